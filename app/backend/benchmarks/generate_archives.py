@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Genera un árbol de archivos de Wazuh sintético (ossec-archive-DD.json / .json.gz)
+con el mismo formato que /var/ossec/logs/archives, para medir sin un manager real.
+
+Ejemplo:
+    python benchmarks/generate_archives.py --output /tmp/archives --days 7 --events-per-day 200000
+    python benchmarks/generate_archives.py --rule-mix sshd_failed=50,web_error=30,syscheck=20
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+from datetime import datetime, timedelta, timezone
+
+# Reglas de ejemplo: id, nivel, descripción, grupos, decoder, ubicación y plantilla de full_log
+RULES = {
+    "sshd_failed": {
+        "id": "5710", "level": 5, "description": "sshd: Attempt to login using a non-existent user",
+        "groups": ["syslog", "sshd", "authentication_failed", "invalid_login"], "decoder": "sshd",
+        "location": "/var/log/auth.log",
+        "full_log": "{month} {day} {time} {agent} sshd[{pid}]: Failed password for invalid user {user} from {srcip} port {port} ssh2",
+    },
+    "sshd_success": {
+        "id": "5715", "level": 3, "description": "sshd: authentication success.",
+        "groups": ["syslog", "sshd", "authentication_success"], "decoder": "sshd",
+        "location": "/var/log/auth.log",
+        "full_log": "{month} {day} {time} {agent} sshd[{pid}]: Accepted publickey for {user} from {srcip} port {port} ssh2",
+    },
+    "sshd_bruteforce": {
+        "id": "5763", "level": 10, "description": "sshd: brute force trying to get access to the system. Authentication failed.",
+        "groups": ["syslog", "sshd", "authentication_failures"], "decoder": "sshd",
+        "location": "/var/log/auth.log",
+        "full_log": "{month} {day} {time} {agent} sshd[{pid}]: Failed password for root from {srcip} port {port} ssh2",
+    },
+    "sudo": {
+        "id": "5402", "level": 3, "description": "Successful sudo to ROOT executed.",
+        "groups": ["syslog", "sudo"], "decoder": "sudo",
+        "location": "/var/log/auth.log",
+        "full_log": "{month} {day} {time} {agent} sudo: {user} : TTY=pts/{tty} ; PWD=/home/{user} ; USER=root ; COMMAND=/usr/bin/systemctl restart nginx",
+    },
+    "web_error": {
+        "id": "31101", "level": 5, "description": "Web server 400 error code.",
+        "groups": ["web", "accesslog", "attack"], "decoder": "web-accesslog",
+        "location": "/var/log/nginx/access.log",
+        "full_log": '{srcip} - - [{day}/{month}/{year}:{time} +0000] "GET /{path}?id={pid} HTTP/1.1" 404 {size} "-" "Mozilla/5.0"',
+    },
+    "web_attack": {
+        "id": "31103", "level": 12, "description": "SQL injection attempt.",
+        "groups": ["web", "accesslog", "attack", "sql_injection"], "decoder": "web-accesslog",
+        "location": "/var/log/nginx/access.log",
+        "full_log": '{srcip} - - [{day}/{month}/{year}:{time} +0000] "GET /{path}?id={pid}%27%20OR%201=1-- HTTP/1.1" 500 {size} "-" "sqlmap/1.7"',
+    },
+    "syscheck": {
+        "id": "550", "level": 7, "description": "Integrity checksum changed.",
+        "groups": ["ossec", "syscheck", "syscheck_entry_modified"], "decoder": "syscheck_integrity_changed",
+        "location": "syscheck",
+        "full_log": "File '/etc/{path}' modified\nMode: realtime\nChanged attributes: size,mtime,md5,sha1,sha256",
+    },
+    "firewall_drop": {
+        "id": "4101", "level": 5, "description": "Firewall drop event.",
+        "groups": ["firewall", "firewall_drop"], "decoder": "iptables",
+        "location": "/var/log/kern.log",
+        "full_log": "{month} {day} {time} {agent} kernel: [UFW BLOCK] IN=eth0 OUT= SRC={srcip} DST=10.0.0.10 PROTO=TCP SPT={port} DPT=22",
+    },
+}
+
+DEFAULT_RULE_MIX = "sshd_failed=30,sshd_success=10,sshd_bruteforce=5,sudo=5,web_error=25,web_attack=3,syscheck=7,firewall_drop=15"
+USERS = ["admin", "root", "oracle", "test", "ubuntu", "deploy", "postgres", "guest"]
+PATHS = ["index.php", "wp-login.php", "api/v1/users", "admin", "passwd", "hosts", "nginx/nginx.conf", "login"]
+
+
+def parse_rule_mix(value):
+    weights = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in RULES:
+            raise argparse.ArgumentTypeError(f"Regla desconocida '{name}'. Disponibles: {', '.join(RULES)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def make_ip_pool(size, rng):
+    return [f"{rng.choice([10, 172, 185, 45, 193])}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}" for _ in range(size)]
+
+
+def pick_skewed(pool, rng, alpha=1.2):
+    """Unos pocos valores concentran la mayoría de eventos, como en un archivo real"""
+    index = int(rng.paretovariate(alpha)) - 1
+    return pool[index % len(pool)]
+
+
+def make_event(day_start, second, sequence, rule_name, agents, ips, rng):
+    rule = RULES[rule_name]
+    moment = day_start + timedelta(seconds=second)
+    agent_id, agent_name = pick_skewed(agents, rng)
+    srcip = pick_skewed(ips, rng)
+    values = {
+        "month": moment.strftime("%b"), "day": moment.strftime("%d"), "year": moment.year,
+        "time": moment.strftime("%H:%M:%S"), "agent": agent_name, "pid": rng.randint(1000, 65000),
+        "user": rng.choice(USERS), "srcip": srcip, "port": rng.randint(1024, 65535),
+        "tty": rng.randint(0, 9), "path": rng.choice(PATHS), "size": rng.randint(100, 20000),
+    }
+    event = {
+        "timestamp": moment.strftime("%Y-%m-%dT%H:%M:%S.") + f"{moment.microsecond // 1000:03d}+0000",
+        "rule": {
+            "level": rule["level"],
+            "description": rule["description"],
+            "id": rule["id"],
+            "firedtimes": sequence % 1000 + 1,
+            "mail": rule["level"] >= 12,
+            "groups": rule["groups"],
+        },
+        "agent": {"id": agent_id, "name": agent_name},
+        "manager": {"name": "wazuh-manager"},
+        "id": f"{int(moment.timestamp())}.{sequence}",
+        "full_log": rule["full_log"].format(**values),
+        "decoder": {"name": rule["decoder"]},
+        "location": rule["location"],
+    }
+    if rule["location"] != "syscheck":
+        event["data"] = {"srcip": srcip, "srcport": str(values["port"]), "srcuser": values["user"]}
+        event["predecoder"] = {"hostname": agent_name, "timestamp": f"{values['month']} {values['day']} {values['time']}"}
+    return event
+
+
+def write_day(output, day, events_per_day, rule_weights, agents, ips, rng, compress):
+    directory = os.path.join(output, str(day.year), day.strftime("%b"))
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"ossec-archive-{day.strftime('%d')}.json" + (".gz" if compress else ""))
+    # Los ficheros van por día local del manager; los timestamps, en UTC (+0000)
+    day_start = day.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None).astimezone(timezone.utc)
+    # El día en curso solo tiene eventos hasta ahora, no en el futuro
+    span = min(86400, max((datetime.now(timezone.utc) - day_start).total_seconds(), 1))
+    names = list(rule_weights)
+    weights = [rule_weights[name] for name in names]
+    opener = gzip.open if compress else open
+    with opener(path, "wt", encoding="utf-8") as f:
+        for sequence in range(events_per_day):
+            # Eventos en orden temporal repartidos a lo largo del día (hasta ahora si es hoy)
+            second = (sequence + rng.random()) * span / events_per_day
+            rule_name = rng.choices(names, weights)[0]
+            f.write(json.dumps(make_event(day_start, second, sequence, rule_name, agents, ips, rng)) + "\n")
+    return path
+
+
+def generate(output, days, events_per_day, rule_weights, agent_count=20, ip_count=5000, seed=42, compress_closed=True, end_day=None):
+    rng = random.Random(seed)
+    agents = [(f"{i:03d}", f"agent-{i:03d}") for i in range(1, agent_count + 1)]
+    ips = make_ip_pool(ip_count, rng)
+    today = end_day or datetime.now()
+    paths = []
+    for i in range(days):
+        day = today - timedelta(days=i)
+        # Wazuh comprime los días cerrados; el del día sigue siendo .json
+        paths.append(write_day(output, day, events_per_day, rule_weights, agents, ips, rng, compress_closed and i > 0))
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generador de archivos de Wazuh sintéticos")
+    parser.add_argument("--output", default="/tmp/wazuh-archives", help="Directorio raíz (equivale a /var/ossec/logs/archives)")
+    parser.add_argument("--days", type=int, default=3, help="Días a generar hacia atrás desde hoy")
+    parser.add_argument("--events-per-day", type=int, default=50000)
+    parser.add_argument("--rule-mix", type=parse_rule_mix, default=parse_rule_mix(DEFAULT_RULE_MIX),
+                        help=f"Pesos por tipo de regla (por defecto: {DEFAULT_RULE_MIX})")
+    parser.add_argument("--agents", type=int, default=20)
+    parser.add_argument("--ips", type=int, default=5000, help="Tamaño del conjunto de IPs de origen")
+    parser.add_argument("--no-gzip", action="store_true", help="No comprimir los días cerrados")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    print(f"🏗️ Generando {args.days} días x {args.events_per_day} eventos en {args.output}...")
+    for path in generate(args.output, args.days, args.events_per_day, args.rule_mix, args.agents, args.ips,
+                         args.seed, not args.no_gzip):
+        print(f"✅ {path} ({os.path.getsize(path) / 1e6:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
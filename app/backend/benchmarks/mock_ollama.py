@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Servidor HTTP que imita la API de Ollama (/api/chat, /api/generate, /api/embed,
+/api/tags) con latencias configurables, para medir el backend sin GPU.
+
+La latencia simula las dos fases de un LLM: prefill (proporcional a los tokens
+del prompt, con un prefijo en cache como el KV cache de Ollama) y decode (por
+token generado).
+
+Ejemplo:
+    python benchmarks/mock_ollama.py --port 11435 --prefill-ms-per-token 0.2 --decode-ms-per-token 25
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWER = (
+    "Según los eventos analizados se observan varios intentos de autenticación fallidos "
+    "desde las mismas IPs de origen contra los agentes más activos. Se recomienda revisar "
+    "las reglas 5710 y 5763, bloquear las direcciones con más intentos y verificar los "
+    "cambios de integridad reportados por syscheck en los ficheros de configuración."
+)
+
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+def now_iso():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def fake_embedding(text, dimensions=64):
+    """Vector determinista: textos iguales dan el mismo embedding"""
+    vector = [0.0] * dimensions
+    for word in text.lower().split():
+        digest = hashlib.md5(word.encode("utf-8")).digest()
+        vector[digest[0] % dimensions] += 1.0 if digest[1] % 2 else -1.0
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+class MockOllama:
+    def __init__(self, prefill_ms_per_token, decode_ms_per_token, output_tokens, load_ms, max_parallel):
+        self.prefill = prefill_ms_per_token / 1000
+        self.decode = decode_ms_per_token / 1000
+        self.output_tokens = output_tokens
+        self.load = load_ms / 1000
+        self.slots = threading.BoundedSemaphore(max_parallel)  # Como OLLAMA_NUM_PARALLEL
+        self.cached_prefix = None
+        self.loaded = False
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def prefill_delay(self, messages):
+        """Solo se cobra el prompt que no comparte prefijo con la petición anterior"""
+        prompt = "".join(message.get("content", "") for message in messages)
+        with self.lock:
+            self.requests += 1
+            delay = 0.0 if self.loaded else self.load
+            self.loaded = True
+            shared = 0
+            if self.cached_prefix:
+                limit = min(len(prompt), len(self.cached_prefix))
+                while shared < limit and prompt[shared] == self.cached_prefix[shared]:
+                    shared += 1
+            self.cached_prefix = prompt
+        return delay + estimate_tokens(prompt[shared:]) * self.prefill, estimate_tokens(prompt)
+
+    def tokens(self, limit=None):
+        words = ANSWER.split(" ")
+        count = min(self.output_tokens, limit or self.output_tokens)
+        return [(" " if i else "") + words[i % len(words)] for i in range(count)]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._json({"models": [{"name": "llama3:latest", "model": "llama3:latest", "size": 0}]})
+        elif self.path == "/api/version":
+            self._json({"version": "0.0.0-mock"})
+        elif self.path == "/":
+            self.send_response(200)
+            self.send_header("Content-Length", "17")
+            self.end_headers()
+            self.wfile.write(b"Ollama is running")
+        else:
+            self._json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        body = self._body()
+        if self.path in ("/api/chat", "/api/generate"):
+            self._generate(body, chat=self.path == "/api/chat")
+        elif self.path == "/api/embed":
+            inputs = body.get("input") or []
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            self._json({"model": body.get("model"), "embeddings": [fake_embedding(text) for text in inputs]})
+        elif self.path == "/api/embeddings":
+            self._json({"embedding": fake_embedding(body.get("prompt", ""))})
+        else:
+            self._json({"error": "not found"}, 404)
+
+    def _chunk(self, payload):
+        data = (json.dumps(payload) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _generate(self, body, chat):
+        mock = self.mock
+        messages = body.get("messages") or [{"content": body.get("prompt", "")}]
+        limit = (body.get("options") or {}).get("num_predict")
+        started = time.perf_counter()
+        with mock.slots:
+            delay, prompt_tokens = mock.prefill_delay(messages)
+            time.sleep(delay)
+            tokens = mock.tokens(limit if limit and limit > 0 else None)
+
+            def piece(text, done):
+                payload = {"model": body.get("model"), "created_at": now_iso(), "done": done}
+                if chat:
+                    payload["message"] = {"role": "assistant", "content": text}
+                else:
+                    payload["response"] = text
+                if done:
+                    payload.update({
+                        "done_reason": "stop",
+                        "total_duration": int((time.perf_counter() - started) * 1e9),
+                        "load_duration": 0,
+                        "prompt_eval_count": prompt_tokens,
+                        "prompt_eval_duration": int(delay * 1e9),
+                        "eval_count": len(tokens),
+                        "eval_duration": int(len(tokens) * mock.decode * 1e9),
+                    })
+                return payload
+
+            if body.get("stream", True):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    for token in tokens:
+                        time.sleep(mock.decode)
+                        self._chunk(piece(token, False))
+                    self._chunk(piece("", True))
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # El cliente canceló la generación
+                return
+            time.sleep(mock.decode * len(tokens))
+            self._json(piece("".join(tokens), True))
+
+
+def start_server(port=11435, prefill_ms_per_token=0.2, decode_ms_per_token=20, output_tokens=120, load_ms=0, max_parallel=1):
+    """Arranca el mock en un hilo y devuelve el servidor (server.shutdown() para pararlo)"""
+    Handler.mock = MockOllama(prefill_ms_per_token, decode_ms_per_token, output_tokens, load_ms, max_parallel)
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock de la API de Ollama con latencias configurables")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--prefill-ms-per-token", type=float, default=0.2, help="Latencia por token de prompt no cacheado")
+    parser.add_argument("--decode-ms-per-token", type=float, default=20, help="Latencia por token generado")
+    parser.add_argument("--output-tokens", type=int, default=120, help="Tokens por respuesta (acotado por num_predict)")
+    parser.add_argument("--load-ms", type=float, default=0, help="Carga del modelo en la primera petición")
+    parser.add_argument("--parallel", type=int, default=1, help="Peticiones simultáneas (OLLAMA_NUM_PARALLEL)")
+    args = parser.parse_args()
+
+    server = start_server(args.port, args.prefill_ms_per_token, args.decode_ms_per_token,
+                          args.output_tokens, args.load_ms, args.parallel)
+    print(f"🤖 Mock de Ollama escuchando en http://127.0.0.1:{args.port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
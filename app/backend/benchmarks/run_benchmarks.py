@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Escenarios de rendimiento del backend sin Wazuh ni GPU.
+
+Genera un archivo sintético, arranca el mock de Ollama y mide
+load_logs_from_days, setup_chain, /stat y N clientes concurrentes de
+/ws/chat. Informa p50/p95/p99, throughput y memoria (RSS); con --baseline
+compara el p95 de cada escenario y sale con código 1 si empeora más de
+--tolerance, para detectar regresiones en CI.
+
+Ejemplo:
+    python benchmarks/run_benchmarks.py --days 3 --events-per-day 50000 --clients 8 --questions 3
+    python benchmarks/run_benchmarks.py --json results.json --baseline baseline.json --tolerance 0.25
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import generate_archives  # noqa: E402
+import mock_ollama  # noqa: E402
+
+SCENARIOS = ("ingest", "setup", "stat", "chat")
+QUESTIONS = [
+    "¿Qué ataques muestran los logs de seguridad de hoy?",
+    "Top 10 agentes con más alertas en los últimos 3 días",
+    "¿Cuántas alertas de nivel 12 o más hubo hoy?",
+    "Resume los security events de intentos de login fallidos",
+    "Explícame qué es Docker",
+]
+TERMINAL_STATUSES = {"response_complete", "timeout_error", "processing_error", "system_not_ready", "loop_error"}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss_mb():
+    # ru_maxrss está en KB en Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[max(math.ceil(pct / 100 * len(ordered)) - 1, 0)]
+
+
+def summarize(name, latencies, work=0, unit="ops"):
+    total = sum(latencies)
+    return {
+        "scenario": name,
+        "runs": len(latencies),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "mean": total / len(latencies),
+        "throughput": work / total if total else 0.0,
+        "unit": f"{unit}/s",
+        "rss_mb": current_rss_mb(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def timed_runs(fn, repeat):
+    latencies = []
+    work = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        work += fn() or 0
+        latencies.append(time.perf_counter() - started)
+    return latencies, work
+
+
+def bench_ingest(main, days, repeat):
+    latencies, events = timed_runs(lambda: len(main.load_logs_from_days(days)), repeat)
+    return [summarize("ingest", latencies, events, "events")]
+
+
+def bench_setup(main, days, repeat):
+    latencies, _ = timed_runs(lambda: main.setup_chain(days) and 1, repeat)
+    return [summarize("setup", latencies, len(latencies), "builds")]
+
+
+def bench_stat(main, days, repeat, index_dir):
+    # En frío incluye construir el índice; en caliente solo se leen los agregados
+    shutil.rmtree(index_dir, ignore_errors=True)
+    main.archive_index = main.ArchiveIndex(index_dir)
+    cold, _ = timed_runs(lambda: len(main.get_index_stats(days).format()) and 1, 1)
+    warm, _ = timed_runs(lambda: len(main.get_index_stats(days).format()) and 1, repeat)
+    return [summarize("stat_cold", cold, 1, "requests"), summarize("stat", warm, len(warm), "requests")]
+
+
+async def chat_client(url, client_id, questions, timeout):
+    import websockets
+
+    latencies, first_tokens = [], []
+    async with websockets.connect(url, max_size=None, open_timeout=timeout) as ws:
+        # Esperar al mensaje de bienvenida (el contexto puede estar construyéndose)
+        while True:
+            message = json.loads(await asyncio.wait_for(ws.recv(), timeout))
+            if message.get("status") in ("ready", "limited"):
+                break
+        for i in range(questions):
+            # Sufijo distinto por cliente y pregunta para no medir el cache de respuestas
+            question = f"{QUESTIONS[(client_id + i) % len(QUESTIONS)]} (c{client_id}q{i})"
+            started = time.perf_counter()
+            first_token = None
+            await ws.send(question)
+            while True:
+                message = json.loads(await asyncio.wait_for(ws.recv(), timeout))
+                status = message.get("status")
+                if first_token is None and status in ("streaming", "response_complete"):
+                    first_token = time.perf_counter() - started
+                if status in TERMINAL_STATUSES:
+                    break
+            latencies.append(time.perf_counter() - started)
+            first_tokens.append(first_token if first_token is not None else latencies[-1])
+    return latencies, first_tokens
+
+
+async def run_chat_clients(url, clients, questions, timeout):
+    results = await asyncio.gather(*(chat_client(url, i, questions, timeout) for i in range(clients)))
+    latencies = [value for client_latencies, _ in results for value in client_latencies]
+    first_tokens = [value for _, client_first in results for value in client_first]
+    return latencies, first_tokens
+
+
+def bench_chat(main, clients, questions, timeout):
+    import uvicorn
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    try:
+        started = time.perf_counter()
+        latencies, first_tokens = asyncio.run(run_chat_clients(f"ws://127.0.0.1:{port}/ws/chat", clients, questions, timeout))
+        elapsed = time.perf_counter() - started
+    finally:
+        server.should_exit = True
+        thread.join(timeout=10)
+    chat = summarize("chat", latencies, len(latencies), "questions")
+    # Throughput real con los clientes en paralelo, no la suma de latencias
+    chat["throughput"] = len(latencies) / elapsed
+    return [chat, summarize("chat_ttft", first_tokens, len(first_tokens), "questions")]
+
+
+def format_report(results):
+    header = f"{'escenario':<12}{'runs':>6}{'p50 s':>10}{'p95 s':>10}{'p99 s':>10}{'throughput':>22}{'RSS MB':>9}{'pico MB':>9}"
+    lines = [header, "-" * len(header)]
+    for result in results:
+        rss = f"{result['rss_mb']:.0f}" if result["rss_mb"] is not None else "-"
+        lines.append(
+            f"{result['scenario']:<12}{result['runs']:>6}{result['p50']:>10.3f}{result['p95']:>10.3f}{result['p99']:>10.3f}"
+            f"{result['throughput']:>12.1f} {result['unit']:<9}{rss:>9}{result['peak_rss_mb']:>9.0f}"
+        )
+    return "\n".join(lines)
+
+
+def compare_baseline(results, baseline_path, tolerance):
+    """Devuelve las regresiones de p95 respecto a un JSON de resultados anterior"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {result["scenario"]: result for result in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        previous = baseline.get(result["scenario"])
+        if previous and result["p95"] > previous["p95"] * (1 + tolerance):
+            regressions.append(f"{result['scenario']}: p95 {result['p95']:.3f}s vs {previous['p95']:.3f}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks del backend con archivo sintético y mock de Ollama")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Lista separada por comas: {', '.join(SCENARIOS)}")
+    parser.add_argument("--archives", help="Árbol de archivos existente (por defecto se genera uno temporal)")
+    parser.add_argument("--days", type=int, default=3)
+    parser.add_argument("--events-per-day", type=int, default=20000)
+    parser.add_argument("--rule-mix", type=generate_archives.parse_rule_mix,
+                        default=generate_archives.parse_rule_mix(generate_archives.DEFAULT_RULE_MIX))
+    parser.add_argument("--repeat", type=int, default=3, help="Repeticiones de ingest/setup/stat")
+    parser.add_argument("--clients", type=int, default=4, help="Clientes /ws/chat concurrentes")
+    parser.add_argument("--questions", type=int, default=3, help="Preguntas por cliente")
+    parser.add_argument("--timeout", type=float, default=120, help="Timeout por mensaje de chat (s)")
+    parser.add_argument("--prefill-ms-per-token", type=float, default=0.2)
+    parser.add_argument("--decode-ms-per-token", type=float, default=10)
+    parser.add_argument("--output-tokens", type=int, default=60)
+    parser.add_argument("--ollama-parallel", type=int, default=1)
+    parser.add_argument("--json", help="Guardar los resultados en este fichero")
+    parser.add_argument("--baseline", help="JSON de resultados previo con el que comparar el p95")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Empeoramiento de p95 permitido (0.2 = 20%%)")
+    parser.add_argument("--verbose", action="store_true", help="Mostrar la salida del backend")
+    args = parser.parse_args()
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+
+    workdir = tempfile.mkdtemp(prefix="wazuh-bench-")
+    archives = args.archives or os.path.join(workdir, "archives")
+    index_dir = os.path.join(workdir, "index")
+    if not args.archives:
+        print(f"🏗️ Generando {args.days} días x {args.events_per_day} eventos...")
+        generate_archives.generate(archives, args.days, args.events_per_day, args.rule_mix)
+
+    ollama_port = free_port()
+    ollama = mock_ollama.start_server(ollama_port, args.prefill_ms_per_token, args.decode_ms_per_token,
+                                      args.output_tokens, max_parallel=args.ollama_parallel)
+    # main lee la configuración del entorno al importarse
+    os.environ.update({
+        "OLLAMA_BASE_URL": f"http://127.0.0.1:{ollama_port}",
+        "OLLAMA_MODEL": "llama3",
+        "REMOTE_HOST": "",
+        "WAZUH_INDEX_DIR": index_dir,
+        "ARCHIVE_FOLLOW_INTERVAL": "0",
+    })
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+
+    results = []
+    try:
+        with output:
+            import main as backend
+            backend.ARCHIVES_DIR = archives
+            backend.remote_host = None
+            backend.days_range = args.days
+            if "ingest" in scenarios:
+                results += bench_ingest(backend, args.days, args.repeat)
+            if "setup" in scenarios:
+                results += bench_setup(backend, args.days, args.repeat)
+            if "stat" in scenarios:
+                results += bench_stat(backend, args.days, args.repeat, index_dir)
+            if "chat" in scenarios:
+                results += bench_chat(backend, args.clients, args.questions, args.timeout)
+    finally:
+        ollama.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(format_report(results))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"config": {k: v for k, v in vars(args).items() if k != "rule_mix"}, "results": results}, f, indent=2)
+        print(f"💾 Resultados guardados en {args.json}")
+    if args.baseline:
+        regressions = compare_baseline(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"❌ Regresión: {regression}")
+        if regressions:
+            sys.exit(1)
+        print("✅ Sin regresiones respecto a la referencia")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,33 @@
 import json
 import os
+import re
+import time
+import hashlib
+import io
+import shlex
+import calendar
+import unicodedata
+import math
 import gzip 
+from array import array
+from bisect import bisect_left
 from datetime import datetime, timedelta
 import asyncio
 import traceback
+import itertools
+from itertools import islice
+from collections import Counter, deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import threading
+import queue
 import sys
 from paramiko.auth_strategy import PrivateKey
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
 from langchain_ollama import ChatOllama
-from langchain.schema.messages import SystemMessage, HumanMessage
+from langchain.schema.messages import SystemMessage, HumanMessage, AIMessage
 import uvicorn
 import argparse
 import sys
@@ -17,6 +35,12 @@ from fastapi import Depends, status, HTTPException
 from fastapi.security import HTTPBearer
 import secrets
 
+try:
+    import orjson  # Backend JSON opcional, bastante más rápido que json
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 
 # Classes 
 class Prompt(BaseModel):
@@ -24,22 +48,134 @@ class Prompt(BaseModel):
 
 
 # ===== Globals for caching =====
-qa_chain = None
-context = None
-wazuh_context = None
-general_context = None
-days_range = 1
+days_range = 1  # Rango por defecto de las sesiones nuevas
 
 
 app = FastAPI()
 security = HTTPBearer()
 
 
+# ===== Métricas (formato de texto de Prometheus) =====
+
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+METRICS_BYTES_BUCKETS = (1e4, 1e5, 1e6, 1e7, 1e8, 1e9, 1e10)
+METRICS_TOKEN_BUCKETS = (128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+metrics_registry = []
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.lock = threading.Lock()  # Se observan desde el event loop y desde hilos
+        metrics_registry.append(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+
+class CounterMetric(Metric):
+    type = "counter"
+
+    def __init__(self, name, documentation):
+        super().__init__(name, documentation)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self):
+        return self.header() + [f"{self.name} {self.value}"]
+
+
+class GaugeMetric(CounterMetric):
+    type = "gauge"
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class HistogramMetric(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, buckets=METRICS_LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            if index < len(self.counts):
+                self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return MetricTimer(self)
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            cumulative = 0
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{le="{bound:g}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+            lines.append(f"{self.name}_sum {self.sum:.6f}")
+            lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class MetricTimer:
+    """with HISTOGRAMA.time(): ... observa la duración del bloque en segundos"""
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+def render_metrics():
+    return "\n".join(line for metric in metrics_registry for line in metric.render()) + "\n"
+
+
+ARCHIVE_READ_SECONDS = HistogramMetric(
+    "wazuh_archive_read_seconds", "Tiempo de lectura y decodificación (o indexado) de un día de archivo")
+ARCHIVE_READ_BYTES = HistogramMetric(
+    "wazuh_archive_read_bytes", "Bytes descomprimidos consumidos por lectura de un día de archivo", METRICS_BYTES_BUCKETS)
+LOG_LINES_PARSED = CounterMetric("wazuh_log_lines_parsed_total", "Líneas JSON decodificadas")
+LOG_PARSE_ERRORS = CounterMetric("wazuh_log_parse_errors_total", "Líneas que no son JSON válido")
+LOG_LOAD_SECONDS = HistogramMetric("wazuh_log_load_seconds", "Duración de la carga de los eventos de un rango")
+CONTEXT_BUILD_SECONDS = HistogramMetric("wazuh_context_build_seconds", "Duración de la construcción de un snapshot de contexto")
+PROMPT_TOKENS = HistogramMetric("wazuh_prompt_tokens", "Tokens estimados del prompt enviado al LLM", METRICS_TOKEN_BUCKETS)
+LLM_QUEUE_WAIT_SECONDS = HistogramMetric("wazuh_llm_queue_wait_seconds", "Espera en la cola del planificador del LLM")
+LLM_FIRST_TOKEN_SECONDS = HistogramMetric(
+    "wazuh_llm_time_to_first_token_seconds", "Desde que se recibe la pregunta hasta el primer token")
+LLM_GENERATION_SECONDS = HistogramMetric("wazuh_llm_generation_seconds", "Duración total de la generación del LLM")
+WEBSOCKETS_ACTIVE = GaugeMetric("wazuh_websocket_connections", "Conexiones WebSocket activas")
+
+
 # ===== CONFIGURACIÓN OLLAMA PARA DOCKER =====
 # Si Ollama está en el host, usa host.docker.internal
 # Si está en otro contenedor, usa el nombre del servicio
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "YOUR_OLLAMA_BASE_URL")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3")
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "8192"))
 api_key = os.getenv("API_KEY", "Toor0128#$95")
 remote_host = os.getenv("REMOTE_HOST", "143.244.165.32")
 ssh_username = os.getenv("SSH_USERNAME", "root")
@@ -65,146 +201,3546 @@ def run_daemon():
         uvicorn.run(app, host="0.0.0.0", port=8000)
 
 
-def load_logs_from_remote(host, user, ssh_private_key, past_days):
-    import paramiko
-    logs = []
-    today = datetime.now()
+ARCHIVES_DIR = "/var/ossec/logs/archives"
+CONTEXT_MAX_LOGS = 100
+# Campos que necesita el contexto; el resto del evento no se conserva
+CONTEXT_FIELDS = ("timestamp", "full_log", "rule.id", "rule.level", "rule.description", "agent.name")
+
+
+def archive_day_paths(day, base_path=None):
+    """Devuelve las rutas (.json, .json.gz) del archivo de Wazuh para un día"""
+    base = f"{base_path or ARCHIVES_DIR}/{day.year}/{day.strftime('%b')}"
+    day_num = day.strftime("%d")
+    return f"{base}/ossec-archive-{day_num}.json", f"{base}/ossec-archive-{day_num}.json.gz"
+
+
+def iter_archive_days(past_days):
+    """Genera los días a cargar, del más reciente al más antiguo"""
+    today = datetime.now()
+    for i in range(past_days):
+        yield today - timedelta(days=i)
+
+
+def iter_window_days(since, until=None):
+    """Días de archivo que pueden contener eventos de [since, until), del más reciente al más antiguo.
+
+    Se añade un día antes de since: el manager puede estar en otra zona horaria.
+    """
+    today = datetime.now()
+    last = min(datetime.fromtimestamp(until), today) if until else today
+    first = datetime.fromtimestamp(since) - timedelta(days=1)
+    day = last
+    while day.date() >= first.date():
+        yield day
+        day -= timedelta(days=1)
+
+
+def decode_log(raw):
+    """Decodifica una línea con el backend JSON más rápido disponible"""
+    try:
+        return json_loads(raw)
+    except ValueError:
+        # orjson rechaza UTF-8 inválido; json lo tolera tras limpiar los bytes
+        if isinstance(raw, bytes):
+            return json.loads(raw.decode('utf-8', errors='ignore'))
+        raise
+
+
+# ===== Eventos compactos =====
+
+FULL_LOG_OPEN_FILES = 4  # Archivos abiertos para leer full_log bajo demanda
+
+
+def intern_text(value):
+    """Comparte una sola copia de los textos que se repiten (agentes, reglas, decoders...)"""
+    return sys.intern(value) if isinstance(value, str) else None
+
+
+_GROUPS = {}  # Tuplas de grupos compartidas entre eventos
+
+
+def intern_groups(groups):
+    if not groups:
+        return ()
+    key = tuple(intern_text(group) for group in groups if isinstance(group, str))
+    return _GROUPS.setdefault(key, key)
+
+
+class FullLogReader:
+    """Lee el full_log de un evento a partir de su archivo y offset.
+
+    Solo se usa con archivos sin comprimir que ya no rotan (ver
+    event_record_factory) y mantiene abiertos los últimos usados.
+    """
+
+    def __init__(self, max_files=FULL_LOG_OPEN_FILES):
+        self.max_files = max_files
+        self.files = OrderedDict()  # ruta -> fichero abierto
+        self.lock = threading.Lock()
+
+    def read(self, path, offset):
+        with self.lock:
+            try:
+                f = self.files.pop(path, None) or open_local_archive(path)
+                self.files[path] = f
+                while len(self.files) > self.max_files:
+                    self.files.popitem(last=False)[1].close()
+                f.seek(offset)
+                raw = f.readline()
+            except OSError as e:
+                print(f"⚠️ Error reading event at {path}:{offset}: {e}")
+                return None
+        try:
+            return decode_log(raw).get('full_log')
+        except ValueError:
+            return None
+
+    def close(self):
+        with self.lock:
+            for f in self.files.values():
+                f.close()
+            self.files.clear()
+
+
+full_log_reader = FullLogReader()
+
+
+class EventRecord:
+    """Evento de Wazuh compacto: solo los campos que usa el backend.
+
+    Ocupa una fracción del dict anidado de json.loads: atributos en
+    __slots__, textos repetidos compartidos con intern_text() y, si se
+    construye con path, full_log se lee del archivo al pedirlo. get() imita
+    al dict original ('rule', 'agent', 'data'...) para los consumidores
+    existentes.
+    """
+
+    __slots__ = (
+        "timestamp", "rule_level", "rule_id", "rule_description", "rule_groups",
+        "agent_id", "agent_name", "decoder", "location", "srcip", "_full_log", "path", "offset",
+    )
+
+    def __init__(self, timestamp=None, rule_level=None, rule_id=None, rule_description=None, rule_groups=(),
+                 agent_id=None, agent_name=None, decoder=None, location=None, srcip=None,
+                 full_log=None, path=None, offset=None):
+        self.timestamp = timestamp
+        self.rule_level = rule_level
+        self.rule_id = intern_text(rule_id)
+        self.rule_description = intern_text(rule_description)
+        self.rule_groups = intern_groups(rule_groups)
+        self.agent_id = intern_text(agent_id)
+        self.agent_name = intern_text(agent_name)
+        self.decoder = intern_text(decoder)
+        self.location = intern_text(location)
+        self.srcip = intern_text(srcip)
+        self._full_log = full_log
+        self.path = intern_text(path)
+        self.offset = offset
+
+    @classmethod
+    def from_log(cls, log, path=None, offset=None):
+        """Desde el dict decodificado; con path no se guarda full_log (se lee bajo demanda)"""
+        rule = log.get('rule') or {}
+        agent = log.get('agent') or {}
+        rule_id = rule.get('id')
+        return cls(
+            log.get('timestamp'), rule.get('level'), str(rule_id) if rule_id is not None else None,
+            rule.get('description'), rule.get('groups'), agent.get('id'), agent.get('name'),
+            (log.get('decoder') or {}).get('name'), log.get('location'), (log.get('data') or {}).get('srcip'),
+            None if path else log.get('full_log'), path, offset if path else None,
+        )
+
+    @property
+    def full_log(self):
+        if self._full_log is None and self.path is not None:
+            return full_log_reader.read(self.path, self.offset)
+        return self._full_log
+
+    def __getstate__(self):
+        # Tupla compacta para enviar lotes entre procesos
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        # Al recibir un lote se vuelven a compartir los textos en este proceso
+        self.__init__(*state)
+
+    def _section(self, values):
+        section = {key: value for key, value in values.items() if value is not None and value != ()}
+        return section or None
+
+    def get(self, key, default=None):
+        if key == 'timestamp':
+            value = self.timestamp
+        elif key == 'full_log':
+            value = self.full_log
+        elif key == 'rule':
+            value = self._section({
+                'level': self.rule_level, 'id': self.rule_id,
+                'description': self.rule_description, 'groups': list(self.rule_groups) or None,
+            })
+        elif key == 'agent':
+            value = self._section({'id': self.agent_id, 'name': self.agent_name})
+        elif key == 'decoder':
+            value = self._section({'name': self.decoder})
+        elif key == 'data':
+            value = self._section({'srcip': self.srcip})
+        elif key == 'location':
+            value = self.location
+        else:
+            value = None
+        return default if value is None else value
+
+
+# Prefiltros anclados a la estructura de Wazuh: {"timestamp":"...","rule":{"level":N,...
+_RAW_TIMESTAMP_RE = re.compile(rb'^\{\s*"timestamp":\s*"([^"]+)"')
+_RAW_RULE_LEVEL_RE = re.compile(rb'^\{\s*"timestamp":\s*"[^"]*",\s*"rule":\s*\{\s*"level":\s*(\d+)')
+
+
+class LogFilter:
+    """Filtro de eventos con un prefiltro barato sobre los bytes crudos.
+
+    matches_raw() solo descarta líneas que seguro no cumplen (si el patrón no
+    aparece se decodifica igualmente) y matches() comprueba el evento ya
+    decodificado. fields limita los campos que se conservan (rutas con punto,
+    p. ej. "rule.level"). Con since la lectura se limita a los días de la
+    ventana y, dentro de cada archivo, a los bloques del índice que la cubren.
+    """
+
+    def __init__(self, min_level=None, agents=None, since=None, until=None, fields=None,
+                 max_level=None, rule_ids=None, groups=None):
+        self.min_level = min_level
+        self.max_level = max_level
+        self.agents = set(agents) if agents else None
+        self.rule_ids = {str(rule_id) for rule_id in rule_ids} if rule_ids else None
+        self.groups = set(groups) if groups else None
+        self.since = since
+        self.until = until
+        self.fields = tuple(fields) if fields else None
+        self._agent_bytes = []
+        for agent in self.agents or ():
+            self._agent_bytes.append(agent.encode('utf-8'))
+            self._agent_bytes.append(json.dumps(agent)[1:-1].encode('ascii'))
+        self._rule_bytes = [rule_id.encode('utf-8') for rule_id in self.rule_ids or ()]
+        self._group_bytes = [json.dumps(group)[1:-1].encode('utf-8') for group in self.groups or ()]
+
+    def _in_window(self, ts):
+        if self.since is not None and ts < self.since:
+            return False
+        if self.until is not None and ts >= self.until:
+            return False
+        return True
+
+    def matches_raw(self, raw):
+        if self._agent_bytes and not any(agent in raw for agent in self._agent_bytes):
+            return False
+        if self._rule_bytes and not any(rule_id in raw for rule_id in self._rule_bytes):
+            return False
+        if self._group_bytes and not any(group in raw for group in self._group_bytes):
+            return False
+        if self.min_level is not None or self.max_level is not None:
+            match = _RAW_RULE_LEVEL_RE.match(raw)
+            if match and not self._level_in_range(int(match.group(1))):
+                return False
+        if self.since is not None or self.until is not None:
+            match = _RAW_TIMESTAMP_RE.match(raw)
+            if match and not self._in_window(parse_timestamp(match.group(1).decode('ascii', errors='ignore'))):
+                return False
+        return True
+
+    def _level_in_range(self, level):
+        if self.min_level is not None and level < self.min_level:
+            return False
+        if self.max_level is not None and level > self.max_level:
+            return False
+        return True
+
+    def matches(self, log):
+        if self.agents is not None and (log.get('agent') or {}).get('name') not in self.agents:
+            return False
+        rule = log.get('rule') or {}
+        if self.rule_ids is not None and str(rule.get('id', '')) not in self.rule_ids:
+            return False
+        if self.groups is not None and not self.groups.intersection(rule.get('groups') or ()):
+            return False
+        if self.min_level is not None or self.max_level is not None:
+            try:
+                level = int(rule.get('level') or 0)
+            except (TypeError, ValueError):
+                level = 0
+            if not self._level_in_range(level):
+                return False
+        if self.since is not None or self.until is not None:
+            if not self._in_window(parse_timestamp(log.get('timestamp'))):
+                return False
+        return True
+
+    @property
+    def indexed(self):
+        """Hay criterios que el índice columnar resuelve sin decodificar JSON"""
+        return any(value is not None for value in (self.since, self.until, self.min_level, self.max_level,
+                                                   self.agents, self.rule_ids))
+
+    @property
+    def remote_fields(self):
+        """Campos que conserva el manager: los pedidos y los que vuelve a comprobar matches()"""
+        if not self.fields:
+            return []
+        return list(dict.fromkeys(self.fields + ("timestamp", "rule.level", "rule.id", "rule.groups", "agent.name")))
+
+    @property
+    def remote_options(self):
+        """Criterios que el script remoto recibe en su último argumento"""
+        return {
+            "max_level": self.max_level,
+            "rule_ids": sorted(self.rule_ids or ()),
+            "groups": sorted(self.groups or ()),
+        }
+
+    def describe(self):
+        parts = []
+        if self.since:
+            parts.append(f"desde {datetime.fromtimestamp(self.since).strftime('%Y-%m-%d %H:%M')}")
+        if self.until:
+            parts.append(f"hasta {datetime.fromtimestamp(self.until).strftime('%Y-%m-%d %H:%M')}")
+        if self.min_level is not None and self.min_level == self.max_level:
+            parts.append(f"nivel {self.min_level}")
+        else:
+            if self.min_level is not None:
+                parts.append(f"nivel >= {self.min_level}")
+            if self.max_level is not None:
+                parts.append(f"nivel <= {self.max_level}")
+        for label, values in (("agentes", self.agents), ("reglas", self.rule_ids), ("grupos", self.groups)):
+            if values:
+                parts.append(f"{label} {','.join(sorted(values))}")
+        return ", ".join(parts) or "sin filtros"
+
+    def project(self, log):
+        if not self.fields:
+            return log
+        projected = {}
+        for path in self.fields:
+            keys = path.split('.')
+            value = log
+            for key in keys:
+                value = value.get(key) if isinstance(value, dict) else None
+                if value is None:
+                    break
+            if value is None:
+                continue
+            target = projected
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = value
+        return projected
+
+
+def parse_log_lines(lines, source, log_filter=None, make_record=None, start=0, offsets=None):
+    """Decodifica perezosamente las líneas JSON de un archivo de archivo.
+
+    Con make_record(log, offset) se entrega un EventRecord en lugar del dict;
+    start es el offset de la primera línea. Con offsets solo se decodifican
+    las líneas que empiezan en ellos (filas elegidas en el índice). El tiempo
+    de las métricas es el de lectura y decodificación, sin el del consumidor.
+    """
+    parsed = errors = 0
+    offset = start
+    elapsed = 0.0
+    resumed = time.perf_counter()
+    try:
+        for line in lines:
+            line_start = offset
+            offset += len(line)
+            if offsets is not None and line_start not in offsets:
+                continue
+            if isinstance(line, str):
+                line = line.encode('utf-8', errors='ignore')
+            line = line.strip()
+            if not line:
+                continue
+            if log_filter and not log_filter.matches_raw(line):
+                continue
+            try:
+                log = decode_log(line)
+            except ValueError:
+                errors += 1
+                print(f"⚠️ Skipping invalid JSON line in {source}")
+                continue
+            parsed += 1
+            if log_filter and not log_filter.matches(log):
+                continue
+            if make_record:
+                log = make_record(log, line_start)
+            elif log_filter:
+                log = log_filter.project(log)
+            elapsed += time.perf_counter() - resumed
+            resumed = None
+            yield log
+            resumed = time.perf_counter()
+    finally:
+        if resumed is not None:
+            elapsed += time.perf_counter() - resumed
+        # Una vez por archivo: las métricas tienen lock
+        ARCHIVE_READ_SECONDS.observe(elapsed)
+        ARCHIVE_READ_BYTES.observe(offset - start)
+        LOG_LINES_PARSED.inc(parsed)
+        LOG_PARSE_ERRORS.inc(errors)
+
+
+def open_local_archive(path, offset=0):
+    """Abre un archivo local en binario (descomprimido) posicionado en offset"""
+    f = gzip.open(path, 'rb') if path.endswith(".gz") else open(path, 'rb')
+    if offset:
+        f.seek(offset)
+    return f
+
+
+class ArchiveSlice:
+    """Líneas de un archivo abierto en start, hasta el offset end (None = hasta el final)"""
+
+    def __init__(self, f, start=0, end=None):
+        self.f = f
+        self.start = start
+        self.end = end
+
+    def __iter__(self):
+        offset = self.start
+        for line in self.f:
+            if self.end is not None and offset >= self.end:
+                break
+            offset += len(line)
+            yield line
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+
+def open_archive_slice(source, path, start=0, end=None):
+    """Abre [start, end) de un archivo de la fuente; sin límites, el archivo tal cual"""
+    if not start and end is None:
+        return source.open(path)
+    return ArchiveSlice(source.open(path, start), start, end)
+
+
+class IndexFeed:
+    """Eventos de las líneas completas de un archivo abierto en start, para indexar.
+
+    Genera (offset de la línea, evento o None si no es JSON válido) y deja en
+    consumed el offset tras la última línea leída. En archivos abiertos (el
+    .json del día) una última línea sin salto de línea todavía se está
+    escribiendo y se deja para la siguiente pasada, y la lectura se detiene
+    en limit (el tamaño del stat): lo escrito después se indexa en la
+    siguiente actualización, con su propio stat.
+    """
+
+    def __init__(self, f, start, limit=None, closed=True):
+        self.f = f
+        self.consumed = start
+        self.limit = limit
+        self.closed = closed
+
+    def __iter__(self):
+        for raw in self.f:
+            line_start = self.consumed
+            if not raw.endswith(b"\n") and not self.closed:
+                break
+            if self.limit is not None and line_start + len(raw) > self.limit:
+                break
+            self.consumed += len(raw)
+            raw = raw.strip()
+            if not raw:
+                continue
+            try:
+                log = decode_log(raw)
+            except ValueError:
+                log = None
+            yield line_start, log
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+
+def open_index_feed(source, path, start, stat):
+    closed = path.endswith(".gz")
+    return IndexFeed(source.open(path, start), start, None if closed else stat["size"], closed)
+
+
+class LocalArchiveSource:
+    """Archivos de Wazuh en el disco local"""
+    name = "local"
+    filters_remotely = False
+
+    def locate(self, day):
+        """Devuelve (ruta, stat) del archivo no vacío del día, o None"""
+        for path in archive_day_paths(day):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if st.st_size > 0:
+                return path, {"size": st.st_size, "mtime": int(st.st_mtime), "inode": st.st_ino}
+        return None
+
+    def open(self, path, offset=0):
+        return open_local_archive(path, offset)
+
+    def open_events(self, path, log_filter=None, start=0, end=None):
+        return open_archive_slice(self, path, start, end)
+
+    def open_index(self, path, start, stat):
+        return open_index_feed(self, path, start, stat)
+
+    def close(self):
+        pass
+
+
+SSH_KEEPALIVE = int(os.getenv("SSH_KEEPALIVE", "30"))  # Segundos entre keepalives
+SSH_MAX_CHANNELS = int(os.getenv("SSH_MAX_CHANNELS", "4"))  # Canales SFTP simultáneos por host
+SSH_CHANNEL_TIMEOUT = 60
+
+
+class SFTPConnectionPool:
+    """Conexión SSH persistente a un host con canales SFTP reutilizables.
+
+    La clave privada se carga una sola vez y el handshake solo se repite si
+    el transporte muere (keepalive caído, reinicio del manager...). Un
+    semáforo limita los canales abiertos a la vez.
+    """
+
+    def __init__(self, host, user, ssh_private_key, max_channels=SSH_MAX_CHANNELS, keepalive=SSH_KEEPALIVE):
+        self.host = host
+        self.user = user
+        self.ssh_private_key = ssh_private_key
+        self.keepalive = keepalive
+        self.slots = threading.BoundedSemaphore(max_channels)
+        self.lock = threading.Lock()
+        self.private_key = None
+        self.ssh = None
+        self.idle = []
+
+    def _is_alive(self):
+        transport = self.ssh.get_transport() if self.ssh else None
+        return bool(transport and transport.is_active())
+
+    def _reset(self):
+        for sftp in self.idle:
+            try:
+                sftp.close()
+            except Exception:
+                pass
+        self.idle = []
+        if self.ssh:
+            self.ssh.close()
+        self.ssh = None
+
+    def _connect(self):
+        import paramiko
+        if self.private_key is None:
+            print(f"🔑 Loading private key from {self.ssh_private_key}")
+            self.private_key = paramiko.RSAKey.from_private_key_file(self.ssh_private_key)
+            print("🔑 Private key loaded successfully")
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            ssh.connect(self.host, username=self.user, pkey=self.private_key, timeout=20)
+        except Exception:
+            ssh.close()
+            raise
+        ssh.get_transport().set_keepalive(self.keepalive)
+        self.ssh = ssh
+        print(f"🔑 SSH connection established ({self.host})")
+
+    def _open_channel(self):
+        with self.lock:
+            if not self._is_alive():
+                self._reset()
+                self._connect()
+            if self.idle:
+                return self.idle.pop()
+            try:
+                return self.ssh.open_sftp()
+            except Exception:
+                # Transporte medio muerto: reconectar una vez
+                print(f"🔁 SSH transport to {self.host} is stale, reconnecting...")
+                self._reset()
+                self._connect()
+                return self.ssh.open_sftp()
+
+    def acquire(self, timeout=SSH_CHANNEL_TIMEOUT):
+        if not self.slots.acquire(timeout=timeout):
+            raise TimeoutError(f"No free SFTP channel to {self.host} after {timeout}s")
+        try:
+            return self._open_channel()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def release(self, sftp, broken=False):
+        with self.lock:
+            channel = sftp.get_channel()
+            if broken or not self._is_alive() or channel is None or channel.closed:
+                try:
+                    sftp.close()
+                except Exception:
+                    pass
+            else:
+                self.idle.append(sftp)
+        self.slots.release()
+
+    def exec_command(self, command):
+        """Ejecuta un comando en el manager y devuelve (stdout, stderr)"""
+        with self.lock:
+            if not self._is_alive():
+                self._reset()
+                self._connect()
+            _, stdout, stderr = self.ssh.exec_command(command, bufsize=SFTP_BUFFER_SIZE)
+        return stdout, stderr
+
+    def close(self):
+        with self.lock:
+            self._reset()
+
+
+_sftp_pools = {}
+_sftp_pools_lock = threading.Lock()
+
+
+def get_sftp_pool(host, user, ssh_private_key):
+    key = (host, user, ssh_private_key)
+    with _sftp_pools_lock:
+        pool = _sftp_pools.get(key)
+        if pool is None:
+            pool = _sftp_pools[key] = SFTPConnectionPool(host, user, ssh_private_key)
+        return pool
+
+
+def close_sftp_pools():
+    with _sftp_pools_lock:
+        for pool in _sftp_pools.values():
+            pool.close()
+        _sftp_pools.clear()
+
+
+# Modo de transferencia remota: "sftp" lee el archivo tal cual, "stream"
+# filtra y comprime en el manager antes de enviar
+REMOTE_TRANSFER_MODE = os.getenv("REMOTE_TRANSFER_MODE", "sftp")
+REMOTE_COMPRESSION = os.getenv("REMOTE_COMPRESSION", "gzip")  # gzip | zstd
+REMOTE_PYTHON = os.getenv("REMOTE_PYTHON", "python3")
+SFTP_BUFFER_SIZE = 1024 * 1024
+
+# Campos que necesitan el índice columnar y su minero de plantillas
+INDEX_FEED_FIELDS = ("timestamp", "rule.level", "rule.id", "agent.name", "data.srcip", "decoder.name", "location", "full_log")
+
+# Se ejecuta en el manager: lee el archivo del día, aplica ventana temporal,
+# nivel mínimo y agentes, y escribe solo los campos pedidos (JSON por línea).
+# En modo índice no filtra: cada línea lleva su offset y el siguiente, y se
+# para en limit y en una última línea a medio escribir, como IndexFeed
+REMOTE_FILTER_SCRIPT = r"""
+import sys, json, gzip, calendar
+path, since, until, min_level = sys.argv[1], float(sys.argv[2]), float(sys.argv[3]), int(sys.argv[4])
+agents, fields = set(json.loads(sys.argv[5])), json.loads(sys.argv[6])
+extra = json.loads(sys.argv[7]) if len(sys.argv) > 7 else {}
+max_level, rule_ids, groups = extra.get('max_level'), set(extra.get('rule_ids') or []), set(extra.get('groups') or [])
+start, end = extra.get('start') or 0, extra.get('end')
+limit, index = extra.get('limit'), extra.get('index')
+def ts(v):
+    try:
+        off = int(v[24:26]) * 3600 + int(v[26:28]) * 60
+        off = -off if v[23] == '-' else off
+        return calendar.timegm((int(v[0:4]), int(v[5:7]), int(v[8:10]), int(v[11:13]), int(v[14:16]), int(v[17:19]))) - off
+    except (TypeError, ValueError, IndexError):
+        return None
+def get(ev, p):
+    for k in p:
+        ev = ev.get(k) if isinstance(ev, dict) else None
+    return ev
+out = sys.stdout.buffer
+with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')) as f:
+    f.seek(start)
+    offset = start
+    for line in f:
+        if end is not None and offset >= end:
+            break
+        if index and not path.endswith('.gz') and not line.endswith(b'\n'):
+            break
+        if limit is not None and offset + len(line) > limit:
+            break
+        line_start = offset
+        offset += len(line)
+        if index and not line.strip():
+            out.write(json.dumps({'n': offset}).encode('utf-8') + b'\n')
+            continue
+        try:
+            ev = json.loads(line.decode('utf-8', 'ignore'))
+        except ValueError:
+            if index:
+                out.write(json.dumps({'o': line_start, 'n': offset}).encode('utf-8') + b'\n')
+            continue
+        t = ts(ev.get('timestamp') or '')
+        if t is not None and (t < since or (until and t >= until)):
+            continue
+        try:
+            level = int(get(ev, ['rule', 'level']) or 0)
+            if level < min_level or (max_level is not None and level > max_level):
+                continue
+        except (TypeError, ValueError):
+            pass
+        if agents and get(ev, ['agent', 'name']) not in agents:
+            continue
+        if rule_ids and str(get(ev, ['rule', 'id'])) not in rule_ids:
+            continue
+        if groups and not groups.intersection(get(ev, ['rule', 'groups']) or []):
+            continue
+        if fields:
+            slim = {}
+            for p in fields:
+                keys = p.split('.')
+                v = get(ev, keys)
+                if v is None:
+                    continue
+                d = slim
+                for k in keys[:-1]:
+                    d = d.setdefault(k, {})
+                d[keys[-1]] = v
+            ev = slim
+        if index:
+            ev = {'o': line_start, 'n': offset, 'e': ev}
+        out.write(json.dumps(ev, separators=(',', ':')).encode('utf-8') + b'\n')
+"""
+
+
+class RemoteCommandStream:
+    """Salida comprimida de un comando remoto, leída como líneas descomprimidas"""
+
+    def __init__(self, channel_file, stderr_file, command):
+        self.channel_file = channel_file
+        self.stderr_file = stderr_file
+        self.command = command
+        if REMOTE_COMPRESSION == "zstd":
+            import zstandard
+            self.reader = io.BufferedReader(
+                zstandard.ZstdDecompressor().stream_reader(channel_file), buffer_size=SFTP_BUFFER_SIZE
+            )
+        else:
+            self.reader = gzip.GzipFile(fileobj=channel_file)
+
+    def __iter__(self):
+        return iter(self.reader)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        channel = self.channel_file.channel
+        self.reader.close()
+        if channel.exit_status_ready() and channel.recv_exit_status() != 0:
+            error = self.stderr_file.read().decode('utf-8', errors='ignore').strip()
+            print(f"⚠️ Remote filter command failed: {error[:300]}")
+        channel.close()
+
+
+class RemoteIndexFeed:
+    """IndexFeed a partir de la salida del script remoto en modo índice"""
+
+    def __init__(self, stream, start):
+        self.stream = stream
+        self.consumed = start
+
+    def __iter__(self):
+        for raw in self.stream:
+            item = decode_log(raw)
+            self.consumed = item["n"]
+            if "o" in item:
+                yield item["o"], item.get("e")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.stream.close()
+
+
+class RemoteArchiveSource:
+    """Archivos de Wazuh en el manager remoto, leídos por un canal SFTP del pool"""
+
+    def __init__(self, host, pool, sftp):
+        self.name = host
+        self.pool = pool
+        self.sftp = sftp
+        self.broken = False
+
+    @classmethod
+    def connect(cls, host, user, ssh_private_key):
+        pool = get_sftp_pool(host, user, ssh_private_key)
+        return cls(host, pool, pool.acquire())
+
+    def locate(self, day):
+        for path in archive_day_paths(day):
+            try:
+                st = self.sftp.stat(path)
+            except IOError:
+                continue
+            except Exception:
+                self.broken = True
+                raise
+            if st.st_size > 0:
+                # SFTP no expone el inode
+                return path, {"size": st.st_size, "mtime": int(st.st_mtime or 0), "inode": 0}
+        return None
+
+    def open(self, path, offset=0):
+        """Abre el archivo con buffer grande y lecturas SFTP en paralelo (prefetch)"""
+        remote_file = self.sftp.open(path, 'rb', bufsize=SFTP_BUFFER_SIZE)
+        if path.endswith(".gz"):
+            remote_file.prefetch()
+            f = gzip.GzipFile(fileobj=remote_file)
+            if offset:
+                f.seek(offset)
+            return f
+        if offset:
+            remote_file.seek(offset)
+        # prefetch pide los bloques desde la posición actual
+        remote_file.prefetch()
+        return remote_file
+
+    @property
+    def filters_remotely(self):
+        return REMOTE_TRANSFER_MODE == "stream"
+
+    def open_events(self, path, log_filter=None, start=0, end=None):
+        """En modo stream el manager filtra, proyecta y comprime antes de enviar"""
+        if not self.filters_remotely:
+            return open_archive_slice(self, path, start, end)
+        log_filter = log_filter or LogFilter()
+        return self._run_filter(
+            path, log_filter, log_filter.remote_fields, {**log_filter.remote_options, "start": start, "end": end}
+        )
+
+    def open_index(self, path, start, stat):
+        """En modo stream el manager lee el archivo y envía solo los campos del índice"""
+        if not self.filters_remotely:
+            return open_index_feed(self, path, start, stat)
+        limit = None if path.endswith(".gz") else stat["size"]
+        options = {"start": start, "limit": limit, "index": True}
+        return RemoteIndexFeed(self._run_filter(path, LogFilter(), list(INDEX_FEED_FIELDS), options), start)
+
+    def _run_filter(self, path, log_filter, fields, options):
+        args = [
+            path,
+            str(log_filter.since or 0),
+            str(log_filter.until or 0),
+            str(log_filter.min_level or 0),
+            json.dumps(sorted(log_filter.agents or [])),
+            json.dumps(fields),
+            json.dumps(options),
+        ]
+        compressor = "zstd -1 -c" if REMOTE_COMPRESSION == "zstd" else "gzip -1 -c"
+        command = (
+            f"{REMOTE_PYTHON} -c {shlex.quote(REMOTE_FILTER_SCRIPT)} "
+            f"{' '.join(shlex.quote(arg) for arg in args)} | {compressor}"
+        )
+        stdout, stderr = self.pool.exec_command(command)
+        return RemoteCommandStream(stdout, stderr, command)
+
+    def checksum(self, path):
+        """sha256 calculado en el manager, o None si no hay sha256sum"""
+        stdout, _ = self.pool.exec_command(f"sha256sum {shlex.quote(path)}")
+        output = stdout.read().decode('utf-8', errors='ignore')
+        if stdout.channel.recv_exit_status() != 0 or not output:
+            return None
+        return output.split()[0]
+
+    def close(self):
+        if self.sftp is not None:
+            self.pool.release(self.sftp, broken=self.broken)
+            self.sftp = None
+
+
+# ===== Espejo local de archivos remotos =====
+
+REMOTE_MIRROR_DIR = os.getenv("REMOTE_MIRROR_DIR", os.path.expanduser("~/.cache/threat_hunter/mirror"))
+REMOTE_MIRROR_MAX_MB = int(os.getenv("REMOTE_MIRROR_MAX_MB", "2048"))  # 0 desactiva el espejo
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(SFTP_BUFFER_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArchiveMirror:
+    """Copia local de los archivos remotos, indexada por host, ruta, tamaño y mtime.
+
+    Los días cerrados se descargan una vez; del .json del día solo se baja lo
+    añadido desde la última copia. Los días cerrados se validan contra el
+    sha256 calculado en el manager y el espejo se recorta por LRU al superar
+    el tamaño máximo.
+    """
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root or REMOTE_MIRROR_DIR
+        self.max_bytes = max_bytes if max_bytes is not None else REMOTE_MIRROR_MAX_MB * 1024 * 1024
+        self.lock = threading.Lock()
+        self.entries = None
+
+    def _meta_path(self):
+        return os.path.join(self.root, "mirror.json")
+
+    def _load(self):
+        if self.entries is None:
+            try:
+                with open(self._meta_path(), encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+        return self.entries
+
+    def _save(self):
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = self._meta_path() + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self._meta_path())
+
+    def _download(self, remote, path, local_path, start):
+        """Copia el archivo remoto desde start (0 = completo) y devuelve los bytes leídos"""
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        target = local_path if start else local_path + ".part"
+        copied = 0
+        with remote.sftp.open(path, 'rb', bufsize=SFTP_BUFFER_SIZE) as remote_file, \
+                open(target, 'ab' if start else 'wb') as local_file:
+            if start:
+                local_file.truncate(start)
+                remote_file.seek(start)
+            remote_file.prefetch()
+            for chunk in iter(lambda: remote_file.read(SFTP_BUFFER_SIZE), b""):
+                local_file.write(chunk)
+                copied += len(chunk)
+        if not start:
+            os.replace(target, local_path)
+        return copied
+
+    def _evict(self, keep_key):
+        total = sum(entry["size"] for entry in self.entries.values())
+        for key, entry in sorted(self.entries.items(), key=lambda item: item[1]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep_key:
+                continue
+            try:
+                os.remove(entry["local"])
+            except OSError:
+                pass
+            total -= entry["size"]
+            del self.entries[key]
+            print(f"🧹 Evicted mirrored archive {entry['path']} ({entry['size']} bytes)")
+
+    def fetch(self, remote, path, stat):
+        """Devuelve la ruta local de una copia al día del archivo remoto"""
+        key = f"{remote.name}:{path}"
+        local_path = os.path.join(self.root, remote.name, path.lstrip("/"))
+        with self.lock:
+            entries = self._load()
+            entry = entries.get(key)
+            local_size = os.path.getsize(local_path) if os.path.exists(local_path) else -1
+
+            if entry and entry["size"] == stat["size"] and entry["mtime"] == stat["mtime"] and local_size == stat["size"]:
+                entry["last_access"] = time.time()
+                self._save()
+                return local_path
+
+            start = 0
+            if (entry and not path.endswith(".gz") and local_size == entry["size"]
+                    and stat["size"] > entry["size"]):
+                start = entry["size"]
+            copied = self._download(remote, path, local_path, start)
+            print(f"⬇️ Mirrored {copied} bytes of {path} ({'delta' if start else 'full'})")
+
+            # Solo los días cerrados (.gz) se validan: no vuelven a cambiar y el
+            # sha256 remoto del .json del día obligaría a releerlo entero
+            expected = remote.checksum(path) if path.endswith(".gz") else None
+            if expected and expected != file_sha256(local_path):
+                os.remove(local_path)
+                entries.pop(key, None)
+                self._save()
+                raise IOError(f"Checksum mismatch for mirrored archive {path}")
+
+            entries[key] = {
+                "host": remote.name,
+                "path": path,
+                "local": local_path,
+                "size": os.path.getsize(local_path),
+                "mtime": stat["mtime"],
+                "sha256": expected,
+                "last_access": time.time(),
+            }
+            self._evict(key)
+            self._save()
+            return local_path
+
+
+archive_mirror = ArchiveMirror()
+
+
+class MirroredArchiveSource:
+    """Fuente remota que lee siempre de la copia local del espejo"""
+
+    def __init__(self, remote):
+        self.remote = remote
+        self.name = remote.name
+        self.located = {}
+
+    def locate(self, day):
+        located = self.remote.locate(day)
+        if located:
+            self.located[located[0]] = located[1]
+        return located
+
+    def open(self, path, offset=0):
+        stat = self.located.get(path)
+        if stat is None:
+            st = self.remote.sftp.stat(path)
+            stat = {"size": st.st_size, "mtime": int(st.st_mtime or 0), "inode": 0}
+        return open_local_archive(archive_mirror.fetch(self.remote, path, stat), offset)
+
+    @property
+    def filters_remotely(self):
+        return self.remote.filters_remotely
+
+    def open_events(self, path, log_filter=None, start=0, end=None):
+        if self.filters_remotely:
+            return self.remote.open_events(path, log_filter, start, end)
+        return open_archive_slice(self, path, start, end)
+
+    def open_index(self, path, start, stat):
+        if self.filters_remotely:
+            return self.remote.open_index(path, start, stat)
+        return open_index_feed(self, path, start, stat)
+
+    def close(self):
+        self.remote.close()
+
+
+def connect_remote_source(host, user, ssh_private_key):
+    remote = RemoteArchiveSource.connect(host, user, ssh_private_key)
+    if REMOTE_MIRROR_MAX_MB > 0:
+        return MirroredArchiveSource(remote)
+    return remote
+
+
+def open_archive_source():
+    """Abre la fuente de archivos configurada (remota si hay remote_host)"""
+    if remote_host:
+        return connect_remote_source(remote_host, ssh_username, ssh_private_key)
+    return LocalArchiveSource()
+
+
+def iter_logs_from_source(source, past_days, log_filter=None, records=False, lazy_full_log=False):
+    """Generador de logs de una fuente, un día cada vez y sin acumular en memoria.
+
+    Si log_filter tiene since se leen los días de la ventana (past_days se
+    ignora) y cada archivo solo entre los puntos de búsqueda de su índice.
+    Con records se entregan EventRecord; lazy_full_log (solo archivos
+    locales leídos enteros) deja full_log en el disco.
+    """
+    windowed = log_filter is not None and log_filter.since is not None
+    days = iter_window_days(log_filter.since, log_filter.until) if windowed else iter_archive_days(past_days)
+    for day in days:
+        located = source.locate(day)
+        if not located:
+            if not windowed:
+                json_path, gz_path = archive_day_paths(day)
+                print(f"⚠️ Log file missing or empty ({source.name}): {json_path} / {gz_path}")
+            continue
+
+        file_path, stat = located
+        start, end = 0, None
+        if windowed:
+            day_index = archive_index.update(source, day)
+            bounds = day_index.seek(log_filter.since, log_filter.until) if day_index else (0, 0, 0, None)
+            if bounds is None:
+                continue
+            start, end = bounds[2:]
+        make_record = None
+        if records:
+            lazy = lazy_full_log and isinstance(source, LocalArchiveSource)
+            make_record = event_record_factory(file_path if lazy else None)
+        try:
+            with source.open_events(file_path, log_filter, start, end) as f:
+                yield from parse_log_lines(f, file_path, log_filter, make_record, start)
+        except Exception as e:
+            print(f"⚠️ Error reading {file_path}: {e}")
+
+
+def archive_may_rotate(path):
+    """True si el archivo local puede comprimirse o desaparecer al rotar.
+
+    El .json de hoy (y el de ayer, hasta que termine la rotación de
+    medianoche) pasa a .json.gz; el .json de un día anterior ya no cambia.
+    """
+    return path.endswith(".gz") or path in {archive_day_paths(day)[0] for day in iter_archive_days(2)}
+
+
+def event_record_factory(path=None):
+    """make_record para parse_log_lines; con path, full_log se queda en el archivo.
+
+    Solo si el archivo no puede rotar: en un .json.gz cada lectura hacia
+    atrás descomprime desde el principio del archivo, y el .json del día
+    desaparece al comprimirse. En los demás casos full_log va en memoria.
+    """
+    if path is None or archive_may_rotate(path):
+        return lambda log, offset: EventRecord.from_log(log)
+    return lambda log, offset: EventRecord.from_log(log, path, offset)
+
+
+def iter_logs_from_remote(host, user, ssh_private_key, past_days, log_filter=None, records=False):
+    """Generador de logs remotos: la conexión SSH se cierra al agotarlo o cerrarlo"""
+    try:
+        source = connect_remote_source(host, user, ssh_private_key)
+    except Exception as e:
+        print(f"❌ Remote connection failed: {e}")
+        return
+
+    try:
+        yield from iter_logs_from_source(source, past_days, log_filter, records)
+    finally:
+        source.close()
+
+
+def iter_logs_from_local(past_days, log_filter=None, records=False, lazy_full_log=False):
+    return iter_logs_from_source(LocalArchiveSource(), past_days, log_filter, records, lazy_full_log)
+
+
+def iter_logs_from_days(past_days=7, log_filter=None, records=False, lazy_full_log=False):
+    """Punto de entrada perezoso: los consumidores toman solo lo que necesitan"""
+    if remote_host:
+        return iter_logs_from_remote(remote_host, ssh_username, ssh_private_key, past_days, log_filter, records)
+    return iter_logs_from_local(past_days, log_filter, records, lazy_full_log)
+
+
+def load_logs_from_remote(host, user, ssh_private_key, past_days, limit=None, log_filter=None):
+    return list(islice(iter_logs_from_remote(host, user, ssh_private_key, past_days, log_filter, records=True), limit))
+
+
+def load_logs_from_days(past_days=7, limit=None, log_filter=None, lazy_full_log=True):
+    """Carga los eventos del rango como EventRecord.
+
+    Las filas se eligen en el índice columnar (ventana, nivel, agentes y
+    reglas de log_filter) y solo se decodifican esas líneas, en paralelo
+    para varios días locales. Con limit se leen los días en orden sin pasar
+    por el índice. Con lazy_full_log los eventos de archivos locales que ya
+    no rotan no guardan full_log: se lee del archivo al pedirlo.
+    """
+    with LOG_LOAD_SECONDS.time():
+        if limit is None or (log_filter is not None and log_filter.indexed):
+            return list(islice(iter_indexed_logs(past_days, log_filter, records=True, lazy_full_log=lazy_full_log), limit))
+        return list(islice(iter_logs_from_days(past_days, log_filter, records=True, lazy_full_log=lazy_full_log), limit))
+
+
+# ===== Índice columnar de archivos =====
+
+INDEX_DIR = os.getenv("WAZUH_INDEX_DIR", os.path.expanduser("~/.cache/threat_hunter/index"))
+INDEX_VERSION = 4
+INDEX_BLOCK_ROWS = 4096  # Filas por punto de búsqueda (offset + rango de timestamps)
+# Columnas de texto codificadas con diccionario (código -> vocabulario en meta.json)
+INDEX_STRING_COLUMNS = ("rule_id", "agent", "srcip", "decoder", "location")
+INDEX_COLUMN_TYPES = {
+    "timestamp": "d",
+    "rule_level": "B",
+    "offset": "Q",
+    "template": "I",  # Plantilla del evento en templates.json (posición + 1; 0 = sin plantilla)
+    **{name: "I" for name in INDEX_STRING_COLUMNS},
+}
+# Agregados por día: conteo exacto por código de diccionario, top-K aproximado para IPs
+STATS_EXACT_COLUMNS = ("rule_id", "agent")
+STATS_HEAVY_HITTERS = int(os.getenv("STATS_HEAVY_HITTERS", "1000"))  # IPs de origen seguidas por día
+STATS_TOP_K = int(os.getenv("STATS_TOP_K", "10"))
+
+
+def parse_timestamp(value):
+    """Convierte un timestamp de Wazuh a segundos epoch (0.0 si no es válido)"""
+    if not value:
+        return 0.0
+    # Camino rápido para el formato fijo de Wazuh: 2024-05-01T10:20:30.123+0000
+    if len(value) == 28 and value[10] == 'T' and value[19] == '.':
+        try:
+            offset = int(value[24:26]) * 3600 + int(value[26:28]) * 60
+            if value[23] == '-':
+                offset = -offset
+            return calendar.timegm((
+                int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                int(value[11:13]), int(value[14:16]), int(value[17:19]),
+            )) + int(value[20:23]) / 1000 - offset
+        except ValueError:
+            pass
+    try:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f%z").timestamp()
+    except ValueError:
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            return 0.0
+
+
+def extract_index_row(log):
+    """Extrae los campos indexados de un evento ya decodificado"""
+    rule = log.get('rule') or {}
+    try:
+        level = min(max(int(rule.get('level') or 0), 0), 255)
+    except (TypeError, ValueError):
+        level = 0
+    return {
+        "timestamp": parse_timestamp(log.get('timestamp')),
+        "rule_level": level,
+        "rule_id": str(rule.get('id', '')),
+        "agent": (log.get('agent') or {}).get('name', ''),
+        "srcip": (log.get('data') or {}).get('srcip', ''),
+        "decoder": (log.get('decoder') or {}).get('name', ''),
+        "location": log.get('location', ''),
+    }
+
+
+class SpaceSaving:
+    """Elementos más frecuentes con memoria acotada (space-saving fusionable).
+
+    counts guarda [estimación, error] por elemento: la estimación nunca es
+    menor que el conteo real y lo supera como mucho en error. Cualquier
+    elemento no seguido aparece como mucho floor veces.
+    """
+
+    def __init__(self, capacity=STATS_HEAVY_HITTERS, counts=None, floor=0):
+        self.capacity = capacity
+        self.counts = {item: list(entry) for item, entry in (counts or {}).items()}
+        self.floor = floor
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["capacity"], data["counts"], data["floor"])
+
+    def to_dict(self):
+        return {"capacity": self.capacity, "counts": self.counts, "floor": self.floor}
+
+    def update(self, counter):
+        """Añade conteos exactos (p. ej. un Counter de un lote)"""
+        return self.merge(SpaceSaving(len(counter), {item: (count, 0) for item, count in counter.items()}))
+
+    def merge(self, other):
+        for item, entry in self.counts.items():
+            if item not in other.counts:
+                entry[0] += other.floor
+                entry[1] += other.floor
+        for item, (count, error) in other.counts.items():
+            entry = self.counts.get(item)
+            if entry is None:
+                self.counts[item] = [count + self.floor, error + self.floor]
+            else:
+                entry[0] += count
+                entry[1] += error
+        self.floor += other.floor
+        if len(self.counts) > self.capacity:
+            ranked = sorted(self.counts.items(), key=lambda item: item[1][0], reverse=True)
+            self.floor = ranked[self.capacity][1][0]
+            self.counts = dict(ranked[:self.capacity])
+        return self
+
+    def top(self, k=STATS_TOP_K):
+        return sorted(self.counts.items(), key=lambda item: item[1][0], reverse=True)[:k]
+
+
+def empty_day_stats():
+    return {
+        "first": 0.0,
+        "last": 0.0,
+        "hours": [0] * 24,
+        "levels": {},
+        "counts": {name: [] for name in STATS_EXACT_COLUMNS},
+        "srcip": SpaceSaving().to_dict(),
+    }
+
+
+def accumulate_day_stats(stats, columns, vocab):
+    """Suma a los agregados de un día (ver empty_day_stats) las filas de columns"""
+    timestamps = [ts for ts in columns["timestamp"] if ts]
+    if timestamps:
+        first, last = min(timestamps), max(timestamps)
+        stats["first"] = min(stats["first"], first) if stats["first"] else first
+        stats["last"] = max(stats["last"], last)
+    hours = stats["hours"]
+    hour_of = {}  # Hora local por bloque de 3600 s: localtime una vez por hora
+    for ts in timestamps:
+        block = int(ts // 3600)
+        hour = hour_of.get(block)
+        if hour is None:
+            hour = hour_of[block] = time.localtime(block * 3600).tm_hour
+        hours[hour] += 1
+    levels = stats["levels"]
+    for level, count in Counter(columns["rule_level"]).items():
+        levels[str(level)] = levels.get(str(level), 0) + count
+    for name in STATS_EXACT_COLUMNS:
+        counts = stats["counts"][name]
+        counts.extend([0] * (len(vocab[name]) - len(counts)))
+        for code, count in Counter(columns[name]).items():
+            counts[code] += count
+    srcips = Counter(vocab["srcip"][code] for code in columns["srcip"])
+    srcips.pop('', None)
+    if srcips:
+        stats["srcip"] = SpaceSaving.from_dict(stats["srcip"]).update(srcips).to_dict()
+
+
+class DayIndex:
+    """Índice columnar de un día de archivo: un fichero binario por columna.
+
+    meta.json guarda el archivo de origen, su stat, los bytes ya indexados y
+    el vocabulario de las columnas de texto y los agregados del día, que se
+    actualizan con cada lote indexado. templates.json guarda el minero de
+    plantillas del día, que ve cada evento al indexarlo. Las columnas solo se
+    leen cuando se piden.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = self._read_meta()
+
+    @property
+    def rows(self):
+        return self.meta["rows"] if self.meta else 0
+
+    def _read_meta(self):
+        try:
+            with open(os.path.join(self.path, "meta.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get("version") != INDEX_VERSION:
+            return None
+        return meta
+
+    def _write_meta(self):
+        tmp_path = os.path.join(self.path, "meta.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, os.path.join(self.path, "meta.json"))
+
+    def is_fresh(self, path, stat):
+        if not self.meta or self.meta["source"] != path:
+            return False
+        old = self.meta["stat"]
+        if old == stat:
+            return True
+        # .json ya indexado hasta su tamaño actual (creció mientras se indexaba)
+        return bool(old) and not path.endswith(".gz") and stat["inode"] == old["inode"] \
+            and stat["size"] == self.meta["consumed"]
+
+    def can_append(self, path, stat):
+        """Solo un .json que ha crecido (mismo inode) admite añadir al final"""
+        if not self.meta or self.meta["source"] != path or path.endswith(".gz"):
+            return False
+        old = self.meta["stat"]
+        return stat["inode"] == old["inode"] and stat["size"] >= old["size"] and stat["size"] > self.meta["consumed"]
+
+    def reset(self, path):
+        os.makedirs(self.path, exist_ok=True)
+        for name in INDEX_COLUMN_TYPES:
+            open(os.path.join(self.path, f"{name}.bin"), "wb").close()
+        if os.path.exists(os.path.join(self.path, "templates.json")):
+            os.remove(os.path.join(self.path, "templates.json"))
+        self.meta = {
+            "version": INDEX_VERSION,
+            "source": path,
+            "stat": None,
+            "consumed": 0,
+            "rows": 0,
+            "parse_errors": 0,
+            "vocab": {name: [] for name in INDEX_STRING_COLUMNS},
+            "stats": empty_day_stats(),
+            "blocks": [],  # [primera fila, offset, timestamp mínimo, timestamp máximo]
+        }
+
+    def load_miner(self):
+        """Minero de plantillas del día (vacío si aún no hay)"""
+        try:
+            with open(os.path.join(self.path, "templates.json"), encoding="utf-8") as f:
+                return LogTemplateMiner.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return LogTemplateMiner()
+
+    def _write_miner(self, miner):
+        tmp_path = os.path.join(self.path, "templates.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(miner.to_dict(), f)
+        os.replace(tmp_path, os.path.join(self.path, "templates.json"))
+
+    def _update_stats(self, columns):
+        """Suma un lote recién indexado a los agregados del día"""
+        accumulate_day_stats(self.meta["stats"], columns, self.meta["vocab"])
+
+    def _update_blocks(self, columns, first_row):
+        """Puntos de búsqueda: un bloque cada INDEX_BLOCK_ROWS filas con su
+        primer offset y el rango de timestamps válidos"""
+        blocks = self.meta["blocks"]
+        timestamps = columns["timestamp"]
+        i = 0
+        while i < len(timestamps):
+            row = first_row + i
+            if row % INDEX_BLOCK_ROWS == 0:
+                blocks.append([row, columns["offset"][i], None, None])
+            end = min(len(timestamps), i + INDEX_BLOCK_ROWS - row % INDEX_BLOCK_ROWS)
+            valid = [ts for ts in timestamps[i:end] if ts]
+            if valid:
+                block = blocks[-1]
+                block[2] = min(valid) if block[2] is None else min(block[2], min(valid))
+                block[3] = max(valid) if block[3] is None else max(block[3], max(valid))
+            i = end
+
+    def seek(self, since=None, until=None):
+        """(fila inicial, fila final, offset inicial, offset final) de la parte
+        del archivo que puede contener eventos de [since, until); None si no hay.
+
+        El archivo está casi ordenado en el tiempo: se empieza en el primer
+        bloque cuyo máximo llega a since y se descartan los bloques finales
+        cuyo mínimo ya es >= until. offset final None = hasta el final.
+        """
+        blocks = self.meta.get("blocks") or []
+        if not blocks:
+            return (0, self.rows, 0, None) if self.rows else None
+        start = 0
+        if since:
+            start = next((i for i, block in enumerate(blocks) if block[3] is not None and block[3] >= since), len(blocks))
+        end = len(blocks)
+        if until:
+            while end > start and (blocks[end - 1][2] is None or blocks[end - 1][2] >= until):
+                end -= 1
+        if start >= end:
+            return None
+        if end < len(blocks):
+            return blocks[start][0], blocks[end][0], blocks[start][1], blocks[end][1]
+        return blocks[start][0], self.rows, blocks[start][1], None
+
+    def count_between(self, since=None, until=None):
+        """Eventos del día con timestamp en [since, until), leyendo solo los bloques candidatos"""
+        if not since and not until:
+            return self.rows
+        bounds = self.seek(since, until)
+        if bounds is None:
+            return 0
+        first_row, last_row = bounds[:2]
+        since, until = since or 0.0, until or float("inf")
+        timestamps = self.column("timestamp")
+        return sum(1 for i in range(first_row, last_row) if since <= timestamps[i] < until)
+
+    def append_from(self, feed, stat):
+        """Indexa los eventos de feed (IndexFeed o RemoteIndexFeed), que empieza
+        en meta['consumed'], y guarda hasta dónde ha llegado la lectura"""
+        columns = {name: array(code) for name, code in INDEX_COLUMN_TYPES.items()}
+        vocab = self.meta["vocab"]
+        codes = {name: {value: i for i, value in enumerate(vocab[name])} for name in INDEX_STRING_COLUMNS}
+        parse_errors = 0
+        miner = self.load_miner()
+        positions = {template: i for i, template in enumerate(miner.templates)}
+
+        for line_start, log in feed:
+            try:
+                if log is None:
+                    raise ValueError("invalid JSON")
+                row = extract_index_row(log)
+            except ValueError:
+                parse_errors += 1
+                continue
+            template = miner.add(log)
+            columns["timestamp"].append(row["timestamp"])
+            columns["rule_level"].append(row["rule_level"])
+            columns["offset"].append(line_start)
+            columns["template"].append(0 if template is None else positions.setdefault(template, len(positions)) + 1)
+            for name in INDEX_STRING_COLUMNS:
+                value = str(row[name] or '')
+                code = codes[name].get(value)
+                if code is None:
+                    code = codes[name][value] = len(vocab[name])
+                    vocab[name].append(value)
+                columns[name].append(code)
+
+        rows = self.meta["rows"]
+        for name, values in columns.items():
+            with open(os.path.join(self.path, f"{name}.bin"), "r+b") as col_file:
+                # Descarta restos de una escritura interrumpida
+                col_file.truncate(rows * values.itemsize)
+                col_file.seek(0, os.SEEK_END)
+                values.tofile(col_file)
+
+        if columns["timestamp"]:
+            self._write_miner(miner)
+        self._update_stats(columns)
+        self._update_blocks(columns, rows)
+        self.meta["rows"] = rows + len(columns["timestamp"])
+        self.meta["consumed"] = feed.consumed
+        self.meta["parse_errors"] += parse_errors
+        self.meta["stat"] = stat
+        self._write_meta()
+        return len(columns["timestamp"])
+
+    def column(self, name):
+        """Lee una columna completa como array (códigos para las de texto)"""
+        values = array(INDEX_COLUMN_TYPES[name])
+        if not self.rows:
+            return values
+        with open(os.path.join(self.path, f"{name}.bin"), "rb") as col_file:
+            values.fromfile(col_file, self.rows)
+        return values
+
+    def values(self, name):
+        """Lee una columna decodificando el diccionario si es de texto"""
+        values = self.column(name)
+        if name in INDEX_STRING_COLUMNS:
+            vocab = self.meta["vocab"][name]
+            return [vocab[code] for code in values]
+        return values
+
+
+class ArchiveIndex:
+    """Índice persistente de archivos de Wazuh, una entrada por fuente y día"""
+
+    def __init__(self, root=None):
+        self.root = root or INDEX_DIR
+        # La recarga, /stat y el seguimiento indexan desde hilos distintos
+        self.lock = threading.RLock()
+
+    def day_index(self, source_name, day):
+        path = os.path.join(self.root, source_name, str(day.year), day.strftime("%b"), f"ossec-archive-{day.strftime('%d')}")
+        return DayIndex(path)
+
+    def update(self, source, day):
+        """Devuelve el índice del día, indexando solo lo que aún no lo está"""
+        with self.lock:
+            return self._update(source, day)
+
+    def _update(self, source, day):
+        located = source.locate(day)
+        if not located:
+            return None
+        path, stat = located
+        day_index = self.day_index(source.name, day)
+        if day_index.is_fresh(path, stat):
+            return day_index
+
+        if not day_index.can_append(path, stat):
+            day_index.reset(path)
+        start = day_index.meta["consumed"]
+        errors = day_index.meta["parse_errors"]
+        started = time.perf_counter()
+        try:
+            with source.open_index(path, start, stat) as feed:
+                added = day_index.append_from(feed, stat)
+            if added:
+                print(f"🗂️ Indexed {added} new events from {path} ({day_index.rows} total)")
+        except Exception as e:
+            print(f"⚠️ Error indexing {path}: {e}")
+            return None
+        ARCHIVE_READ_SECONDS.observe(time.perf_counter() - started)
+        ARCHIVE_READ_BYTES.observe(day_index.meta["consumed"] - start)
+        LOG_LINES_PARSED.inc(added)
+        LOG_PARSE_ERRORS.inc(day_index.meta["parse_errors"] - errors)
+        return day_index
+
+
+archive_index = ArchiveIndex()
+
+
+def iter_index_days(past_days, source=None, since=None, until=None):
+    """Genera el índice de cada día del rango, poniéndolo al día si hace falta.
+
+    Con since se recorren los días de la ventana [since, until). Sin source
+    se abre (y se cierra al terminar) la fuente configurada.
+    """
+    if source is None:
+        try:
+            source = open_archive_source()
+        except Exception as e:
+            print(f"❌ Remote connection failed: {e}")
+            return
+        try:
+            yield from iter_index_days(past_days, source, since, until)
+        finally:
+            source.close()
+        return
+
+    days = list(iter_window_days(since, until) if since is not None else iter_archive_days(past_days))
+    with archive_index.lock:
+        warm_index_parallel(source, days)
+    for day in days:
+        day_index = archive_index.update(source, day)
+        if day_index:
+            yield day_index
+
+
+def select_index_rows(day_index, log_filter):
+    """Filas del día que pueden cumplir log_filter según las columnas del índice (None = todas).
+
+    Ventana, nivel, agentes y reglas se resuelven sin decodificar JSON; los
+    grupos no están indexados y se comprueban al decodificar la línea.
+    """
+    selected = None
+    if log_filter.since is not None or log_filter.until is not None:
+        # Solo las filas de los bloques que pueden caer en la ventana
+        bounds = day_index.seek(log_filter.since, log_filter.until)
+        if bounds is None:
+            return []
+        timestamps = day_index.column("timestamp")
+        selected = [i for i in range(bounds[0], bounds[1]) if log_filter._in_window(timestamps[i])]
+    if log_filter.min_level is not None or log_filter.max_level is not None:
+        levels = day_index.column("rule_level")
+        allowed = [log_filter._level_in_range(value) for value in range(256)]
+        rows = range(day_index.rows) if selected is None else selected
+        selected = [i for i in rows if allowed[levels[i]]]
+    for name, wanted in (("agent", log_filter.agents), ("rule_id", log_filter.rule_ids)):
+        if not wanted:
+            continue
+        codes = {code for code, value in enumerate(day_index.meta["vocab"][name]) if value in wanted}
+        if not codes:
+            return []
+        column = day_index.column(name)
+        rows = range(day_index.rows) if selected is None else selected
+        selected = [i for i in rows if column[i] in codes]
+    return selected
+
+
+def index_read(day_index, rows):
+    """(ruta, offset inicial, offset final, offsets) para leer las filas indicadas
+    (en orden) de un día indexado; None si no hay filas.
+
+    Con filas contiguas basta con leer el tramo (offsets None); si no, las
+    líneas que no están en offsets se saltan sin decodificar.
+    """
+    if not rows:
+        return None
+    offsets = day_index.column("offset")
+    first, last = rows[0], rows[-1]
+    end = offsets[last + 1] if last + 1 < day_index.rows else None
+    wanted = None if last - first + 1 == len(rows) else {offsets[i] for i in rows}
+    return day_index.meta["source"], offsets[first], end, wanted
+
+
+def iter_index_read(source, read, log_filter=None, make_record=None):
+    path, start, end, offsets = read
+    if source.filters_remotely:
+        # El manager aplica log_filter en [start, end): salen las mismas filas
+        # que eligió el índice, ya proyectadas, sin offsets de línea
+        offsets = None
+    with source.open_events(path, log_filter, start, end) as f:
+        yield from parse_log_lines(f, path, log_filter, make_record, start, offsets)
+
+
+def share_rows(counts, total):
+    """Reparte total filas entre días con counts filas disponibles: a partes
+    iguales, y lo que no usan los días con menos filas pasa al resto"""
+    quotas = [0] * len(counts)
+    remaining = total
+    order = sorted(range(len(counts)), key=counts.__getitem__)
+    for position, i in enumerate(order):
+        quotas[i] = min(counts[i], remaining // (len(order) - position))
+        remaining -= quotas[i]
+    return quotas
+
+
+def iter_indexed_logs(past_days, log_filter=None, records=False, lazy_full_log=False, max_rows=None):
+    """Eventos del rango que cumplen log_filter, elegidos en las columnas del índice.
+
+    Solo se decodifican las líneas seleccionadas; con archivos locales de
+    varios días la decodificación se reparte en el pool de procesos. Con
+    max_rows las filas se reparten entre los días del rango y de cada día se
+    toman las más recientes. Los días se entregan del más antiguo al más
+    reciente.
+    """
+    log_filter = log_filter or LogFilter()
+    try:
+        source = open_archive_source()
+    except Exception as e:
+        print(f"❌ Remote connection failed: {e}")
+        return
+
+    try:
+        selections = []
+        for day_index in iter_index_days(past_days, source, log_filter.since, log_filter.until):
+            rows = select_index_rows(day_index, log_filter)
+            selections.append((day_index, range(day_index.rows) if rows is None else rows))
+        if max_rows is not None:
+            quotas = share_rows([len(rows) for _, rows in selections], max_rows)
+            selections = [(day_index, rows[len(rows) - quota:]) for (day_index, rows), quota in zip(selections, quotas)]
+        reads = [read for read in (index_read(day_index, rows) for day_index, rows in reversed(selections)) if read]
+        if isinstance(source, LocalArchiveSource) and len(reads) > 1 and LOG_LOADER_WORKERS > 1:
+            yield from iter_logs_parallel(reads, log_filter=log_filter, records=records, lazy_full_log=lazy_full_log)
+            return
+        for read in reads:
+            make_record = None
+            if records:
+                lazy = lazy_full_log and isinstance(source, LocalArchiveSource)
+                make_record = event_record_factory(read[0] if lazy else None)
+            try:
+                yield from iter_index_read(source, read, log_filter, make_record)
+            except Exception as e:
+                print(f"⚠️ Error reading {read[0]}: {e}")
+    finally:
+        source.close()
+
+
+def count_indexed_logs(past_days=7, since=None, until=None):
+    return sum(day_index.count_between(since, until) for day_index in iter_index_days(past_days))
+
+
+# ===== Decodificación paralela por días =====
+
+LOG_LOADER_WORKERS = int(os.getenv("LOG_LOADER_WORKERS", str(os.cpu_count() or 1)))
+LOG_LOADER_QUEUE_SIZE = int(os.getenv("LOG_LOADER_QUEUE_SIZE", "8"))  # Lotes en vuelo por día
+LOG_LOADER_BATCH_SIZE = 1000
+# Los hijos no se crean con fork: el proceso tiene hilos (event loop, seguimiento,
+# SFTP) y un fork podría heredar un lock tomado. forkserver arranca cada hijo
+# desde un proceso limpio, sin hilos; spawn donde no existe (Windows, macOS antiguo)
+LOG_LOADER_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+
+def _put_batch(out_queue, batch, stop):
+    """Espera hueco en la cola acotada; False si el consumidor ya no quiere más"""
+    while not stop.is_set():
+        try:
+            out_queue.put(batch, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _decode_day_worker(read, out_queue, stop, batch_size, log_filter=None, records=False, lazy_full_log=False):
+    """Proceso hijo: decodifica las filas de un día y las envía por lotes a su cola acotada.
+
+    read es (ruta, offset inicial, offset final, offsets) como en index_read.
+    Con records los lotes son de EventRecord, bastante más baratos de
+    serializar que los dicts. Devuelve las métricas de lectura del hijo (ver
+    read_metrics) para el proceso principal.
+    """
+    path = read[0]
+    before = read_metrics()
+    make_record = event_record_factory(path if lazy_full_log else None) if records else None
+    batch = []
+    try:
+        for log in iter_index_read(LocalArchiveSource(), read, log_filter, make_record):
+            batch.append(log)
+            if len(batch) >= batch_size:
+                if not _put_batch(out_queue, batch, stop):
+                    break
+                batch = []
+    except Exception as e:
+        print(f"⚠️ Error reading {path}: {e}")
+    finally:
+        if batch:
+            _put_batch(out_queue, batch, stop)
+        _put_batch(out_queue, None, stop)
+    return read_metrics(before)
+
+
+def _index_day_worker(index_root, day):
+    """Proceso hijo: pone al día el índice columnar de un día local; devuelve
+    sus métricas de lectura"""
+    before = read_metrics()
+    ArchiveIndex(index_root).update(LocalArchiveSource(), day)
+    return read_metrics(before)
+
+
+def read_metrics(before=None):
+    """(líneas, errores, segundos, bytes, lecturas) de las métricas de lectura;
+    con before, lo acumulado desde entonces (en un proceso hijo)"""
+    current = (
+        LOG_LINES_PARSED.value, LOG_PARSE_ERRORS.value,
+        ARCHIVE_READ_SECONDS.sum, ARCHIVE_READ_BYTES.sum, ARCHIVE_READ_SECONDS.count,
+    )
+    if before is None:
+        return current
+    return tuple(now - then for now, then in zip(current, before))
+
+
+def merge_read_metrics(delta):
+    """Suma al proceso principal las métricas de lectura de un hijo"""
+    parsed, errors, seconds, read_bytes, reads = delta
+    LOG_LINES_PARSED.inc(parsed)
+    LOG_PARSE_ERRORS.inc(errors)
+    if reads:
+        # Un hijo lee un solo día: una observación con el total
+        ARCHIVE_READ_SECONDS.observe(seconds)
+        ARCHIVE_READ_BYTES.observe(read_bytes)
+
+
+def iter_logs_parallel(reads, workers=None, queue_size=None, log_filter=None, records=False, lazy_full_log=False):
+    """Decodifica las lecturas de varios días en un pool de procesos y las entrega en orden.
+
+    reads son lecturas de index_read en orden temporal (del día más antiguo
+    al más reciente). Cada día tiene su propia cola acotada, así la memoria
+    no depende del rango; se envían al pool en ese mismo orden, de modo que
+    el día que se está leyendo siempre tiene un proceso asignado. Si el
+    consumidor deja de leer, los procesos se detienen en su siguiente lote.
+    """
+    workers = workers or LOG_LOADER_WORKERS
+    queue_size = queue_size or LOG_LOADER_QUEUE_SIZE
+    if not reads:
+        return
+
+    with LOG_LOADER_CONTEXT.Manager() as manager, \
+            ProcessPoolExecutor(max_workers=min(workers, len(reads)), mp_context=LOG_LOADER_CONTEXT) as pool:
+        stop = manager.Event()
+        queues = []
+        workers_done = []
+        for read in reads:
+            out_queue = manager.Queue(maxsize=queue_size)
+            workers_done.append(pool.submit(
+                _decode_day_worker, read, out_queue, stop, LOG_LOADER_BATCH_SIZE, log_filter, records, lazy_full_log
+            ))
+            queues.append(out_queue)
+        try:
+            for out_queue in queues:
+                while True:
+                    batch = out_queue.get()
+                    if batch is None:
+                        break
+                    yield from batch
+        finally:
+            # También si el consumidor para antes: los hijos terminan su lote y devuelven sus métricas
+            stop.set()
+            for future in workers_done:
+                merge_read_metrics(future.result())
+
+
+def warm_index_parallel(source, days, workers=None):
+    """Indexa en paralelo los días locales (de la lista days) que no estén al día"""
+    workers = workers or LOG_LOADER_WORKERS
+    if not isinstance(source, LocalArchiveSource) or workers < 2:
+        return
+    pending = []
+    for day in days:
+        located = source.locate(day)
+        if located and not archive_index.day_index(source.name, day).is_fresh(*located):
+            pending.append(day)
+    if len(pending) < 2:
+        return
+    print(f"⚙️ Indexing {len(pending)} days with {min(workers, len(pending))} processes...")
+    with ProcessPoolExecutor(max_workers=min(workers, len(pending)), mp_context=LOG_LOADER_CONTEXT) as pool:
+        for delta in pool.map(_index_day_worker, [archive_index.root] * len(pending), pending):
+            merge_read_metrics(delta)
+
+
+# ===== Seguimiento (tail -F) del archivo del día =====
+
+# Segundos entre refrescos del contexto; 0 desactiva el seguimiento
+ARCHIVE_FOLLOW_INTERVAL = float(os.getenv("ARCHIVE_FOLLOW_INTERVAL", "0"))
+
+
+class ArchiveFollower:
+    """Sigue el archivo del día como tail -F.
+
+    Recuerda inode y offset por fichero para leer solo las líneas nuevas en
+    cada refresco, y detecta truncados, rotaciones y la compresión del día
+    cerrado a .json.gz (se continúa en el mismo offset descomprimido).
+    """
+
+    def __init__(self, max_events=CONTEXT_MAX_LOGS):
+        self.positions = {}  # ruta del .json -> {"day", "inode", "offset", "closed"}
+        self.recent = deque(maxlen=max_events)
+        self.lock = threading.Lock()  # refresh() y la lectura de recent
+
+    def _initial_offset(self, source, day, path):
+        """Arranca cerca del final usando los offsets del índice si existen"""
+        day_index = archive_index.day_index(source.name, day)
+        if not day_index.meta or day_index.meta["source"] != path:
+            return 0
+        offsets = day_index.column("offset")
+        if len(offsets) <= self.recent.maxlen:
+            return 0
+        return offsets[-self.recent.maxlen]
+
+    def _refresh_day(self, source, day):
+        json_path, gz_path = archive_day_paths(day)
+        located = source.locate(day)
+        if not located:
+            return 0
+        path, stat = located
+        state = self.positions.get(json_path)
+        closed = path == gz_path
+
+        if state and state["closed"]:
+            return 0
+        if closed:
+            # Día comprimido: el contenido es el mismo, se sigue desde el offset
+            offset = state["offset"] if state else 0
+        elif state is None:
+            offset = self._initial_offset(source, day, path)
+        elif stat["inode"] != state["inode"] or stat["size"] < state["offset"]:
+            print(f"🔁 Archive rotated or truncated, following from start: {path}")
+            offset = 0
+        else:
+            offset = state["offset"]
+            if stat["size"] == offset:
+                return 0
+
+        added = 0
+        with source.open(path, offset) as f:
+            for raw in f:
+                if not raw.endswith(b"\n") and not closed:
+                    break  # Línea todavía a medio escribir
+                offset += len(raw)
+                raw = raw.strip()
+                if not raw:
+                    continue
+                try:
+                    self.recent.append(EventRecord.from_log(decode_log(raw)))
+                    added += 1
+                except ValueError:
+                    print(f"⚠️ Skipping invalid JSON line in {path}")
+
+        self.positions[json_path] = {"day": day.date(), "inode": stat["inode"], "offset": offset, "closed": closed}
+        return added
+
+    def refresh(self, source):
+        """Lee lo añadido desde el último refresco; devuelve el número de eventos nuevos"""
+        today = datetime.now()
+        yesterday = today - timedelta(days=1)
+        added = 0
+        # Tras medianoche se terminan de leer las últimas líneas del día anterior
+        if archive_day_paths(yesterday)[0] in self.positions:
+            added += self._refresh_day(source, yesterday)
+        added += self._refresh_day(source, today)
+        self.positions = {
+            path: state for path, state in self.positions.items()
+            if state["day"] >= yesterday.date()
+        }
+        return added
+
+
+archive_follower = ArchiveFollower()
+
+
+def refresh_followed_context():
+    """Incorpora los eventos nuevos del archivo del día a todos los snapshots.
+
+    Las versiones nuevas del ranker y del minero se construyen sin bloquear
+    el registro; solo el cambio de snapshot toma su lock.
+    """
+    try:
+        source = open_archive_source()
+    except Exception as e:
+        print(f"❌ Remote connection failed: {e}")
+        return 0
+
+    # Un solo refresco a la vez: el hilo de seguimiento y las construcciones de contexto
+    with archive_follower.lock:
+        try:
+            added = archive_follower.refresh(source)
+        except Exception as e:
+            print(f"⚠️ Error following archive: {e}")
+            return 0
+        finally:
+            source.close()
+        if not added or not archive_follower.recent:
+            return added
+
+        recent = list(archive_follower.recent)
+        new_logs = recent[-added:]
+        for snapshot in context_registry.snapshots():
+            window = snapshot.days_range
+            if isinstance(window, LogWindow):
+                if not window.follows:
+                    continue  # Ventana cerrada: los eventos nuevos quedan fuera
+                log_filter = window.log_filter()
+                snapshot_logs = [log for log in new_logs if log_filter.matches(log)]
+                if not snapshot_logs:
+                    continue
+            else:
+                snapshot_logs = new_logs
+            # Versiones nuevas: las peticiones en curso siguen leyendo las publicadas
+            changes = {}
+            # Primero las plantillas, para que el ranker asocie los eventos nuevos a ellas
+            if snapshot.template_miner is not None:
+                changes["template_miner"] = snapshot.template_miner.copy().add_many(snapshot_logs)
+                embed_templates(changes["template_miner"])
+            if snapshot.event_ranker is None:
+                changes["wazuh_context"] = initialize_assistant_context(create_simple_context(recent))
+            else:
+                changes["event_ranker"] = snapshot.event_ranker.extend(snapshot_logs, changes.get("template_miner"))
+            # Versión nueva: las respuestas cacheadas no incluyen estos eventos
+            context_registry.replace(snapshot, snapshot.replace(**changes))
+    return added
+
+
+async def follow_archives_loop():
+    print(f"👀 Following today's archive every {ARCHIVE_FOLLOW_INTERVAL}s")
+    while True:
+        added = await asyncio.to_thread(refresh_followed_context)
+        if added:
+            print(f"🔄 Wazuh context refreshed with {added} new events")
+        await asyncio.sleep(ARCHIVE_FOLLOW_INTERVAL)
+
+
+# ===== Selección de logs por relevancia =====
+
+RANKING_POOL_SIZE = int(os.getenv("RANKING_POOL_SIZE", "20000"))  # Eventos candidatos por contexto
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+RANKING_RECENCY_HALF_LIFE = 6 * 3600  # Segundos en los que el peso por antigüedad se reduce a la mitad
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(r"[\w.:/-]+")
+
+
+def tokenize(text):
+    """Tokens en minúsculas; se quitan puntuaciones sueltas al final (p. ej. 'ssh2.')"""
+    return [token.strip(".:/-") for token in _TOKEN_RE.findall(text.lower()) if token.strip(".:/-")]
+
+
+def estimate_tokens(text):
+    """Aproximación barata de tokens de llama3 (~4 caracteres por token)"""
+    return len(text) // 4 + 1
+
+
+def format_log_line(i, log):
+    """Línea de contexto de un evento: cabecera con metadatos y full_log recortado"""
+    rule = log.get('rule') or {}
+    agent = (log.get('agent') or {}).get('name', '')
+    header = f"[{log.get('timestamp', '')[:19]}] {agent} nivel {rule.get('level', '?')} regla {rule.get('id', '?')}"
+    if rule.get('description'):
+        header += f" ({rule['description']})"
+    return f"Log {i}: {header}: {log.get('full_log', '')[:200]}..."
+
+
+class EventRanker:
+    """Índice invertido BM25 sobre full_log y la descripción de la regla.
+
+    Se construye una vez por contexto y admite añadir eventos nuevos; la
+    puntuación de cada pregunta se refuerza con el nivel de la regla y la
+    antigüedad del evento. Con un minero de plantillas cada evento queda
+    asociado a la posición de su plantilla, para combinar BM25 con la
+    similitud semántica y enviar un solo ejemplo de cada plantilla.
+
+    Una versión publicada no cambia: extend() devuelve otra que comparte las
+    listas y solo añade al final, y cada versión ve sus n_docs primeros
+    documentos. Así el coste de un refresco depende de los eventos nuevos.
+    """
+
+    def __init__(self, max_docs=RANKING_POOL_SIZE, miner=None):
+        self.max_docs = max_docs
+        self.miner = miner
+        self.n_docs = 0
+        self.total_length = 0
+        self.agents = ()  # Agentes con eventos en esta versión
+        self.docs = []
+        self.doc_templates = []  # Posición de la plantilla en el minero, o None
+        self.template_docs = {}  # posición de plantilla -> [doc_id]
+        self.agent_docs = {}  # agente -> [doc_id]
+        self.postings = {}  # token -> [(doc_id, tf)]
+        self.doc_lengths = []
+        self.timestamps = []
+        self.levels = []
+
+    def _index(self, log, template=None):
+        doc_id = self.n_docs
+        rule = log.get('rule') or {}
+        tokens = tokenize(f"{log.get('full_log', '')} {rule.get('description', '')}")
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, tf in counts.items():
+            self.postings.setdefault(token, []).append((doc_id, tf))
+        self.docs.append(log)
+        self.doc_templates.append(template)
+        if template is not None:
+            self.template_docs.setdefault(template, []).append(doc_id)
+        agent = (log.get('agent') or {}).get('name')
+        if agent:
+            self.agent_docs.setdefault(agent, []).append(doc_id)
+        self.doc_lengths.append(len(tokens))
+        self.total_length += len(tokens)
+        self.timestamps.append(parse_timestamp(log.get('timestamp')))
+        try:
+            self.levels.append(int(rule.get('level') or 0))
+        except (TypeError, ValueError):
+            self.levels.append(0)
+        self.n_docs = doc_id + 1
+
+    def add(self, logs):
+        """Añade eventos a esta versión; solo antes de publicarla"""
+        for log in logs:
+            if log.get('full_log'):
+                template = self.miner.match(log) if self.miner else None
+                self._index(log, None if template is None else template.position)
+        if self.n_docs > self.max_docs:
+            # La cuarta parte libre absorbe varios refrescos antes de compactar otra vez
+            self._compact(self.max_docs * 3 // 4)
+        if len(self.agents) != len(self.agent_docs):
+            self.agents = tuple(self.agent_docs)
+        return self
+
+    def extend(self, logs, miner=None):
+        """Versión nueva con logs añadidos, sin modificar esta"""
+        if len(self.docs) == self.n_docs:
+            other = EventRanker(self.max_docs, self.miner)
+            for name in ("docs", "doc_templates", "template_docs", "agent_docs", "postings",
+                         "doc_lengths", "timestamps", "levels", "n_docs", "total_length", "agents"):
+                setattr(other, name, getattr(self, name))
+        else:
+            # Otra versión ya añadió a estas listas: se copia hasta n_docs
+            other = self._select_docs(range(self.n_docs))
+        if miner is not None:
+            other.miner = miner
+        return other.add(logs)
+
+    def _compact(self, keep):
+        """Conserva los keep eventos más recientes en listas nuevas"""
+        newest = sorted(range(self.n_docs), key=self.timestamps.__getitem__)[-keep:]
+        compacted = self._select_docs(sorted(newest))
+        for name in ("docs", "doc_templates", "template_docs", "agent_docs", "postings",
+                     "doc_lengths", "timestamps", "levels", "n_docs", "total_length"):
+            setattr(self, name, getattr(compacted, name))
+        self.agents = tuple(self.agent_docs)
+
+    def _select_docs(self, doc_ids):
+        """Ranker nuevo con solo doc_ids (en orden), renumerados sin volver a tokenizar"""
+        other = EventRanker(self.max_docs, self.miner)
+        new_ids = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+        for name in ("docs", "doc_templates", "doc_lengths", "timestamps", "levels"):
+            values = getattr(self, name)
+            setattr(other, name, [values[doc_id] for doc_id in doc_ids])
+        other.n_docs = len(new_ids)
+        other.total_length = sum(other.doc_lengths)
+        for name in ("template_docs", "agent_docs"):
+            remapped = {}
+            for key, ids in getattr(self, name).items():
+                kept = [new_ids[doc_id] for doc_id in ids if doc_id in new_ids]
+                if kept:
+                    remapped[key] = kept
+            setattr(other, name, remapped)
+        for token, postings in self.postings.items():
+            kept = [(new_ids[doc_id], tf) for doc_id, tf in postings if doc_id in new_ids]
+            if kept:
+                other.postings[token] = kept
+        other.agents = tuple(other.agent_docs)
+        return other
+
+    def _visible(self, ids):
+        # Listas en orden creciente de doc_id: lo que añadió una versión posterior queda al final
+        return ids[:bisect_left(ids, self.n_docs)]
+
+    def _boost(self, doc_id, now):
+        level_boost = 1 + self.levels[doc_id] / 15
+        age = max(now - self.timestamps[doc_id], 0) if self.timestamps[doc_id] else RANKING_RECENCY_HALF_LIFE * 4
+        recency_boost = 1 + 0.5 ** (age / RANKING_RECENCY_HALF_LIFE)
+        return level_boost * recency_boost
+
+    def rank(self, query, semantic=None, agents=None):
+        """Devuelve los doc_id ordenados por relevancia para la pregunta.
+
+        semantic ({LogTemplate: similitud}) suma la similitud de la plantilla
+        de cada evento a su puntuación BM25 normalizada; agents limita el
+        resultado a los eventos de esos agentes.
+        """
+        n_docs = self.n_docs
+        if not n_docs:
+            return []
+        now = time.time()
+        avg_length = self.total_length / n_docs or 1
+        scores = {}
+        for token in set(tokenize(query)):
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            postings = postings[:bisect_left(postings, (n_docs,))]
+            if not postings:
+                continue
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[doc_id] / avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        if semantic:
+            top = max(scores.values(), default=0.0) or 1.0
+            scores = {doc_id: (1 - SEMANTIC_WEIGHT) * score / top for doc_id, score in scores.items()}
+            for template, similarity in semantic.items():
+                for doc_id in self._visible(self.template_docs.get(template.position, [])):
+                    scores[doc_id] = scores.get(doc_id, 0.0) + SEMANTIC_WEIGHT * similarity
+        candidates = range(n_docs)
+        if agents:
+            candidates = [doc_id for agent in agents for doc_id in self._visible(self.agent_docs.get(agent, []))]
+            scores = {doc_id: scores[doc_id] for doc_id in candidates if doc_id in scores}
+        if scores:
+            ranked = sorted(scores, key=lambda doc_id: scores[doc_id] * self._boost(doc_id, now), reverse=True)
+        else:
+            # Sin términos en común: los eventos más graves y recientes
+            ranked = sorted(candidates, key=lambda doc_id: self._boost(doc_id, now), reverse=True)
+        return ranked
+
+    def select(self, query, token_budget=CONTEXT_TOKEN_BUDGET, semantic=None, agents=None):
+        """Los eventos más relevantes que caben en el presupuesto de tokens"""
+        selected = []
+        seen = set()
+        used = 0
+        for doc_id in self.rank(query, semantic, agents):
+            # Un solo ejemplo por plantilla (mismo mensaje salvo variables, de cualquier agente)
+            log = self.docs[doc_id]
+            key = self.doc_templates[doc_id]
+            if key is None:
+                key = tuple(mask_variables(log.get('full_log', ''), log_agent(log)))
+            if key in seen:
+                continue
+            seen.add(key)
+            cost = estimate_tokens(format_log_line(len(selected) + 1, log))
+            if used + cost > token_budget:
+                if selected:
+                    break
+                continue
+            selected.append(log)
+            used += cost
+        return selected
+
+
+# ===== Agrupación de logs en plantillas (tipo Drain) =====
+
+TEMPLATE_MAX_CLUSTERS = int(os.getenv("TEMPLATE_MAX_CLUSTERS", "5000"))
+TEMPLATE_SIMILARITY = 0.5  # Fracción mínima de tokens iguales para unirse a una plantilla
+TEMPLATE_BUDGET_SHARE = 0.4  # Parte del presupuesto de tokens para las plantillas
+WILDCARD = "<*>"
+
+_VARIABLE_TOKEN_RE = re.compile(
+    r"^(\d+([.:]\d+)*|0x[0-9a-f]+|[0-9a-f]{8,}|\S*\[\d+\]:?|\S*=\S*\d\S*)$", re.IGNORECASE
+)
+
+
+def mask_variables(text, agent=None):
+    """Sustituye por <*> los tokens que parecen variables (números, IPs, PIDs,
+    hashes) y el nombre del agente (el host de las cabeceras syslog), para que
+    el mismo mensaje de varios agentes caiga en la misma plantilla"""
+    return [
+        WILDCARD if token == agent or _VARIABLE_TOKEN_RE.match(token) else token
+        for token in text.split()
+    ]
+
+
+def log_agent(log):
+    return (log.get('agent') or {}).get('name')
+
+
+def log_rule_id(log):
+    rule_id = (log.get('rule') or {}).get('id')
+    return str(rule_id) if rule_id is not None else ''
+
+
+def template_rule_id(template):
+    # Cada plantilla solo recibe eventos de su regla
+    return min(template.rule_ids, default='')
+
+
+def group_key(rule_id, tokens):
+    return rule_id, len(tokens), tokens[0]
+
+
+class LogTemplate:
+    """Plantilla de log con contadores y ejemplos de los valores variables"""
+
+    __slots__ = ("tokens", "count", "first_seen", "last_seen", "max_level", "rule_ids", "agents", "examples", "position")
+
+    def __init__(self, tokens, position=None):
+        self.tokens = list(tokens)
+        self.position = position  # Índice en LogTemplateMiner.templates
+        self.count = 0
+        self.first_seen = None
+        self.last_seen = None
+        self.max_level = 0
+        self.rule_ids = set()
+        self.agents = set()
+        self.examples = {}  # posición -> valores de ejemplo
+
+    @property
+    def text(self):
+        return " ".join(self.tokens)
+
+    def to_dict(self):
+        return {
+            "tokens": self.tokens, "count": self.count, "first_seen": self.first_seen, "last_seen": self.last_seen,
+            "max_level": self.max_level, "rule_ids": sorted(self.rule_ids), "agents": sorted(self.agents),
+            "examples": {str(i): values for i, values in self.examples.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        template = cls(data["tokens"])
+        template.count = data["count"]
+        template.first_seen = data["first_seen"]
+        template.last_seen = data["last_seen"]
+        template.max_level = data["max_level"]
+        template.rule_ids = set(data["rule_ids"])
+        template.agents = set(data["agents"])
+        template.examples = {int(i): values for i, values in data["examples"].items()}
+        return template
+
+    def copy(self):
+        other = LogTemplate(self.tokens, self.position)
+        other.count = self.count
+        other.first_seen = self.first_seen
+        other.last_seen = self.last_seen
+        other.max_level = self.max_level
+        other.rule_ids = set(self.rule_ids)
+        other.agents = set(self.agents)
+        other.examples = {i: list(values) for i, values in self.examples.items()}
+        return other
+
+    def similarity(self, tokens):
+        # Dos variables en la misma posición también coinciden: si no, una
+        # línea con muchas variables no alcanzaría ni a su propia plantilla
+        same = sum(1 for a, b in zip(self.tokens, tokens) if a == b)
+        return same / len(tokens)
+
+    def merge(self, masked, raw_tokens, log, max_examples):
+        for i, token in enumerate(masked):
+            if self.tokens[i] != token:
+                self.tokens[i] = WILDCARD
+        for i, token in enumerate(self.tokens):
+            if token == WILDCARD and i < len(raw_tokens):
+                values = self.examples.setdefault(i, [])
+                if len(values) < max_examples and raw_tokens[i] not in values:
+                    values.append(raw_tokens[i])
+        self.count += 1
+        timestamp = log.get('timestamp') or ''
+        if timestamp:
+            if self.first_seen is None or timestamp < self.first_seen:
+                self.first_seen = timestamp
+            if self.last_seen is None or timestamp > self.last_seen:
+                self.last_seen = timestamp
+        rule = log.get('rule') or {}
+        try:
+            self.max_level = max(self.max_level, int(rule.get('level') or 0))
+        except (TypeError, ValueError):
+            pass
+        if rule.get('id') and len(self.rule_ids) < 5:
+            self.rule_ids.add(str(rule['id']))
+        agent = (log.get('agent') or {}).get('name')
+        if agent and len(self.agents) < 5:
+            self.agents.add(agent)
+
+
+class LogTemplateMiner:
+    """Minero de plantillas en streaming al estilo Drain.
+
+    Los eventos se agrupan por regla, número de tokens y primer token;
+    dentro del grupo se une a la plantilla más parecida (o crea una nueva) y
+    las posiciones que difieren pasan a ser <*>. Separar por regla evita unir
+    mensajes de forma parecida pero distinto significado (login aceptado y
+    fallido). Una plantilla conserva su posición en templates en las copias.
+    """
+
+    def __init__(self, similarity=TEMPLATE_SIMILARITY, max_clusters=TEMPLATE_MAX_CLUSTERS, max_examples=3):
+        self.similarity = similarity
+        self.max_clusters = max_clusters
+        self.max_examples = max_examples
+        self.groups = {}  # (regla, longitud, primer token) -> [LogTemplate]
+        self.templates = []
+        self.total = 0
+        self.unclustered = 0
+        self.owned = None  # En una copia: ids de las plantillas y grupos ya copiados (el resto se comparte)
+
+    def _owns(self, value):
+        return self.owned is None or id(value) in self.owned
+
+    def _group(self, key):
+        """Lista del grupo, propia de este minero antes de modificarla"""
+        group = self.groups.get(key)
+        if group is None or not self._owns(group):
+            group = self.groups[key] = list(group or ())
+            if self.owned is not None:
+                self.owned.add(id(group))
+        return group
+
+    def _own(self, group, template):
+        """Plantilla propia de este minero antes de modificarla (copia si es compartida)"""
+        if self._owns(template):
+            return template
+        own = template.copy()
+        self.owned.add(id(own))
+        group[group.index(template)] = own
+        self.templates[template.position] = own
+        return own
+
+    def _new_template(self, group, tokens):
+        template = LogTemplate(tokens, len(self.templates))
+        if self.owned is not None:
+            self.owned.add(id(template))
+        group.append(template)
+        self.templates.append(template)
+        return template
+
+    def _best(self, group, masked):
+        best, best_score = None, 0.0
+        for template in group:
+            score = template.similarity(masked)
+            if score > best_score:
+                best, best_score = template, score
+        return best, best_score
+
+    def match(self, log):
+        """Plantilla a la que pertenece el evento, sin modificar el minero"""
+        masked = mask_variables(log.get('full_log') or '', log_agent(log))
+        if not masked:
+            return None
+        best, best_score = self._best(self.groups.get(group_key(log_rule_id(log), masked), ()), masked)
+        return best if best_score >= self.similarity else None
+
+    def add(self, log):
+        full_log = log.get('full_log')
+        if not full_log:
+            return None
+        raw_tokens = full_log.split()
+        masked = mask_variables(full_log, log_agent(log))
+        if not masked:
+            return None
+        self.total += 1
+        group = self._group(group_key(log_rule_id(log), masked))
+        best, best_score = self._best(group, masked)
+        if best is None or best_score < self.similarity:
+            if len(self.templates) >= self.max_clusters:
+                self.unclustered += 1
+                return None
+            best = self._new_template(group, masked)
+        best = self._own(group, best)
+        best.merge(masked, raw_tokens, log, self.max_examples)
+        return best
+
+    def add_many(self, logs):
+        for log in logs:
+            self.add(log)
+        return self
+
+    def absorb(self, other, count, first_seen, last_seen, max_level):
+        """Une la plantilla other de otro minero (la de un día del índice) con sus contadores"""
+        tokens = other.tokens
+        self.total += count
+        group = self._group(group_key(template_rule_id(other), tokens))
+        best = next((template for template in group if template.tokens == tokens), None)
+        if best is None:
+            best, best_score = self._best(group, tokens)
+            if best is None or best_score < self.similarity:
+                if len(self.templates) >= self.max_clusters:
+                    self.unclustered += count
+                    return None
+                best = self._new_template(group, tokens)
+            else:
+                best = self._own(group, best)
+                for i, token in enumerate(tokens):
+                    if best.tokens[i] != token:
+                        best.tokens[i] = WILDCARD
+        best = self._own(group, best)
+        best.count += count
+        if first_seen and (best.first_seen is None or first_seen < best.first_seen):
+            best.first_seen = first_seen
+        if last_seen and (best.last_seen is None or last_seen > best.last_seen):
+            best.last_seen = last_seen
+        best.max_level = max(best.max_level, max_level)
+        for merged, values in ((best.rule_ids, other.rule_ids), (best.agents, other.agents)):
+            for value in sorted(values):
+                if len(merged) >= 5:
+                    break
+                merged.add(value)
+        for i, values in other.examples.items():
+            merged = best.examples.setdefault(i, [])
+            merged.extend(value for value in values[:self.max_examples - len(merged)] if value not in merged)
+        return best
+
+    def copy(self):
+        """Copia para actualizar sin tocar este minero (el publicado).
+
+        Comparte plantillas y grupos y solo copia los que modifica: copiar el
+        minero entero solo duplica las listas de referencias.
+        """
+        other = LogTemplateMiner(self.similarity, self.max_clusters, self.max_examples)
+        other.total = self.total
+        other.unclustered = self.unclustered
+        other.templates = list(self.templates)
+        other.groups = dict(self.groups)
+        other.owned = set()
+        return other
+
+    def to_dict(self):
+        return {"total": self.total, "unclustered": self.unclustered, "templates": [t.to_dict() for t in self.templates]}
+
+    @classmethod
+    def from_dict(cls, data):
+        miner = cls()
+        miner.total = data["total"]
+        miner.unclustered = data["unclustered"]
+        for item in data["templates"]:
+            template = LogTemplate.from_dict(item)
+            template.position = len(miner.templates)
+            miner.templates.append(template)
+            miner.groups.setdefault(group_key(template_rule_id(template), template.tokens), []).append(template)
+        return miner
+
+    def top(self, n=None):
+        """Plantillas ordenadas por nivel máximo y número de eventos"""
+        ranked = sorted(self.templates, key=lambda t: (t.max_level, t.count), reverse=True)
+        return ranked[:n] if n else ranked
+
+
+def format_epoch(ts):
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%dT%H:%M:%S") if ts else None
+
+
+def mine_index_templates(past_days, log_filter=None):
+    """Plantillas de todos los eventos del rango, a partir de los mineros diarios del índice.
+
+    Sin ventana ni filtros se suman los contadores de cada día; con ellos se
+    cuentan solo las filas seleccionadas, con su primera y última vez y su
+    nivel máximo leídos de las columnas. Los grupos no están indexados y no
+    se tienen en cuenta aquí.
+    """
+    log_filter = log_filter or LogFilter()
+    miner = LogTemplateMiner()
+    for day_index in iter_index_days(past_days, since=log_filter.since, until=log_filter.until):
+        day_miner = day_index.load_miner()
+        rows = select_index_rows(day_index, log_filter)
+        if rows is None:
+            for template in day_miner.templates:
+                miner.absorb(
+                    template, template.count, format_epoch(parse_timestamp(template.first_seen)),
+                    format_epoch(parse_timestamp(template.last_seen)), template.max_level,
+                )
+            miner.total += day_miner.unclustered
+            miner.unclustered += day_miner.unclustered
+            continue
+        codes = day_index.column("template")
+        timestamps = day_index.column("timestamp")
+        levels = day_index.column("rule_level")
+        stats = {}  # código -> [eventos, primero, último, nivel máximo]
+        for i in rows:
+            code, ts = codes[i], timestamps[i]
+            entry = stats.get(code)
+            if entry is None:
+                stats[code] = [1, ts, ts, levels[i]]
+                continue
+            entry[0] += 1
+            if ts < entry[1]:
+                entry[1] = ts
+            if ts > entry[2]:
+                entry[2] = ts
+            if levels[i] > entry[3]:
+                entry[3] = levels[i]
+        for code, (count, first, last, level) in stats.items():
+            if code and code <= len(day_miner.templates):
+                miner.absorb(day_miner.templates[code - 1], count, format_epoch(first), format_epoch(last), level)
+            else:
+                miner.total += count
+                miner.unclustered += count
+    return miner
+
+
+def format_template_line(i, template):
+    first = (template.first_seen or '')[:19]
+    last = (template.last_seen or '')[:19]
+    line = (
+        f"Patrón {i}: {template.count} eventos entre {first} y {last}, nivel máx {template.max_level}, "
+        f"reglas {','.join(sorted(template.rule_ids)) or '?'}, agentes {','.join(sorted(template.agents)) or '?'}: "
+        f"{template.text[:200]}"
+    )
+    examples = [f"{', '.join(values)}" for _, values in sorted(template.examples.items())[:3]]
+    if examples:
+        line += f" | ejemplos de <*>: {' / '.join(examples)}"
+    return line
+
+
+def create_template_context(miner, token_budget):
+    """Resumen de plantillas (las más graves y frecuentes) dentro del presupuesto"""
+    if not miner or not miner.templates:
+        return ""
+    lines = []
+    used = 0
+    for template in miner.top():
+        line = format_template_line(len(lines) + 1, template)
+        cost = estimate_tokens(line)
+        if used + cost > token_budget:
+            break
+        lines.append(line)
+        used += cost
+    header = f"Patrones agregados ({miner.total} eventos en {len(miner.templates)} plantillas):"
+    return header + "\n" + "\n".join(lines)
+
+
+# ===== Recuperación semántica (embeddings de plantillas) =====
+
+SEMANTIC_RETRIEVAL = os.getenv("SEMANTIC_RETRIEVAL", "false").lower() == "true"
+# Modelo de sentence-transformers en CPU, u "ollama:<modelo>" para usar el servidor de Ollama
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+SEMANTIC_TOP_K = int(os.getenv("SEMANTIC_TOP_K", "20"))  # Plantillas candidatas por pregunta
+SEMANTIC_WEIGHT = float(os.getenv("SEMANTIC_WEIGHT", "0.5"))  # Peso de la similitud frente a BM25
+SEMANTIC_MIN_SIMILARITY = 0.2
+
+try:
+    import numpy as np  # Solo para la recuperación semántica (viene con sentence-transformers)
+except ImportError:
+    np = None
+
+
+def load_embedding_model(name):
+    """Devuelve encode(textos) -> matriz float32 con filas normalizadas"""
+    if name.startswith("ollama:"):
+        from langchain_ollama import OllamaEmbeddings
+        embeddings = OllamaEmbeddings(model=name[len("ollama:"):], base_url=OLLAMA_BASE_URL)
+
+        def encode(texts):
+            vectors = np.asarray(embeddings.embed_documents(list(texts)), dtype=np.float32)
+            return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return encode
+
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(name, device="cpu")
+
+    def encode(texts):
+        vectors = model.encode(list(texts), batch_size=EMBEDDING_BATCH_SIZE, normalize_embeddings=True, convert_to_numpy=True)
+        return vectors.astype(np.float32, copy=False)
+    return encode
+
+
+class TemplateVectorStore:
+    """Embeddings persistentes de las plantillas de log, indexados por su texto.
+
+    vectors.f32 es una matriz float32 de solo anexado que se lee con memmap y
+    texts.txt guarda el texto de cada fila. Las plantillas que ya aparecieron
+    en otros días o recargas no se vuelven a embeber: cada construcción solo
+    calcula, en lotes, las que son nuevas.
+    """
+
+    def __init__(self, root, model_name=EMBEDDING_MODEL, encode=None):
+        self.root = root
+        self.model_name = model_name
+        self.encode = encode or load_embedding_model(model_name)
+        self.lock = threading.Lock()
+        self.rows = {}  # texto -> fila
+        self.dim = None
+        self.vectors = None
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    def _load(self):
+        try:
+            with open(self._path("meta.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+        if meta.get("model") != self.model_name or not meta.get("dim"):
+            # Otro modelo u otra dimensión: los vectores no son comparables
+            for name in ("vectors.f32", "texts.txt", "meta.json"):
+                if os.path.exists(self._path(name)):
+                    os.remove(self._path(name))
+            return
+        self.dim = meta["dim"]
+        with open(self._path("texts.txt"), encoding="utf-8") as f:
+            texts = f.read().splitlines()
+        rows = min(len(texts), os.path.getsize(self._path("vectors.f32")) // (4 * self.dim))
+        if rows < len(texts) or rows * 4 * self.dim < os.path.getsize(self._path("vectors.f32")):
+            # Escritura interrumpida: se descarta la cola incompleta
+            os.truncate(self._path("vectors.f32"), rows * 4 * self.dim)
+            with open(self._path("texts.txt"), "w", encoding="utf-8") as f:
+                f.write("".join(text + "\n" for text in texts[:rows]))
+        self.rows = {text: i for i, text in enumerate(texts[:rows])}
+        self._map()
+
+    def _map(self):
+        if self.rows:
+            self.vectors = np.memmap(self._path("vectors.f32"), dtype=np.float32, mode="r", shape=(len(self.rows), self.dim))
+
+    def update(self, texts):
+        """Embebe en lotes los textos que aún no están; devuelve cuántos se añadieron"""
+        with self.lock:
+            missing = list(dict.fromkeys(text for text in texts if text not in self.rows))
+            for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+                batch = missing[start:start + EMBEDDING_BATCH_SIZE]
+                vectors = self.encode(batch)
+                if self.dim is None:
+                    self.dim = int(vectors.shape[1])
+                    with open(self._path("meta.json"), "w", encoding="utf-8") as f:
+                        json.dump({"model": self.model_name, "dim": self.dim}, f)
+                # Primero los vectores: una fila sin texto se descarta al cargar
+                with open(self._path("vectors.f32"), "ab") as f:
+                    f.write(vectors.tobytes())
+                with open(self._path("texts.txt"), "a", encoding="utf-8") as f:
+                    f.write("".join(text + "\n" for text in batch))
+                for text in batch:
+                    self.rows[text] = len(self.rows)
+            if missing:
+                self._map()
+            return len(missing)
+
+    def search(self, query, texts, k=SEMANTIC_TOP_K):
+        """Los k textos de texts más parecidos a la pregunta: [(texto, similitud)]
+
+        Búsqueda exacta sobre las filas de las plantillas del contexto (como
+        mucho TEMPLATE_MAX_CLUSTERS), leídas del memmap.
+        """
+        vectors = self.vectors  # update() puede volver a mapear el fichero
+        if vectors is None:
+            return []
+        candidates = []
+        rows = []
+        for text in texts:
+            row = self.rows.get(text)
+            if row is not None and row < len(vectors):
+                candidates.append(text)
+                rows.append(row)
+        if not rows:
+            return []
+        scores = vectors[np.asarray(rows)] @ self.encode([query])[0]
+        top = np.argsort(-scores)[:k]
+        return [(candidates[i], float(scores[i])) for i in top]
+
+    def summary(self):
+        return f"{len(self.rows)} plantillas embebidas ({self.model_name})"
+
+
+template_vectors = None
+template_vectors_lock = threading.Lock()
+template_vectors_failed = False
+
+
+def get_template_vectors():
+    """Almacén de embeddings, cargando el modelo la primera vez; None si está desactivado o no disponible"""
+    global template_vectors, template_vectors_failed
+    if not SEMANTIC_RETRIEVAL or template_vectors_failed:
+        return None
+    with template_vectors_lock:
+        if template_vectors is None and not template_vectors_failed:
+            if np is None:
+                print("⚠️ Semantic retrieval needs numpy; using keyword ranking only")
+                template_vectors_failed = True
+                return None
+            slug = re.sub(r"[^\w.-]+", "_", EMBEDDING_MODEL)
+            try:
+                print(f"🧠 Loading embedding model {EMBEDDING_MODEL}...")
+                template_vectors = TemplateVectorStore(os.path.join(INDEX_DIR, "embeddings", slug))
+            except Exception as e:
+                print(f"⚠️ Embedding model unavailable, using keyword ranking only: {e}")
+                template_vectors_failed = True
+    return template_vectors
+
+
+def embed_templates(miner):
+    """Añade al almacén las plantillas nuevas del minero"""
+    store = get_template_vectors()
+    if store is None or miner is None:
+        return 0
+    try:
+        return store.update(template.text for template in list(miner.templates))
+    except Exception as e:
+        print(f"⚠️ Error embedding log templates: {e}")
+        return 0
+
+
+def semantic_template_scores(miner, question):
+    """{LogTemplate: similitud} de las plantillas más parecidas a la pregunta"""
+    store = template_vectors
+    if store is None or miner is None or not miner.templates:
+        return None
+    by_text = {template.text: template for template in list(miner.templates)}
+    try:
+        hits = store.search(question, list(by_text), SEMANTIC_TOP_K)
+    except Exception as e:
+        print(f"⚠️ Error in semantic search: {e}")
+        return None
+    return {by_text[text]: score for text, score in hits if score >= SEMANTIC_MIN_SIMILARITY}
+
+
+def create_question_events(snapshot, question, token_budget=CONTEXT_TOKEN_BUDGET, agents=None):
+    """Eventos más relevantes para esta pregunta, en la parte del presupuesto
+    que no ocupan las plantillas del prefijo (solo de agents, si se indican)"""
+    event_ranker = snapshot.event_ranker
+    if not event_ranker or not event_ranker.n_docs:
+        return ""
+    semantic = semantic_template_scores(snapshot.template_miner, question)
+    selected = event_ranker.select(question, int(token_budget * (1 - TEMPLATE_BUDGET_SHARE)), semantic, agents)
+    return "\n\n".join(format_log_line(i + 1, log) for i, log in enumerate(selected))
+
+
+def create_simple_context(logs, max_logs=CONTEXT_MAX_LOGS):
+    """Crea un contexto simple sin embeddings.
+
+    Acepta cualquier iterable y deja de consumirlo al llegar a max_logs.
+    """
+    context_parts = []
+    for i, log in enumerate(islice(logs, max_logs)):  # Limitar a 100 logs para no sobrecargar
+        log_text = log.get('full_log', '')
+        if log_text:
+            context_parts.append(f"Log {i+1}: {log_text[:200]}...")  # Limitar longitud
+    
+    return "\n\n".join(context_parts)
+
+def is_wazuh_related_question(question):
+    """Detecta si la pregunta está relacionada con Wazuh/logs de seguridad"""
+    wazuh_keywords = [
+        'wazuh', 'logs', 'security', 'threat', 'alert', 'event', 'attack',
+        'intrusion', 'firewall', 'antivirus', 'malware', 'vulnerability',
+        'breach', 'incident', 'monitoring', 'detection', 'siem',
+        'ossec', 'archives', 'security logs', 'threat hunting',
+        'security events', 'alerts', 'incidents', 'attacks',
+        'log analysis', 'security analysis', 'threat analysis',
+        'registro', 'seguridad', 'amenaza', 'alerta', 'evento', 'ataque', 'intrusion',
+        'sospechos', 'bloquead', 'fuerza bruta', 'incidente', 'vulnerabilidad', 'agente'
+    ]
+    
+    question_lower = fold_text(question)
+    return any(keyword in question_lower for keyword in wazuh_keywords)
+
+
+# ===== Consultas estructuradas (conteos y rankings sin LLM) =====
+
+STRUCTURED_QUERY_PHRASING = os.getenv("STRUCTURED_QUERY_PHRASING", "true").lower() == "true"
+
+QUERY_COUNT_RE = re.compile(r"\b(cuant[oa]s|how many|count|numero de|cantidad de|total de)\b")
+QUERY_TOP_RE = re.compile(
+    r"\b(top|ranking|principales|mas (frecuentes?|activ[oa]s?|comunes)|most (common|frequent|active)"
+    r"|by (alert|event) count|por numero de)\b"
+)
+QUERY_LIMIT_RE = re.compile(r"\btop\s*(\d{1,3})\b|\b(\d{1,3})\s+(agentes|agents|reglas|rules|ips|hosts|decoders)\b")
+QUERY_LEVEL_RE = re.compile(
+    r"\b(?:nivel|level|severidad|severity)\s*"
+    r"(>=|≥|=>|<=|≤|=<|>|<|=|mayor o igual (?:a|que)|menor o igual (?:a|que)|mayor (?:a|que)|menor (?:a|que)"
+    r"|superior a|inferior a|de al menos|al menos|at least|above|over|below|under|igual a|de)?\s*(\d{1,2})"
+    r"(\s*(?:o|or)\s*(?:mas|superior|mayor|higher|more|above))?"
+)
+QUERY_RULE_RE = re.compile(r"\b(?:regla|rule)\s*(?:id\s*)?#?(\d{2,6})\b")
+QUERY_IP_RE = re.compile(r"\b(\d{1,3}(?:\.\d{1,3}){3})\b")
+QUERY_AGENT_RE = re.compile(
+    r"(?<!por )(?<!per )(?<!by )(?<!cada )\b(?:agente|agent|host)\s+"
+    r"(?!(?:con|with|de|del|by|por|que|that|mas|most|y|and|en|on|in|hoy|today|ayer|yesterday|ultim\w*|last|past|esta|this)\b)"
+    r"([a-z0-9][\w.-]*)"
+)
+QUERY_DIMENSIONS = (
+    ("agent", re.compile(r"\b(agentes?|agents?|hosts?|equipos?)\b")),
+    ("rule_id", re.compile(r"\b(reglas?|rules?)\b")),
+    ("srcip", re.compile(r"\b(ips?|srcip|direcciones|origen|source)\b")),
+    ("rule_level", re.compile(r"\b(nivel(es)?|levels?|severidad|severity)\b")),
+    ("decoder", re.compile(r"\b(decoders?|decodificador(es)?)\b")),
+    ("location", re.compile(r"\b(location|ubicacion(es)?|ficheros?)\b")),
+    ("hour", re.compile(r"\b(por|per|by|cada) (hora|hour)\b")),
+    ("day", re.compile(r"\b(por|per|by|cada) (dia|day)\b")),
+)
+QUERY_GROUP_RE = re.compile(r"\b(por|per|by|cada)\s+(agente|agent|host|regla|rule|ip|nivel|level|decoder|hora|hour|dia|day)")
+# Palabras que no cambian lo que se cuenta; cualquier otra ("ataques", "ssh",
+# "login fallidos") describe un sujeto sin filtro en el índice y va al LLM
+QUERY_FILLER_WORDS = frozenset("""
+    eventos evento alertas alerta logs log registros registro entradas events event alerts alert entries records
+    hubo hay ha han habido hubieron se saltaron salto saltado dispararon disparo disparado generaron genero generado
+    registraron registrado tuvo tuvieron tiene tienen veces vez
+    there were was is are have has had did does do been fired triggered generated times
+    de del la el los las lo en con y o a al que cual cuales quien quienes para sobre un una unos unas su sus desde hasta
+    the of in on at with and or by for to from which what who that an its their since until
+    me dame muestrame muestra dime lista listar ver give show list tell
+    total numero cantidad count how many mas most more
+    hoy ayer ultimo ultima ultimos ultimas esta este semana dia dias hora horas h
+    today yesterday last past this week day days hour hours
+""".split())
+_QUERY_WORD_RE = re.compile(r"[a-z]+")
+QUERY_DIMENSION_LABELS = {
+    "agent": "agente", "rule_id": "regla", "srcip": "IP de origen", "rule_level": "nivel",
+    "decoder": "decoder", "location": "ubicación", "hour": "hora", "day": "día",
+}
+QUERY_LEVEL_OPERATORS = {
+    ">=": lambda a, b: a >= b, ">": lambda a, b: a > b, "<=": lambda a, b: a <= b,
+    "<": lambda a, b: a < b, "=": lambda a, b: a == b,
+}
+
+
+def fold_text(text):
+    """Minúsculas y sin acentos, conservando la puntuación (IPs, operadores)"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+def parse_level_operator(operator, suffix):
+    if suffix:
+        return ">="
+    operator = (operator or "").strip()
+    if operator in (">=", "≥", "=>") or "igual" in operator and "mayor" in operator or operator in ("al menos", "de al menos", "at least"):
+        return ">="
+    if operator in ("<=", "≤", "=<") or "igual" in operator and "menor" in operator:
+        return "<="
+    if operator in (">", "mayor a", "mayor que", "superior a", "above", "over"):
+        return ">"
+    if operator in ("<", "menor a", "menor que", "inferior a", "below", "under"):
+        return "<"
+    return "="
+
+
+def parse_query_window(text):
+    """(since, until, días a leer) a partir de expresiones como 'hoy' o 'últimos 3 días'"""
+    now = datetime.now()
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    match = re.search(r"\b(?:ultim[oa]s?|last|past)\s+(\d{1,3})\s*(dias?|days?|horas?|hours?|h)\b", text)
+    if match:
+        amount = int(match.group(1))
+        if match.group(2).startswith(("h", "hora", "hour")):
+            since = now - timedelta(hours=amount)
+            return since.timestamp(), None, (now - since).days + 2
+        return (midnight - timedelta(days=amount - 1)).timestamp(), None, amount
+    if re.search(r"\b(ultima hora|last hour)\b", text):
+        return (now - timedelta(hours=1)).timestamp(), None, 2
+    if re.search(r"\b(hoy|today)\b", text):
+        return midnight.timestamp(), None, 1
+    if re.search(r"\b(ayer|yesterday)\b", text):
+        return (midnight - timedelta(days=1)).timestamp(), midnight.timestamp(), 2
+    if re.search(r"\b(esta semana|ultima semana|this week|last week)\b", text):
+        return (midnight - timedelta(days=6)).timestamp(), None, 7
+    return None, None, None
+
+
+class StructuredQuery:
+    """Conteo o ranking sobre el índice columnar: filtros + agrupación opcional"""
+
+    def __init__(self, kind, group_by=None, limit=STATS_TOP_K, filters=None, since=None, until=None, past_days=None):
+        self.kind = kind  # "count" o "top"
+        self.group_by = group_by
+        self.limit = limit
+        self.filters = filters or {}  # columna -> valor; rule_level -> (operador, nivel)
+        self.since = since
+        self.until = until
+        self.past_days = past_days
+
+    def describe(self):
+        parts = []
+        if "rule_level" in self.filters:
+            operator, level = self.filters["rule_level"]
+            parts.append(f"nivel {operator} {level}")
+        for name in ("agent", "rule_id", "srcip"):
+            if name in self.filters:
+                parts.append(f"{QUERY_DIMENSION_LABELS[name]} {self.filters[name]}")
+        if self.since:
+            parts.append(f"desde {datetime.fromtimestamp(self.since).strftime('%Y-%m-%d %H:%M')}")
+        if self.until:
+            parts.append(f"hasta {datetime.fromtimestamp(self.until).strftime('%Y-%m-%d %H:%M')}")
+        parts.append(f"días leídos: {self.past_days}")
+        group = f", agrupado por {QUERY_DIMENSION_LABELS[self.group_by]}" if self.group_by else ""
+        return f"{'Ranking' if self.kind == 'top' else 'Conteo'} de eventos ({', '.join(parts)}){group}"
+
+    def _select(self, day_index):
+        """Filas del día que cumplen los filtros (None = todas)"""
+        selected = None
+        if self.since or self.until:
+            # Solo las filas de los bloques que pueden caer en la ventana
+            bounds = day_index.seek(self.since, self.until)
+            if bounds is None:
+                return []
+            timestamps = day_index.column("timestamp")
+            since, until = self.since or 0.0, self.until or float("inf")
+            selected = [i for i in range(bounds[0], bounds[1]) if since <= timestamps[i] < until]
+        if "rule_level" in self.filters:
+            operator, level = self.filters["rule_level"]
+            compare = QUERY_LEVEL_OPERATORS[operator]
+            levels = day_index.column("rule_level")
+            # 256 niveles posibles: se evalúa el operador una vez por valor
+            allowed = [compare(value, level) for value in range(256)]
+            rows = range(day_index.rows) if selected is None else selected
+            selected = [i for i in rows if allowed[levels[i]]]
+        for name in ("agent", "rule_id", "srcip"):
+            if name not in self.filters:
+                continue
+            wanted = self.filters[name].lower()
+            codes = {code for code, value in enumerate(day_index.meta["vocab"][name]) if value.lower() == wanted}
+            if not codes:
+                return []
+            column = day_index.column(name)
+            rows = range(day_index.rows) if selected is None else selected
+            selected = [i for i in rows if column[i] in codes]
+        return selected
+
+    def _group(self, day_index, selected, counts):
+        name = self.group_by
+        if name in ("hour", "day"):
+            timestamps = day_index.column("timestamp")
+            values = timestamps if selected is None else [timestamps[i] for i in selected]
+            fmt = "%H:00" if name == "hour" else "%Y-%m-%d"
+            labels = {}  # Una conversión de fecha por bloque de hora
+            for ts in values:
+                if not ts:
+                    continue
+                block = int(ts // 3600)
+                label = labels.get(block)
+                if label is None:
+                    label = labels[block] = datetime.fromtimestamp(block * 3600).strftime(fmt)
+                counts[label] += 1
+            return
+        column = day_index.column(name)
+        codes = Counter(column) if selected is None else Counter(column[i] for i in selected)
+        if name in INDEX_STRING_COLUMNS:
+            vocab = day_index.meta["vocab"][name]
+            for code, count in codes.items():
+                counts[vocab[code]] += count
+        else:
+            for value, count in codes.items():
+                counts[str(value)] += count
+
+    def run(self):
+        """Devuelve (total de eventos, filas (valor, conteo)) recorriendo el índice"""
+        total = 0
+        counts = Counter()
+        for day_index in iter_index_days(self.past_days, since=self.since, until=self.until):
+            stats = day_index.meta["stats"]
+            if not day_index.rows or (self.since and stats["last"] < self.since) or (self.until and stats["first"] >= self.until):
+                continue
+            selected = self._select(day_index)
+            total += day_index.rows if selected is None else len(selected)
+            if self.group_by:
+                self._group(day_index, selected, counts)
+        if not self.group_by:
+            return total, []
+        if self.group_by in ("hour", "day"):
+            return total, sorted(counts.items())
+        counts.pop('', None)
+        return total, counts.most_common(self.limit)
+
+    def format_result(self, total, rows):
+        lines = [self.describe(), f"Total de eventos: {total}"]
+        if self.group_by:
+            label = QUERY_DIMENSION_LABELS[self.group_by]
+            lines.extend(f"{i}. {label} {value}: {count}" for i, (value, count) in enumerate(rows, start=1))
+            if not rows:
+                lines.append("(sin resultados)")
+        return "\n".join(lines)
+
+
+def parse_structured_query(question, default_days=None):
+    """Reconoce preguntas de conteo o ranking; None si no lo son o si lo que
+    cuentan no se puede expresar con los filtros del índice.
+
+    Sin ventana explícita se consultan default_days días o la LogWindow de la sesión.
+    """
+    text = fold_text(question)
+    is_count = bool(QUERY_COUNT_RE.search(text))
+    is_top = bool(QUERY_TOP_RE.search(text))
+    group_match = QUERY_GROUP_RE.search(text)
+    if not (is_count or is_top or group_match):
+        return None
+
+    filters = {}
+    match = QUERY_LEVEL_RE.search(text)
+    if match:
+        filters["rule_level"] = (parse_level_operator(match.group(1), match.group(3)), int(match.group(2)))
+        text = text[:match.start()] + " " + text[match.end():]
+    match = QUERY_RULE_RE.search(text)
+    if match:
+        filters["rule_id"] = match.group(1)
+        text = text[:match.start()] + " " + text[match.end():]
+    match = QUERY_IP_RE.search(text)
+    if match:
+        filters["srcip"] = match.group(1)
+        text = text[:match.start()] + " " + text[match.end():]
+    match = QUERY_AGENT_RE.search(text)
+    if match:
+        filters["agent"] = match.group(1)
+        text = text[:match.start()] + " " + text[match.end():]
+    since, until, past_days = parse_query_window(text)
+    if past_days is None and isinstance(default_days, LogWindow):
+        # Sin periodo en la pregunta: el de la ventana de la sesión
+        since, until = default_days.bounds()
+        past_days = default_days.days
+        window_filters = default_days.filters
+        if "min_level" in window_filters and "rule_level" not in filters:
+            filters["rule_level"] = (">=", window_filters["min_level"])
+        for name, column in (("agents", "agent"), ("rule_ids", "rule_id")):
+            if len(window_filters.get(name, ())) == 1 and column not in filters:
+                filters[column] = window_filters[name][0]
+
+    # La dimensión mencionada primero (que no sea un filtro) es la agrupación
+    group_by = None
+    mentions = [(found.start(), name) for name, pattern in QUERY_DIMENSIONS for found in [pattern.search(text)] if found]
+    rest = text
+    for pattern in (QUERY_COUNT_RE, QUERY_TOP_RE, QUERY_GROUP_RE, QUERY_LIMIT_RE, *(pattern for _, pattern in QUERY_DIMENSIONS)):
+        rest = pattern.sub(" ", rest)
+    if any(word not in QUERY_FILLER_WORDS for word in _QUERY_WORD_RE.findall(rest)):
+        # Lo que se cuenta no se puede expresar con los filtros del índice
+        return None
+    if is_top or group_match:
+        candidates = sorted((start, name) for start, name in mentions if name not in filters)
+        group_by = candidates[0][1] if candidates else None
+        if group_by is None and not is_count:
+            return None
+    limit_match = QUERY_LIMIT_RE.search(text)
+    limit = int(limit_match.group(1) or limit_match.group(2)) if limit_match else STATS_TOP_K
+    return StructuredQuery(
+        "top" if group_by else "count", group_by, limit, filters, since, until, past_days or default_days or days_range
+    )
+
+
+QUERY_PHRASING_PROMPT = (
+    "You are a security analyst. Answer the user's question in spanish using ONLY the exact "
+    "query result provided, which was computed over the Wazuh archives. Do not recompute, "
+    "estimate or invent numbers; keep every value as given and be brief."
+)
+
+
+# ===== Enrutado de preguntas =====
+
+ROUTER_MIN_CONFIDENCE = float(os.getenv("ROUTER_MIN_CONFIDENCE", "0.05"))  # Margen mínimo sobre la segunda intención
+LOG_INTENTS = ("logs", "aggregate", "agent")
+
+# Preguntas de ejemplo por intención; sus centroides se calculan una vez al arrancar
+ROUTER_EXAMPLES = {
+    "general": [
+        "explícame qué es docker", "cómo se escribe un bucle for en python", "qué diferencia hay entre tcp y udp",
+        "escribe un correo para mi equipo", "qué es kubernetes y para qué sirve", "traduce este texto al inglés",
+        "hola, qué tal", "recomiéndame un libro de programación", "cómo configuro git en windows",
+        "explain what a rest api is", "write a bash script to rename files", "what is the capital of france",
+        "qué hora es en madrid", "resume este artículo", "cómo funciona un hash criptográfico",
+    ],
+    "logs": [
+        "qué ataques muestran los logs de hoy", "hay intentos de fuerza bruta por ssh", "analiza los eventos de seguridad",
+        "detectas algo sospechoso en los registros", "qué alertas críticas ha habido", "hay inyecciones sql en el servidor web",
+        "resume los intentos de login fallidos", "qué cambios de integridad reportó syscheck", "hay malware o ransomware",
+        "busca escaneos de puertos o conexiones bloqueadas por el firewall", "qué pasó anoche en la red",
+        "show me suspicious authentication failures", "any signs of intrusion in the archives", "threat hunting sobre los eventos",
+        "qué usuarios intentaron acceder como root", "explica la alerta de la regla 5710", "hay actividad de sqlmap",
+        "qué ha pasado desde la ip 10.0.0.5", "eventos de sudo ejecutados por usuarios", "qué vulnerabilidades se detectaron",
+        "dame un resumen de las conexiones bloqueadas", "analiza la actividad de esta dirección ip", "hay accesos no autorizados",
+    ],
+    "aggregate": [
+        "cuántas alertas de nivel 12 hubo hoy", "top 10 agentes con más alertas", "cuántos eventos hay en los últimos 3 días",
+        "ranking de reglas más frecuentes", "cuántos intentos de login fallidos por hora", "ips de origen más activas",
+        "número de alertas por agente", "how many events per day", "top rules by alert count", "qué reglas se disparan más",
+        "cuántas veces saltó la regla 5710", "cantidad de eventos por nivel", "total de alertas de esta semana",
+    ],
+    "agent": [
+        "qué le pasa al agente web01", "analiza el servidor db01", "qué eventos tiene el host agent-003",
+        "revisa la actividad del equipo srv-mail", "hay algo raro en el agente 004", "detalle de alertas del servidor web",
+        "qué ha ocurrido en la máquina de base de datos", "what happened on host web01", "investiga el agente del firewall",
+        "muéstrame los eventos de ese equipo", "cómo está el agente de producción",
+    ],
+}
+ROUTER_INTENT_LABELS = {
+    "general": "general", "logs": "análisis de logs", "aggregate": "consulta agregada", "agent": "detalle por agente",
+}
+_ROUTER_WORD_RE = re.compile(r"[a-z0-9][\w.-]*")
+
+
+def router_features(text):
+    """Palabras y trigramas de caracteres (sin acentos); los trigramas toleran
+    variaciones como plurales, conjugaciones o erratas"""
+    features = Counter()
+    for word in _ROUTER_WORD_RE.findall(fold_text(text)):
+        features["w:" + word] += 1.0
+        padded = f" {word} "
+        for i in range(len(padded) - 2):
+            features[padded[i:i + 3]] += 0.5
+    return features
+
+
+def normalize_vector(vector):
+    norm = math.sqrt(sum(value * value for value in vector.values())) or 1.0
+    return {key: value / norm for key, value in vector.items()}
+
+
+class QuestionRoute:
+    """Intención elegida, confianza (margen sobre la segunda) y agentes mencionados"""
+
+    __slots__ = ("intent", "confidence", "scores", "agents")
+
+    def __init__(self, intent, confidence, scores, agents=()):
+        self.intent = intent
+        self.confidence = confidence
+        self.scores = scores
+        self.agents = list(agents)
+
+    @property
+    def uses_logs(self):
+        return self.intent in LOG_INTENTS
+
+    def describe(self):
+        text = f"{ROUTER_INTENT_LABELS[self.intent]} (confianza {self.confidence:.2f})"
+        if self.agents:
+            text += f", agentes {', '.join(self.agents)}"
+        return text
+
+
+class QuestionRouter:
+    """Clasificador de preguntas por similitud coseno con el centroide de cada intención.
+
+    Las preguntas de ejemplo se vectorizan con palabras y trigramas ponderados
+    por IDF; clasificar una pregunta son unas decenas de productos sobre
+    diccionarios dispersos (microsegundos en CPU). Si la confianza es baja se
+    recurre a las palabras clave de is_wazuh_related_question.
+    """
+
+    def __init__(self, examples=ROUTER_EXAMPLES, min_confidence=ROUTER_MIN_CONFIDENCE):
+        self.min_confidence = min_confidence
+        documents = {intent: [router_features(text) for text in texts] for intent, texts in examples.items()}
+        total = sum(len(features) for features in documents.values())
+        frequency = Counter(key for features in documents.values() for vector in features for key in vector)
+        self.idf = {key: math.log(1 + total / count) for key, count in frequency.items()}
+        self.centroids = {}
+        for intent, features in documents.items():
+            centroid = Counter()
+            for vector in features:
+                for key, value in self.vectorize(vector).items():
+                    centroid[key] += value / len(features)
+            self.centroids[intent] = normalize_vector(centroid)
+
+    def vectorize(self, features):
+        # Los términos que no aparecen en los ejemplos no ayudan a decidir
+        return normalize_vector({key: value * self.idf[key] for key, value in features.items() if key in self.idf})
+
+    def mentioned_agents(self, question, known_agents):
+        words = set(_ROUTER_WORD_RE.findall(fold_text(question)))
+        return [agent for agent in known_agents if fold_text(agent) in words]
+
+    def route(self, question, known_agents=()):
+        features = router_features(question)
+        vector = self.vectorize(features)
+        scores = {
+            intent: sum(value * centroid.get(key, 0.0) for key, value in vector.items())
+            for intent, centroid in self.centroids.items()
+        }
+        intent = max(scores, key=scores.get)
+        # La confianza es el margen frente a la mejor intención del otro lado
+        # (general frente a las que consultan los logs)
+        rivals = [value for name, value in scores.items() if (name in LOG_INTENTS) != (intent in LOG_INTENTS)]
+        confidence = scores[intent] - max(rivals, default=0.0)
+        agents = self.mentioned_agents(question, known_agents)
+        if agents:
+            # Nombrar un agente conocido es la señal más fiable de que se pregunta por los logs
+            intent = "aggregate" if intent == "aggregate" else "agent"
+            confidence = max(confidence, self.min_confidence)
+        elif QUERY_IP_RE.search(question) and intent == "general":
+            intent, confidence = "logs", self.min_confidence
+        elif confidence < self.min_confidence:
+            intent = "logs" if is_wazuh_related_question(question) else "general"
+        if intent == "agent" and not agents:
+            intent = "logs"  # Sin agente reconocido no hay nada que filtrar
+        return QuestionRoute(intent, confidence, scores, agents)
+
+
+question_router = QuestionRouter()
+
+
+def initialize_assistant_context(logs_context=""):
+    base_context = """You are a security analyst performing threat hunting.
+Your task is to analyze logs from Wazuh. You have access to the logs provided in the context.
+The objective is to identify potential security threats or any other needs from the user.
+All queries should be interpreted as asking about security events, patterns or other request from the user using the provided logs. response in spanish"""
+    
+    if logs_context:
+        return f"{base_context}\n\nAvailable logs:\n{logs_context}"
+    return base_context
+
+def get_general_context():
+    """Contexto general para preguntas no relacionadas con Wazuh"""
+    return """You are a helpful AI assistant. You can help with general questions, 
+programming, analysis, and various topics. Be informative, accurate, and helpful. response in spanish"""
+
+# ===== Ventanas de eventos de las sesiones =====
+
+WINDOW_DURATION_RE = re.compile(r"^(\d{1,4})(m|min|h|d)$")
+WINDOW_CLOCK_RE = re.compile(r"^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$")
+WINDOW_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+WINDOW_FILTER_RE = re.compile(r"^(nivel|level|agente|agent|regla|rule|grupo|group)(>=|<=|=)(.+)$")
+WINDOW_UNITS = {"m": 60, "min": 60, "h": 3600, "d": 86400}
+
+
+class LogWindow:
+    """Ventana de eventos de una sesión (/set window): periodo y filtros.
+
+    Hace de clave del snapshot de contexto en lugar del número de días. Una
+    ventana relativa ('2h') se recalcula en cada construcción y sigue
+    recibiendo los eventos nuevos; una absoluta ('ayer 02:00-04:00') es fija.
+    """
+
+    __slots__ = ("label", "duration", "since", "until", "filters")
+
+    def __init__(self, label, duration=None, since=None, until=None, filters=None):
+        self.label = label
+        self.duration = duration
+        self.since = since
+        self.until = until
+        self.filters = filters or {}  # Argumentos de LogFilter: min_level, max_level, agents, rule_ids, groups
+
+    def __eq__(self, other):
+        return isinstance(other, LogWindow) and self.label == other.label
+
+    def __hash__(self):
+        return hash(self.label)
+
+    def __str__(self):
+        return f"ventana {self.label}"
+
+    @property
+    def follows(self):
+        return self.until is None
+
+    def bounds(self):
+        if self.duration:
+            return time.time() - self.duration, None
+        return self.since, self.until
+
+    @property
+    def days(self):
+        """Días de archivo, contando hacia atrás desde hoy, que alcanza la ventana"""
+        since = self.bounds()[0]
+        return max((datetime.now().date() - datetime.fromtimestamp(since).date()).days + 1, 1)
+
+    def log_filter(self, fields=None):
+        since, until = self.bounds()
+        return LogFilter(since=since, until=until, fields=fields, **self.filters)
+
+
+def parse_window_filter(key, operator, value, filters):
+    if key in ("nivel", "level"):
+        low, _, high = value.partition("-")
+        if operator == ">=":
+            filters["min_level"] = int(value)
+        elif operator == "<=":
+            filters["max_level"] = int(value)
+        else:
+            filters["min_level"], filters["max_level"] = int(low), int(high or low)
+        return
+    values = [item for item in value.split(",") if item]
+    name = {"agente": "agents", "agent": "agents", "regla": "rule_ids", "rule": "rule_ids"}.get(key, "groups")
+    filters[name] = sorted(values)
+
+
+def parse_log_window(spec):
+    """Interpreta '/set window <spec>'; lanza ValueError con el motivo.
+
+    Periodos: '2h', '30m', '3d', 'hoy', 'ayer 02:00-04:00', '2024-05-01 10:00-12:00'
+    o '2024-05-01T22:00..2024-05-02T02:00'. Filtros: nivel>=10, nivel=5-9,
+    agente=web01,db01, regla=5710, grupo=sshd.
+    """
+    midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    duration = since = until = time_label = None
+    filters = {}
+    tokens = spec.split()
+    i = 0
+    while i < len(tokens):
+        token, folded = tokens[i], fold_text(tokens[i])
+        i += 1
+        match = WINDOW_FILTER_RE.match(folded)
+        if match:
+            key, operator = match.group(1), match.group(2)
+            try:
+                parse_window_filter(key, operator, token[len(key) + len(operator):], filters)
+            except ValueError:
+                raise ValueError(f"Filtro inválido: '{token}'")
+            continue
+        if time_label:
+            raise ValueError(f"Periodo duplicado o no reconocido: '{token}'")
+        match = WINDOW_DURATION_RE.match(folded)
+        if match:
+            duration = int(match.group(1)) * WINDOW_UNITS[match.group(2)]
+            time_label = folded
+            continue
+        if ".." in folded:
+            try:
+                start, end = (datetime.fromisoformat(part.upper()) for part in folded.split("..", 1))
+            except ValueError:
+                raise ValueError(f"Rango de fechas inválido: '{token}'")
+            since, until = start.timestamp(), end.timestamp()
+            time_label = f"{start:%Y-%m-%d %H:%M}..{end:%Y-%m-%d %H:%M}"
+            continue
+        if folded in ("hoy", "today"):
+            day = midnight
+        elif folded in ("ayer", "yesterday"):
+            day = midnight - timedelta(days=1)
+        elif WINDOW_DATE_RE.match(folded):
+            day = datetime.fromisoformat(folded)
+        else:
+            raise ValueError(f"No se reconoce '{token}'")
+        start, end = day, day + timedelta(days=1)
+        time_label = f"{day:%Y-%m-%d}"
+        clock = WINDOW_CLOCK_RE.match(tokens[i]) if i < len(tokens) else None
+        if not clock and day == midnight:
+            # El día en curso queda abierto y sigue recibiendo los eventos nuevos
+            end = None
+        if clock:
+            i += 1
+            hour1, minute1, hour2, minute2 = map(int, clock.groups())
+            if hour1 > 23 or hour2 > 23 or minute1 > 59 or minute2 > 59:
+                raise ValueError(f"Hora inválida: '{clock.group(0)}'")
+            start = day.replace(hour=hour1, minute=minute1)
+            end = day.replace(hour=hour2, minute=minute2)
+            if end <= start:
+                end += timedelta(days=1)  # 22:00-02:00 cruza la medianoche
+            time_label += f" {start:%H:%M}-{end:%H:%M}"
+        since, until = start.timestamp(), end.timestamp() if end else None
+    if not time_label:
+        raise ValueError("Falta el periodo (p. ej. 2h, ayer o 2024-05-01 10:00-12:00)")
+    if until is not None and since >= until:
+        raise ValueError("El inicio de la ventana debe ser anterior al final")
+    described = LogFilter(**filters).describe() if filters else ""
+    label = f"{time_label} ({described})" if described else time_label
+    return LogWindow(label, duration, since, until, filters)
+
+
+def range_days(key):
+    """Días de archivo de un rango de sesión (número de días o LogWindow)"""
+    return key.days if isinstance(key, LogWindow) else key
+
+
+def describe_range(key):
+    return str(key) if isinstance(key, LogWindow) else f"{key} días"
+
+
+SNAPSHOT_VERSIONS = itertools.count(1)
+SNAPSHOT_IDLE_RANGES = int(os.getenv("SNAPSHOT_IDLE_RANGES", "2"))  # Rangos sin sesiones que se conservan
+
+
+class ContextSnapshot:
+    """Contexto inmutable de un rango de días, compartido por las sesiones.
+
+    El prompt, el LLM y la fuente no cambian nunca: el seguimiento del archivo
+    del día publica una versión nueva con replace(), con un índice de
+    relevancia extendido (EventRanker.extend) y una copia del minero de
+    plantillas. Nadie modifica lo que ve una versión publicada, así que una
+    petición en curso puede seguir leyéndolo.
+    """
+
+    __slots__ = (
+        "version", "created", "days_range", "source", "qa_chain",
+        "general_context", "wazuh_context", "event_ranker", "template_miner",
+    )
+    FIELDS = __slots__[2:]
+
+    def __init__(self, days_range, source, qa_chain, general_context, wazuh_context, event_ranker=None, template_miner=None):
+        values = dict(
+            version=next(SNAPSHOT_VERSIONS), created=time.time(), days_range=days_range, source=source,
+            qa_chain=qa_chain, general_context=general_context, wazuh_context=wazuh_context,
+            event_ranker=event_ranker, template_miner=template_miner,
+        )
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ContextSnapshot es inmutable; usa replace()")
+
+    def replace(self, **changes):
+        values = {name: getattr(self, name) for name in self.FIELDS}
+        values.update(changes)
+        return ContextSnapshot(**values)
+
+    def describe(self):
+        return f"v{self.version}, {describe_range(self.days_range)}, fuente {self.source}, creado {datetime.fromtimestamp(self.created).strftime('%H:%M:%S')}"
+
+
+class SnapshotRegistry:
+    """Snapshot vigente por rango de días.
 
-    try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        print(f"🔑 Loading private key from {ssh_private_key}")
-        privateKey = paramiko.RSAKey.from_private_key_file(ssh_private_key)
-        print(f"🔑 Private key loaded successfully")
-        ssh.connect(host, username=user, pkey=privateKey, timeout=20)
-        print(f"🔑 SSH connection established")
-        sftp = ssh.open_sftp()
-
-        for i in range(past_days):
-            day = today - timedelta(days=i)
-            year = day.year
-            month_name = day.strftime("%b")
-            day_num = day.strftime("%d")
-            base_path = f"/var/ossec/logs/archives/{year}/{month_name}"
-            json_path = f"{base_path}/ossec-archive-{day_num}.json"
-            gz_path = f"{base_path}/ossec-archive-{day_num}.json.gz"
-
-            remote_file = None
-            try:
-                if sftp.stat(json_path).st_size > 0:
-                    remote_file = sftp.open(json_path, 'r')
-                elif sftp.stat(gz_path).st_size > 0:
-                    remote_file = gzip.GzipFile(fileobj=sftp.open(gz_path, 'rb'))
-            except IOError:
-                print(f"⚠️ Remote log not found or unreadable: {json_path} / {gz_path}")
-                continue
+    Las sesiones fijan su rango (días o LogWindow); las que coinciden
+    comparten el mismo snapshot. Los rangos que ya no usa nadie se conservan (LRU) hasta
+    SNAPSHOT_IDLE_RANGES, salvo el rango por defecto, que nunca se descarta.
+    """
 
-            if remote_file:
-                try:
-                    for line in remote_file:
-                        if isinstance(line, bytes):
-                            line = line.decode('utf-8', errors='ignore')
-                        if line.strip():
-                            try:
-                                log = json.loads(line.strip())
-                                logs.append(log)
-                            except json.JSONDecodeError:
-                                print(f"⚠️ Skipping invalid JSON line from remote file.")
-                except Exception as e:
-                    print(f"⚠️ Error reading remote file: {e}")
-        sftp.close()
-        ssh.close()
-    except Exception as e:
-        print(f"❌ Remote connection failed: {e}")
-    return logs
+    def __init__(self, max_idle=SNAPSHOT_IDLE_RANGES):
+        self.max_idle = max_idle
+        self.current = OrderedDict()  # días -> ContextSnapshot
+        self.pins = Counter()  # días -> sesiones
+        # El event loop y los hilos (construcciones, seguimiento) lo comparten;
+        # solo se toma para leer o cambiar referencias, nunca durante trabajo largo
+        self.lock = threading.RLock()
 
-def load_logs_from_days(past_days=7):
-    if remote_host:
-        return load_logs_from_remote(remote_host, ssh_username, ssh_private_key, past_days)
+    def get(self, past_days):
+        with self.lock:
+            snapshot = self.current.get(past_days)
+            if snapshot is not None:
+                self.current.move_to_end(past_days)
+            return snapshot
 
-    logs = []
-    today = datetime.now()
-    for i in range(past_days):
-        day = today - timedelta(days=i)
-        year = day.year
-        month_name = day.strftime("%b")
-        day_num = day.strftime("%d")
-
-        json_path = f"/var/ossec/logs/archives/{year}/{month_name}/ossec-archive-{day_num}.json"
-        gz_path = f"/var/ossec/logs/archives/{year}/{month_name}/ossec-archive-{day_num}.json.gz"
-
-        file_path = None
-        open_func = None
-
-        if os.path.exists(json_path) and os.path.getsize(json_path) > 0:
-            file_path = json_path
-            open_func = open
-        elif os.path.exists(gz_path) and os.path.getsize(gz_path) > 0:
-            file_path = gz_path
-            open_func = gzip.open
-        else:
-            print(f"⚠️ Log file missing or empty: {json_path} / {gz_path}")
-            continue
+    def snapshots(self):
+        with self.lock:
+            return list(self.current.values())
 
-        try:
-            with open_func(file_path, 'rt', encoding='utf-8', errors='ignore') as f:
-                for line in f:
-                    if line.strip():
-                        try:
-                            log = json.loads(line.strip())
-                            logs.append(log)
-                        except json.JSONDecodeError:
-                            print(f"⚠️ Skipping invalid JSON line in {file_path}")
-        except Exception as e:
-            print(f"⚠️ Error reading {file_path}: {e}")
-    return logs
+    def publish(self, snapshot):
+        with self.lock:
+            self.current[snapshot.days_range] = snapshot
+            self.current.move_to_end(snapshot.days_range)
+            self._evict()
 
+    def replace(self, old, snapshot):
+        """Publica snapshot solo si old sigue vigente (no lo sustituyó una recarga
+        ni se descartó); devuelve si se publicó"""
+        with self.lock:
+            if self.current.get(old.days_range) is not old:
+                return False
+            self.current[snapshot.days_range] = snapshot
+            return True
 
-def create_simple_context(logs):
-    """Crea un contexto simple sin embeddings"""
-    context_parts = []
-    for i, log in enumerate(logs[:100]):  # Limitar a 100 logs para no sobrecargar
-        log_text = log.get('full_log', '')
-        if log_text:
-            context_parts.append(f"Log {i+1}: {log_text[:200]}...")  # Limitar longitud
-    
-    return "\n\n".join(context_parts)
+    def pin(self, past_days):
+        with self.lock:
+            self.pins[past_days] += 1
 
-def is_wazuh_related_question(question):
-    """Detecta si la pregunta está relacionada con Wazuh/logs de seguridad"""
-    wazuh_keywords = [
-        'wazuh', 'logs', 'security', 'threat', 'alert', 'event', 'attack',
-        'intrusion', 'firewall', 'antivirus', 'malware', 'vulnerability',
-        'breach', 'incident', 'monitoring', 'detection', 'siem',
-        'ossec', 'archives', 'security logs', 'threat hunting',
-        'security events', 'alerts', 'incidents', 'attacks',
-        'log analysis', 'security analysis', 'threat analysis'
-    ]
-    
-    question_lower = question.lower()
-    return any(keyword in question_lower for keyword in wazuh_keywords)
+    def unpin(self, past_days):
+        with self.lock:
+            self.pins[past_days] -= 1
+            if self.pins[past_days] <= 0:
+                del self.pins[past_days]
+            self._evict()
 
+    def _evict(self):
+        idle = [days for days in self.current if days not in self.pins and days != days_range]
+        for days in idle[:max(len(idle) - self.max_idle, 0)]:
+            print(f"🗑️ Dropping idle context snapshot for {describe_range(days)}")
+            del self.current[days]
 
-def initialize_assistant_context(logs_context=""):
-    base_context = """You are a security analyst performing threat hunting.
-Your task is to analyze logs from Wazuh. You have access to the logs provided in the context.
-The objective is to identify potential security threats or any other needs from the user.
-All queries should be interpreted as asking about security events, patterns or other request from the user using the provided logs. response in spanish"""
-    
-    if logs_context:
-        return f"{base_context}\n\nAvailable logs:\n{logs_context}"
-    return base_context
+    def summary(self):
+        with self.lock:
+            return ", ".join(
+                f"{describe_range(days)} (v{snapshot.version}, {self.pins.get(days, 0)} sesiones)"
+                for days, snapshot in self.current.items()
+            ) or "ninguno"
 
-def get_general_context():
-    """Contexto general para preguntas no relacionadas con Wazuh"""
-    return """You are a helpful AI assistant. You can help with general questions, 
-programming, analysis, and various topics. Be informative, accurate, and helpful. response in spanish"""
 
-def setup_chain(past_days=7):
-    global qa_chain, context, days_range, wazuh_context, general_context
-    days_range = past_days
-    print(f"🔄 Initializing QA chain with logs from past {past_days} days...")
-    logs = load_logs_from_days(past_days)
+context_registry = SnapshotRegistry()
+
+
+def build_context_snapshot(past_days=7, on_progress=None):
+    """Construye el snapshot de contexto de un rango sin publicarlo (se ejecuta en un hilo).
+
+    on_progress recibe mensajes cortos de avance para el cliente que pidió la recarga.
+    """
+    progress = on_progress or (lambda message: None)
+    if isinstance(past_days, LogWindow):
+        log_filter = past_days.log_filter(CONTEXT_FIELDS)
+        print(f"🔄 Initializing QA chain with logs from window {past_days.label}...")
+        progress(f"Cargando eventos de la {past_days}...")
+    else:
+        log_filter = LogFilter(fields=CONTEXT_FIELDS)
+        print(f"🔄 Initializing QA chain with logs from past {past_days} days...")
+        progress(f"Cargando eventos de los últimos {past_days} días...")
+    following = ARCHIVE_FOLLOW_INTERVAL > 0 and (not isinstance(past_days, LogWindow) or past_days.follows)
+    # Candidatos para la selección por relevancia, solo con los campos del contexto:
+    # los eventos más recientes de cada día del rango, repartidos por igual. En
+    # seguimiento se deja sitio a los eventos nuevos antes de compactar el ranker
+    pool_size = RANKING_POOL_SIZE * 3 // 4 if following else RANKING_POOL_SIZE
+    logs = []
+    with LOG_LOAD_SECONDS.time():
+        for log in iter_indexed_logs(range_days(past_days), log_filter, records=True, max_rows=pool_size):
+            logs.append(log)
+            if len(logs) % 5000 == 0:
+                progress(f"{len(logs)} eventos cargados...")
     
     # CONFIGURACIÓN MEJORADA DE OLLAMA
     llm = ChatOllama(
@@ -212,38 +3748,532 @@ def setup_chain(past_days=7):
         base_url=OLLAMA_BASE_URL,
         temperature=0.1,
         timeout=60,  # Timeout más largo
-        num_predict=512  # Limitar tokens para evitar timeouts
+        num_predict=512,  # Limitar tokens para evitar timeouts
+        num_ctx=OLLAMA_NUM_CTX,  # Fijo: cambiarlo descarta el KV cache del modelo
+        keep_alive=OLLAMA_KEEP_ALIVE  # Mantener el modelo (y su KV cache) cargado
     )
-    
     # Crear contexto general
     general_context = get_general_context()
+    source_name = remote_host or LocalArchiveSource.name
     
     if not logs:
         print("❌ No logs found. Using general context only.")
-        wazuh_context = initialize_assistant_context()
-    else:
-        print(f"✅ {len(logs)} logs loaded from the last {past_days} days.")
-        print("📦 Creating simple context without embeddings...")
-        
-        # Crear contexto simple sin embeddings
-        logs_context = create_simple_context(logs)
-        wazuh_context = initialize_assistant_context(logs_context)
-    
-    # Crear una cadena simple sin vectorstore
-    qa_chain = llm
+        return ContextSnapshot(past_days, source_name, llm, general_context, initialize_assistant_context())
+
+    # Pone al día el índice (solo lo nuevo) y da el total sin decodificar JSON
+    progress("Actualizando el índice de archivos...")
+    total_logs = count_indexed_logs(range_days(past_days), log_filter.since, log_filter.until)
+    print(f"✅ {total_logs} logs indexed in {describe_range(past_days)}, {len(logs)} candidates for context.")
+    if following:
+        # Arranca el seguimiento; del archivo del día solo se añade lo posterior
+        # al último candidato, que ya incluye los eventos recientes del índice
+        refresh_followed_context()
+        newest = max((parse_timestamp(log.get('timestamp')) or 0.0 for log in logs), default=0.0)
+        with archive_follower.lock:
+            recent = list(archive_follower.recent)
+        logs += [
+            log for log in recent
+            if (parse_timestamp(log.get('timestamp')) or 0.0) > newest and log_filter.matches(log)
+        ]
+    # Las plantillas cubren todo el rango: se minan al indexar cada día
+    miner = mine_index_templates(range_days(past_days), log_filter)
+    print(f"🧩 {len(miner.templates)} log templates mined from {miner.total} events")
+    progress(f"{len(miner.templates)} plantillas de {miner.total} eventos; construyendo el índice de relevancia...")
+    # Prefijo estable (instrucciones + plantillas): Ollama reutiliza su KV cache
+    # entre preguntas; los eventos relevantes van en el mensaje de cada pregunta
+    templates_context = create_template_context(miner, int(CONTEXT_TOKEN_BUDGET * TEMPLATE_BUDGET_SHARE))
+    wazuh_context = initialize_assistant_context(templates_context or create_simple_context(logs))
+    if get_template_vectors() is not None:
+        progress("Calculando embeddings de las plantillas nuevas...")
+        print(f"🧠 {embed_templates(miner)} new log templates embedded ({template_vectors.summary()})")
+    print("🔎 Building relevance index over candidate logs...")
+    # Cada evento se asocia a su plantilla (similitud semántica y deduplicación)
+    ranker = EventRanker(miner=miner)
+    return ContextSnapshot(
+        past_days, source_name, llm, general_context, wazuh_context,
+        event_ranker=ranker.add(logs), template_miner=miner
+    )
+
+
+def build_and_publish(past_days=7, on_progress=None):
+    """Construye y publica el snapshot de un rango, fuera del event loop"""
+    with CONTEXT_BUILD_SECONDS.time():
+        snapshot = build_context_snapshot(past_days, on_progress)
+    context_registry.publish(snapshot)
+    return snapshot
+
+
+def setup_chain(past_days=7):
+    build_and_publish(past_days)
     print("✅ QA chain initialized successfully (Ollama only).")
     return True
 
 
-def get_stats(logs):
-    total_logs = len(logs)
-    dates = [datetime.strptime(log.get('timestamp', '')[:10], "%Y-%m-%d") for log in logs if 'timestamp' in log and log.get('timestamp')]
-    date_range = ""
-    if dates:
-        earliest = min(dates).strftime("%Y-%m-%d")
-        latest = max(dates).strftime("%Y-%m-%d")
-        date_range = f" from {earliest} to {latest}"
-    return f"Logs loaded: {total_logs}{date_range}"
+class ContextRebuilder:
+    """Construye snapshots en un hilo sin bloquear el event loop.
+
+    Hay como mucho una construcción por rango: las peticiones que llegan
+    mientras se construye un rango se unen a ella y reciben su avance.
+    Rangos distintos se construyen en paralelo.
+    """
+
+    def __init__(self):
+        self.jobs = {}  # días -> (tarea, [(future, on_progress)])
+
+    @property
+    def busy(self):
+        return sorted(self.jobs, key=str)
+
+    async def rebuild(self, past_days, on_progress=None):
+        """Espera a que haya un snapshot nuevo de past_days publicado; devuelve si tuvo éxito"""
+        future = asyncio.get_running_loop().create_future()
+        if past_days in self.jobs:
+            self.jobs[past_days][1].append((future, on_progress))
+        else:
+            waiters = [(future, on_progress)]
+            self.jobs[past_days] = (asyncio.create_task(self._run(past_days, waiters)), waiters)
+        return await asyncio.shield(future)
+
+    async def acquire(self, past_days, on_progress=None):
+        """Snapshot vigente de past_days, construyéndolo solo si no existe"""
+        snapshot = context_registry.get(past_days)
+        if snapshot is None and await self.rebuild(past_days, on_progress):
+            snapshot = context_registry.get(past_days)
+        return snapshot
+
+    async def _run(self, past_days, waiters):
+        loop = asyncio.get_running_loop()
+
+        def dispatch(message):
+            for future, on_progress in waiters:
+                if on_progress and not future.done():
+                    asyncio.create_task(on_progress(message))
+
+        def progress(message):
+            loop.call_soon_threadsafe(dispatch, message)
+
+        try:
+            snapshot = await asyncio.to_thread(build_and_publish, past_days, progress)
+            print(f"✅ Context snapshot v{snapshot.version} ready ({describe_range(past_days)})")
+            success = True
+        except Exception as e:
+            print(f"❌ Error rebuilding context: {e}")
+            traceback.print_exc()
+            success = False
+        finally:
+            del self.jobs[past_days]
+        for future, _ in waiters:
+            if not future.done():
+                future.set_result(success)
+
+
+context_rebuilder = ContextRebuilder()
+
+
+class IndexStats:
+    """Agregados de un rango de días sumando los de cada índice diario.
+
+    Con filas seleccionadas (ventana o filtros de la sesión) los agregados
+    del día se recalculan leyendo solo las columnas necesarias.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.parse_errors = 0
+        self.earliest = self.latest = None
+        self.days = {}
+        self.hours = [0] * 24
+        self.levels = Counter()
+        self.counts = {name: Counter() for name in STATS_EXACT_COLUMNS}
+        self.srcips = SpaceSaving()
+
+    def add(self, day_index, rows=None):
+        meta = day_index.meta
+        stats, total = meta["stats"], meta["rows"]
+        if rows is None:
+            self.parse_errors += meta["parse_errors"]
+        else:
+            stats, total = empty_day_stats(), len(rows)
+            columns = {}
+            for name in ("timestamp", "rule_level", "srcip", *STATS_EXACT_COLUMNS):
+                values = day_index.column(name)
+                columns[name] = [values[i] for i in rows]
+            accumulate_day_stats(stats, columns, meta["vocab"])
+        self.total += total
+        if stats["first"]:
+            self.earliest = min(self.earliest or stats["first"], stats["first"])
+            self.latest = max(self.latest or stats["last"], stats["last"])
+            day = datetime.fromtimestamp(stats["first"]).strftime("%Y-%m-%d")
+            self.days[day] = self.days.get(day, 0) + total
+        self.hours = [a + b for a, b in zip(self.hours, stats["hours"])]
+        self.levels.update({int(level): count for level, count in stats["levels"].items()})
+        for name in STATS_EXACT_COLUMNS:
+            vocab = meta["vocab"][name]
+            self.counts[name].update({vocab[code]: count for code, count in enumerate(stats["counts"][name]) if count})
+        self.srcips.merge(SpaceSaving.from_dict(stats["srcip"]))
+        return self
+
+    def summary(self):
+        date_range = ""
+        if self.earliest is not None:
+            earliest = datetime.fromtimestamp(self.earliest).strftime("%Y-%m-%d")
+            latest = datetime.fromtimestamp(self.latest).strftime("%Y-%m-%d")
+            date_range = f" from {earliest} to {latest}"
+        return f"Logs loaded: {self.total}{date_range}"
+
+    def format(self, top=STATS_TOP_K):
+        def ranking(items):
+            return "\n".join(f"  - {value or '(vacío)'}: {count}" for value, count in items) or "  - (sin datos)"
+
+        lines = [self.summary()]
+        if self.parse_errors:
+            lines.append(f"Líneas no válidas: {self.parse_errors}")
+        lines.append("\n**Eventos por día:**")
+        lines.append(ranking(sorted(self.days.items())))
+        busiest = sorted(range(24), key=lambda hour: self.hours[hour], reverse=True)[:3]
+        lines.append("\n**Eventos por hora:**")
+        lines.append("  " + " ".join(f"{hour:02d}h:{count}" for hour, count in enumerate(self.hours) if count))
+        lines.append(f"  - Horas con más actividad: {', '.join(f'{hour:02d}h' for hour in busiest if self.hours[hour])}")
+        lines.append("\n**Eventos por nivel de regla:**")
+        lines.append(ranking(sorted(self.levels.items(), reverse=True)))
+        lines.append(f"\n**Top {top} reglas:**")
+        lines.append(ranking(self.counts["rule_id"].most_common(top)))
+        lines.append(f"\n**Top {top} agentes:**")
+        lines.append(ranking(self.counts["agent"].most_common(top)))
+        lines.append(f"\n**Top {top} IPs de origen:**")
+        lines.append("\n".join(
+            f"  - {ip}: {count}" + (f" (±{error})" if error else "")
+            for ip, (count, error) in self.srcips.top(top)
+        ) or "  - (sin datos)")
+        return "\n".join(lines)
+
+
+def get_index_stats(past_days=7, log_filter=None):
+    """Estadísticas desde los agregados del índice, sin leer columnas ni JSON.
+
+    Con log_filter (la ventana de la sesión) se cuentan solo las filas que
+    cumplen su periodo, nivel, agentes y reglas.
+    """
+    stats = IndexStats()
+    since, until = (log_filter.since, log_filter.until) if log_filter else (None, None)
+    for day_index in iter_index_days(past_days, since=since, until=until):
+        stats.add(day_index, select_index_rows(day_index, log_filter) if log_filter else None)
+    return stats
+
+
+STREAM_FLUSH_INTERVAL = 0.05  # Segundos mínimos entre frames de tokens
+
+
+async def stream_llm_response(llm, message, on_chunk):
+    """Genera la respuesta con astream y entrega los tokens agrupados a on_chunk.
+
+    on_chunk es una corrutina que recibe el texto pendiente; si devuelve False
+    (cliente desconectado) se corta la generación. Devuelve el texto completo.
+    """
+    parts = []
+    pending = []
+    last_flush = 0.0  # El primer token sale sin esperar
+    async for chunk in llm.astream(message):
+        text = chunk.content if hasattr(chunk, 'content') else str(chunk)
+        if not text:
+            continue
+        parts.append(text)
+        pending.append(text)
+        now = time.perf_counter()
+        if now - last_flush >= STREAM_FLUSH_INTERVAL:
+            if not await on_chunk("".join(pending)):
+                raise WebSocketDisconnect()
+            pending = []
+            last_flush = now
+    if pending and not await on_chunk("".join(pending)):
+        raise WebSocketDisconnect()
+    return "".join(parts)
+
+
+# ===== Cache de respuestas =====
+
+RESPONSE_CACHE_TTL = int(os.getenv("CACHE_TTL", "3600"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+# Modelo de embeddings de Ollama para preguntas casi iguales (vacío = solo coincidencia exacta)
+RESPONSE_CACHE_EMBEDDING_MODEL = os.getenv("RESPONSE_CACHE_EMBEDDING_MODEL", "")
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.95"))
+
+
+def normalize_question(question):
+    """Minúsculas, sin acentos, sin signos de puntuación y espacios simples"""
+    text = unicodedata.normalize("NFKD", question.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class ResponseCache:
+    """Cache LRU con TTL de respuestas del LLM.
+
+    La clave es el hash de modelo, modo, versión del contexto (o resultado
+    de la consulta estructurada), historial de la conversación y pregunta
+    normalizada; con un modelo de embeddings configurado también se
+    reutilizan respuestas a preguntas casi idénticas del mismo ámbito.
+    """
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # clave -> (ámbito, respuesta, embedding, creada)
+        self.embeddings = None
+        if RESPONSE_CACHE_EMBEDDING_MODEL:
+            from langchain_ollama import OllamaEmbeddings
+            self.embeddings = OllamaEmbeddings(model=RESPONSE_CACHE_EMBEDDING_MODEL, base_url=OLLAMA_BASE_URL)
+
+    def scope(self, mode, snapshot, history=(), result=None):
+        # Las respuestas generales no dependen de los logs cargados
+        version = snapshot.version if mode != "general" else 0
+        if result is not None:
+            # Consultas estructuradas: leen el índice vivo, no el snapshot
+            version = hashlib.sha256(result.encode("utf-8")).hexdigest()[:16]
+        scope = f"{OLLAMA_MODEL}|{mode}|{version}"
+        if history:
+            # Una continuación ("¿y ayer?") depende de los turnos anteriores de la sesión
+            digest = hashlib.sha256()
+            for message in history:
+                digest.update(f"{type(message).__name__}\x00{message.content}\x00".encode("utf-8"))
+            scope += f"|{digest.hexdigest()[:16]}"
+        return scope
+
+    def key(self, scope, question):
+        return hashlib.sha256(f"{scope}|{normalize_question(question)}".encode("utf-8")).hexdigest()
+
+    async def embed(self, question):
+        if not self.embeddings:
+            return None
+        try:
+            return await self.embeddings.aembed_query(normalize_question(question))
+        except Exception as e:
+            print(f"⚠️ Error calculando embedding para el cache: {e}")
+            return None
+
+    def _expire(self):
+        now = time.time()
+        for key in [key for key, entry in self.entries.items() if now - entry[3] > self.ttl]:
+            del self.entries[key]
+
+    def get(self, key, scope, embedding=None):
+        self._expire()
+        entry = self.entries.get(key)
+        if entry is None and embedding is not None:
+            best_score = RESPONSE_CACHE_SIMILARITY
+            for candidate_key, candidate in self.entries.items():
+                if candidate[0] != scope or candidate[2] is None:
+                    continue
+                score = cosine_similarity(embedding, candidate[2])
+                if score >= best_score:
+                    key, entry, best_score = candidate_key, candidate, score
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, scope, answer, embedding=None):
+        self.entries[key] = (scope, answer, embedding, time.time())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+response_cache = ResponseCache()
+
+
+# ===== Planificador de peticiones al LLM =====
+
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "2"))  # Peticiones simultáneas a Ollama
+
+
+class LLMTicket:
+    __slots__ = ("future", "on_position", "position")
+
+    def __init__(self, future, on_position):
+        self.future = future
+        self.on_position = on_position
+        self.position = None
+
+
+class LLMScheduler:
+    """Cola compartida de peticiones al LLM con reparto justo entre sesiones.
+
+    Como mucho max_in_flight peticiones llegan a Ollama a la vez; el resto
+    espera en una cola por sesión que se atiende por turnos (round-robin),
+    de modo que una sesión con muchas preguntas no bloquea a las demás.
+    """
+
+    def __init__(self, max_in_flight=LLM_MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.queues = OrderedDict()  # sesión -> deque[LLMTicket]
+
+    def _waiting_order(self):
+        """Orden en que se concederían los turnos con el estado actual"""
+        queues = [list(queue) for queue in self.queues.values()]
+        order = []
+        for round_index in range(max((len(queue) for queue in queues), default=0)):
+            order.extend(queue[round_index] for queue in queues if round_index < len(queue))
+        return order
+
+    def _notify_positions(self):
+        for position, ticket in enumerate(self._waiting_order(), start=1):
+            if ticket.on_position and ticket.position != position:
+                ticket.position = position
+                asyncio.create_task(ticket.on_position(position))
+
+    def _dispatch(self):
+        while self.in_flight < self.max_in_flight and self.queues:
+            session_id, queue = next(iter(self.queues.items()))
+            ticket = queue.popleft()
+            if queue:
+                self.queues.move_to_end(session_id)
+            else:
+                del self.queues[session_id]
+            if ticket.future.done():
+                continue
+            self.in_flight += 1
+            ticket.future.set_result(True)
+        self._notify_positions()
+
+    def _release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _discard(self, session_id, ticket):
+        queue = self.queues.get(session_id)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self.queues[session_id]
+        self._notify_positions()
+
+    @property
+    def waiting(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def run(self, session_id, factory, on_position=None):
+        """Espera turno y ejecuta factory(); si se cancela libera la cola o el turno"""
+        ticket = LLMTicket(asyncio.get_running_loop().create_future(), on_position)
+        self.queues.setdefault(session_id, deque()).append(ticket)
+        self._dispatch()
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                self._release()  # Se concedió el turno justo al cancelar
+            else:
+                ticket.future.cancel()
+                self._discard(session_id, ticket)
+            raise
+        try:
+            return await factory()
+        finally:
+            self._release()
+
+
+llm_scheduler = LLMScheduler()
+
+
+# ===== Memoria de la conversación =====
+
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "1500"))  # Tokens de historial por pregunta
+MEMORY_MAX_TURNS = int(os.getenv("MEMORY_MAX_TURNS", "6"))  # Turnos que se guardan literales
+MEMORY_SUMMARY_TOKENS = int(os.getenv("MEMORY_SUMMARY_TOKENS", "300"))
+
+SUMMARY_PROMPT = (
+    "Resume la conversación entre un usuario y un asistente de seguridad Wazuh. "
+    "Conserva agentes, IPs, usuarios, reglas, fechas y conclusiones relevantes. "
+    f"Responde solo con el resumen, en menos de {MEMORY_SUMMARY_TOKENS * 3 // 4} palabras."
+)
+
+
+class ConversationMemory:
+    """Historial de una sesión acotado por tokens.
+
+    Los turnos recientes se guardan literales; los que no caben en el
+    presupuesto pasan a un resumen acumulado que el LLM actualiza en segundo
+    plano, sin retrasar la siguiente respuesta.
+    """
+
+    def __init__(self, session_id, token_budget=MEMORY_TOKEN_BUDGET, max_turns=MEMORY_MAX_TURNS):
+        self.session_id = session_id
+        self.token_budget = token_budget
+        self.max_turns = max_turns
+        self.turns = deque()  # (HumanMessage, AIMessage, tokens)
+        self.tokens = 0
+        self.summary = ""
+        self.pending = []  # Turnos retirados que faltan por resumir
+        self.summary_task = None
+
+    @property
+    def summary_tokens(self):
+        return estimate_tokens(self.summary) if self.summary else 0
+
+    def messages(self):
+        """Resumen (si existe) y turnos literales, listos para el prompt"""
+        messages = []
+        if self.summary:
+            messages.append(SystemMessage(content=f"Resumen de la conversación anterior:\n{self.summary}"))
+        for human, ai, _ in self.turns:
+            messages.extend([human, ai])
+        return messages
+
+    def add(self, question, answer, llm=None):
+        tokens = estimate_tokens(question) + estimate_tokens(answer)
+        self.turns.append((HumanMessage(content=question), AIMessage(content=answer), tokens))
+        self.tokens += tokens
+        # Siempre queda al menos el último turno literal
+        while len(self.turns) > 1 and (
+            len(self.turns) > self.max_turns or self.tokens + self.summary_tokens > self.token_budget
+        ):
+            human, ai, tokens = self.turns.popleft()
+            self.tokens -= tokens
+            self.pending.append((human, ai))
+        if self.pending and llm and (self.summary_task is None or self.summary_task.done()):
+            self.summary_task = asyncio.create_task(self._summarize(llm))
+
+    async def _summarize(self, llm):
+        while self.pending:
+            turns, self.pending = self.pending, []
+            transcript = "\n".join(f"Usuario: {human.content}\nAsistente: {ai.content}" for human, ai in turns)
+            prompt = [
+                SystemMessage(content=SUMMARY_PROMPT),
+                HumanMessage(content=f"Resumen actual:\n{self.summary or '(vacío)'}\n\nNuevos turnos:\n{transcript}")
+            ]
+            try:
+                response = await llm_scheduler.run(self.session_id, lambda: llm.ainvoke(prompt))
+                summary = (response.content if hasattr(response, 'content') else str(response)).strip()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Error resumiendo el historial: {e}")
+                # Sin LLM se conservan al menos las preguntas
+                summary = "\n".join([self.summary] + [f"- {human.content}" for human, _ in turns]).strip()
+            # Recortar por el principio: lo más reciente es lo más útil
+            self.summary = summary[-MEMORY_SUMMARY_TOKENS * 4:]
+
+    def clear(self):
+        self.close()
+        self.turns.clear()
+        self.tokens = 0
+        self.summary = ""
+        self.pending = []
+
+    def close(self):
+        if self.summary_task and not self.summary_task.done():
+            self.summary_task.cancel()
+        self.summary_task = None
 
 
 # ===== API Endpoints =====
@@ -253,6 +4283,11 @@ async def get():
     return {"message": "Health Check", "ollama_url": OLLAMA_BASE_URL}
 
 
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 # ========= WebSocket Chat MEJORADO =========
 
 
@@ -262,18 +4297,25 @@ async def get():
 
 @app.websocket("/ws/chat")
 async def websocket_endpoint(websocket: WebSocket):
-    global qa_chain, context, wazuh_context, general_context, days_range
-    
     # Variables para tracking del estado
     connection_start = datetime.now()
+    reader_task = None
+    reload_task = None
+    memory = None
+    session_days = None
     messages_processed = 0
     last_activity = datetime.now()
+    WEBSOCKETS_ACTIVE.inc()
     
     try:
         await websocket.accept()
         print(f"🔗 Nueva conexión WebSocket establecida: {connection_start}")
+        session_id = id(websocket)
         
-        chat_history = []
+        memory = ConversationMemory(session_id)
+        # Rango propio de la sesión; el snapshot se comparte con las de igual rango
+        session_days = days_range
+        context_registry.pin(session_days)
         
         # Función helper para enviar mensajes con manejo de errores
         async def send_safe_message(message_data: dict, close_on_fail: bool = False):
@@ -290,15 +4332,30 @@ async def websocket_endpoint(websocket: WebSocket):
                         pass
                 return False
         
+        async def send_rebuild_progress(message):
+            await send_safe_message({
+                "role": "system",
+                "message": f"⏳ {message}",
+                "status": "reload_progress"
+            })
+        
         # Función para diagnosticar el estado del sistema
         async def system_diagnostic():
+            snapshot = context_registry.get(session_days)
             diagnostic = {
-                "qa_chain_status": "✅ Activo" if qa_chain else "❌ Inactivo",
-                "wazuh_context_status": "✅ Cargado" if wazuh_context else "❌ No cargado",
-                "general_context_status": "✅ Cargado" if general_context else "❌ No cargado",
+                "qa_chain_status": "✅ Activo" if snapshot and snapshot.qa_chain else "❌ Inactivo",
+                "wazuh_context_status": "✅ Cargado" if snapshot and snapshot.wazuh_context else "❌ No cargado",
+                "general_context_status": "✅ Cargado" if snapshot and snapshot.general_context else "❌ No cargado",
                 "ollama_url": OLLAMA_BASE_URL,
                 "ollama_model": OLLAMA_MODEL,
-                "days_range": days_range,
+                "days_range": range_days(session_days),
+                "log_window": session_days.label if isinstance(session_days, LogWindow) else None,
+                "context_snapshot": snapshot.describe() if snapshot else "Ninguno",
+                "shared_snapshots": context_registry.summary(),
+                "context_rebuild": f"🔄 En curso ({', '.join(map(describe_range, context_rebuilder.busy))})" if context_rebuilder.busy else "Inactiva",
+                "llm_queue": f"{llm_scheduler.in_flight}/{llm_scheduler.max_in_flight} en curso, {llm_scheduler.waiting} en espera",
+                "memory": f"{len(memory.turns)} turnos literales, ~{memory.tokens + memory.summary_tokens} tokens",
+                "semantic_retrieval": template_vectors.summary() if template_vectors is not None else "Desactivada",
                 "connection_duration": str(datetime.now() - connection_start),
                 "messages_processed": messages_processed,
                 "last_activity": str(datetime.now() - last_activity)
@@ -321,8 +4378,54 @@ async def websocket_endpoint(websocket: WebSocket):
             
             return diagnostic
         
+        # Recarga en segundo plano con avance para esta sesión
+        async def reload_context(past_days, force=True):
+            try:
+                if force:
+                    success = await context_rebuilder.rebuild(past_days, on_progress=send_rebuild_progress)
+                else:
+                    success = await context_rebuilder.acquire(past_days, on_progress=send_rebuild_progress) is not None
+                if success:
+                    await send_safe_message({
+                        "role": "bot", 
+                        "message": f"✅ Recarga completada exitosamente.\nAhora usando logs de: {describe_range(past_days)}.",
+                        "status": "reload_success"
+                    })
+                    memory.clear()
+                else:
+                    diagnostic = await system_diagnostic()
+                    error_msg = (
+                        f"❌ Error en la recarga.\n\n"
+                        f"Diagnóstico rápido:\n"
+                        f"- Ollama: {diagnostic.get('ollama_connection', 'Desconocido')}\n"
+                        f"- Logs encontrados: Verificando...\n\n"
+                        f"Usa /diagnostic para análisis completo."
+                    )
+                    await send_safe_message({
+                        "role": "bot", 
+                        "message": error_msg,
+                        "status": "reload_failed"
+                    })
+            except Exception as reload_error:
+                error_msg = (
+                    f"❌ Error crítico durante recarga:\n"
+                    f"**Error:** {str(reload_error)}\n"
+                    f"**Tipo:** {type(reload_error).__name__}\n\n"
+                    f"Usa /diagnostic para más información."
+                )
+                await send_safe_message({
+                    "role": "bot", 
+                    "message": error_msg,
+                    "status": "reload_critical_error",
+                    "error_details": {
+                        "error": str(reload_error),
+                        "type": type(reload_error).__name__,
+                        "traceback": traceback.format_exc()
+                    }
+                })
+        
         # Verificar que el sistema esté listo
-        if not qa_chain or not wazuh_context or not general_context:
+        if not context_registry.get(session_days):
             await send_safe_message({
                 "role": "system", 
                 "message": "⚠️ El Asistente no está listo. Iniciando diagnóstico del sistema...",
@@ -350,7 +4453,7 @@ async def websocket_endpoint(websocket: WebSocket):
             })
             
             try:
-                success = setup_chain(past_days=days_range)
+                success = await context_rebuilder.acquire(session_days, on_progress=send_rebuild_progress) is not None
                 if not success:
                     error_msg = (
                         "❌ Error al inicializar el sistema.\n\n"
@@ -390,27 +4493,66 @@ async def websocket_endpoint(websocket: WebSocket):
         
         # Mensaje de bienvenida
         welcome_msg = f"👋 ¡Hola! Soy un asistente inteligente.\n"
-        welcome_msg += f"🔍 **Modo Wazuh:** Menciona 'logs', 'security', 'wazuh', 'threat' para análisis de seguridad\n"
-        welcome_msg += f"💬 **Modo General:** Para cualquier otra pregunta\n"
-        welcome_msg += f"📊 Rango de logs: {days_range} días\n"
-        welcome_msg += f"🔧 Estado: {'✅ Listo' if qa_chain else '⚠️ Modo diagnóstico'}\n"  
+        welcome_msg += "🧭 Cada pregunta se clasifica sola según su intención, sin palabras clave:\n"
+        welcome_msg += "🔍 **Modo Wazuh:** Preguntas sobre los eventos y alertas de seguridad\n"
+        welcome_msg += "🖥️ **Modo agente:** Si nombras un agente, se analizan solo sus eventos\n"
+        welcome_msg += "📐 **Consulta estructurada:** Conteos y rankings exactos sobre el índice de logs\n"
+        welcome_msg += "💬 **Modo General:** Para cualquier otra pregunta\n"
+        ready = context_registry.get(session_days) is not None
+        welcome_msg += f"📊 Rango de logs: {describe_range(session_days)}\n"
+        welcome_msg += f"🔧 Estado: {'✅ Listo' if ready else '⚠️ Modo diagnóstico'}\n"  
         welcome_msg += f"💡 Escribe /help para ver comandos disponibles"
         
-        if qa_chain:
-            chat_history = [SystemMessage(content=general_context)]
-        
         await send_safe_message({
             "role": "bot", 
             "message": welcome_msg,
-            "status": "ready" if qa_chain else "limited"
+            "status": "ready" if ready else "limited"
         })
 
+        # Los mensajes se leen en segundo plano para detectar la desconexión
+        # también mientras una pregunta espera turno o se está generando
+        incoming = asyncio.Queue()
+        disconnected = asyncio.Event()
+
+        async def read_messages():
+            try:
+                while True:
+                    await incoming.put(await websocket.receive_text())
+            except Exception:
+                disconnected.set()
+                await incoming.put(None)
+
+        async def run_until_disconnect(coro):
+            task = asyncio.create_task(coro)
+            disconnect_wait = asyncio.create_task(disconnected.wait())
+            try:
+                await asyncio.wait({task, disconnect_wait}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                disconnect_wait.cancel()
+                if not task.done():
+                    task.cancel()
+            if disconnected.is_set() and task.cancelled():
+                raise WebSocketDisconnect()
+            return task.result()
+
+        async def send_queue_position(position):
+            await send_safe_message({
+                "role": "system",
+                "message": f"⏳ En cola para el modelo: posición {position}",
+                "status": "queued",
+                "position": position
+            })
+
+        reader_task = asyncio.create_task(read_messages())
+
         # Loop principal con manejo robusto de errores
         while True:
             try:
                 # Timeout para recibir mensajes con heartbeat
                 try:
-                    data = await asyncio.wait_for(websocket.receive_text(), timeout=300)  # 5 min timeout
+                    data = await asyncio.wait_for(incoming.get(), timeout=300)  # 5 min timeout
+                    if data is None:
+                        raise WebSocketDisconnect()
                     last_activity = datetime.now()
                     messages_processed += 1
                 except asyncio.TimeoutError:
@@ -450,8 +4592,8 @@ async def websocket_endpoint(websocket: WebSocket):
                     
                     # Test de logs
                     try:
-                        test_logs = load_logs_from_days(1)  # Solo 1 día para test rápido
-                        diag_msg += f"- Test de logs (1 día): {'✅' if test_logs else '❌'} ({len(test_logs) if test_logs else 0} logs)\n"
+                        test_logs = count_indexed_logs(1)  # Solo 1 día para test rápido
+                        diag_msg += f"- Test de logs (1 día): {'✅' if test_logs else '❌'} ({test_logs} logs)\n"
                     except Exception as e:
                         diag_msg += f"- Test de logs: ❌ Error: {str(e)}\n"
                     
@@ -468,10 +4610,12 @@ async def websocket_endpoint(websocket: WebSocket):
                     help_msg = (
                         "📋 **Menú de Ayuda:**\n\n"
                         "**Modos de Operación:**\n"
-                        "🔍 **Modo Wazuh:** Se activa automáticamente cuando mencionas:\n"
-                        "   - 'logs', 'security', 'wazuh', 'threat', 'alert', 'event'\n"
-                        "   - 'attack', 'intrusion', 'firewall', 'malware', 'vulnerability'\n"
-                        "   - 'breach', 'incident', 'monitoring', 'detection', 'siem'\n\n"
+                        "Un clasificador elige el modo de cada pregunta por su intención (no por palabras clave); "
+                        "el mensaje indica el modo usado.\n"
+                        "🔍 **Modo Wazuh:** Análisis de los eventos y alertas de seguridad del rango\n"
+                        "🖥️ **Modo agente:** Al nombrar un agente conocido se analizan solo sus eventos\n"
+                        "📐 **Consulta estructurada:** Conteos y rankings (cuántos, top, por agente/regla/IP/nivel/hora/día) "
+                        "con filtros de nivel, regla, IP y agente; resultado exacto sobre el índice de logs\n"
                         "💬 **Modo General:** Para cualquier otra pregunta\n\n"
                         "**Comandos del Sistema:**\n"
                         "/diagnostic - Diagnóstico completo del sistema\n"
@@ -479,13 +4623,18 @@ async def websocket_endpoint(websocket: WebSocket):
                         "/reload - Recargar logs con rango actual\n"
                         "/ping - Test de conectividad\n\n"
                         "**Configuración:**\n"
-                        "/set days <número> - Establecer días para cargar logs (1-365)\n\n"
+                        "/set days <número> - Establecer días para cargar logs (1-365)\n"
+                        "/set window <periodo> [filtros] - Ventana de eventos, p. ej. `2h`, `ayer 02:00-04:00`, "
+                        "`2h nivel>=10 agente=web01` (`/set window off` vuelve a los días)\n\n"
                         "**Información:**\n"
                         "/stat - Estadísticas de los logs\n"
                         "/uptime - Información de la sesión\n\n"
                         "**Ejemplos de uso:**\n"
                         "🔍 Wazuh: \"¿Cuáles son los eventos más frecuentes?\"\n"
                         "🔍 Wazuh: \"Muéstrame alertas de seguridad del último día\"\n"
+                        "🖥️ Agente: \"¿Qué le pasa al agente web01?\"\n"
+                        "📐 Consulta: \"Top 10 agentes con más alertas en los últimos 3 días\"\n"
+                        "📐 Consulta: \"¿Cuántas alertas de nivel 12 o más hubo hoy?\"\n"
                         "💬 General: \"¿Cómo funciona Python?\"\n"
                         "💬 General: \"Explícame qué es Docker\""
                     )
@@ -499,7 +4648,7 @@ async def websocket_endpoint(websocket: WebSocket):
                         f"- Tiempo activa: {datetime.now() - connection_start}\n"
                         f"- Mensajes procesados: {messages_processed}\n"
                         f"- Última actividad: {last_activity.strftime('%H:%M:%S')}\n"
-                        f"- Estado del sistema: {'✅ Operativo' if qa_chain else '⚠️ Modo limitado'}"
+                        f"- Estado del sistema: {'✅ Operativo' if context_registry.get(session_days) else '⚠️ Modo limitado'}"
                     )
                     await send_safe_message({"role": "bot", "message": uptime_info})
                     continue
@@ -513,7 +4662,8 @@ async def websocket_endpoint(websocket: WebSocket):
                         status_msg += f"- Contexto General: {diagnostic['general_context_status']}\n"
                         status_msg += f"- Ollama: {diagnostic.get('ollama_connection', 'Verificando...')}\n"
                         status_msg += f"- Modelo objetivo: {OLLAMA_MODEL}\n"
-                        status_msg += f"- Rango de días: {days_range}\n"
+                        status_msg += f"- Rango de logs: {describe_range(session_days)}\n"
+                        status_msg += f"- Snapshot de contexto: {diagnostic['context_snapshot']}\n"
                         status_msg += f"- Mensajes procesados: {messages_processed}"
                         
                         await send_safe_message({
@@ -531,50 +4681,47 @@ async def websocket_endpoint(websocket: WebSocket):
                 if data.lower() == "/reload":
                     await send_safe_message({
                         "role": "bot", 
-                        "message": f"🔄 Recargando logs de los últimos {days_range} días...",
+                        "message": (
+                            f"🔄 Recargando logs ({describe_range(session_days)})...\n"
+                            "Puedes seguir preguntando: se usa el contexto actual hasta que el nuevo esté listo."
+                        ),
                         "status": "reloading"
                     })
-                    
+                    # En segundo plano para que la sesión siga atendiendo mensajes
+                    reload_task = asyncio.create_task(reload_context(session_days))
+                    continue
+
+                if data.lower().startswith("/set window"):
+                    spec = data[len("/set window"):].strip()
                     try:
-                        success = setup_chain(past_days=days_range)
-                        if success and qa_chain:
-                            await send_safe_message({
-                                "role": "bot", 
-                                "message": f"✅ Recarga completada exitosamente.\nAhora usando logs de los últimos {days_range} días.",
-                                "status": "reload_success"
-                            })
-                            chat_history = [SystemMessage(content=general_context)]
+                        if spec.lower() in ("off", "dias", "días", "days"):
+                            new_range = days_range
                         else:
-                            diagnostic = await system_diagnostic()
-                            error_msg = (
-                                f"❌ Error en la recarga.\n\n"
-                                f"Diagnóstico rápido:\n"
-                                f"- Ollama: {diagnostic.get('ollama_connection', 'Desconocido')}\n"
-                                f"- Logs encontrados: Verificando...\n\n"
-                                f"Usa /diagnostic para análisis completo."
+                            new_range = parse_log_window(spec)
+                    except ValueError as e:
+                        await send_safe_message({
+                            "role": "bot",
+                            "message": (
+                                f"⚠️ {e}\n**Uso:** `/set window <periodo> [filtros]`\n"
+                                "**Ejemplos:** `/set window 2h`, `/set window ayer 02:00-04:00`, "
+                                "`/set window 2024-05-01T22:00..2024-05-02T02:00 nivel>=10 grupo=sshd`"
                             )
-                            await send_safe_message({
-                                "role": "bot", 
-                                "message": error_msg,
-                                "status": "reload_failed"
-                            })
-                    except Exception as reload_error:
-                        error_msg = (
-                            f"❌ Error crítico durante recarga:\n"
-                            f"**Error:** {str(reload_error)}\n"
-                            f"**Tipo:** {type(reload_error).__name__}\n\n"
-                            f"Usa /diagnostic para más información."
-                        )
+                        })
+                        continue
+                    context_registry.pin(new_range)
+                    context_registry.unpin(session_days)
+                    session_days = new_range
+                    if context_registry.get(session_days):
                         await send_safe_message({
-                            "role": "bot", 
-                            "message": error_msg,
-                            "status": "reload_critical_error",
-                            "error_details": {
-                                "error": str(reload_error),
-                                "type": type(reload_error).__name__,
-                                "traceback": traceback.format_exc()
-                            }
+                            "role": "bot",
+                            "message": f"✅ Rango establecido: {describe_range(session_days)}.\n♻️ Se reutiliza el contexto ya cargado para este rango."
+                        })
+                    else:
+                        await send_safe_message({
+                            "role": "bot",
+                            "message": f"✅ Rango establecido: {describe_range(session_days)}.\n🔄 Cargando su contexto en segundo plano..."
                         })
+                        reload_task = asyncio.create_task(reload_context(session_days, force=False))
                     continue
 
                 if data.lower().startswith("/set days"):
@@ -587,11 +4734,20 @@ async def websocket_endpoint(websocket: WebSocket):
                                 "message": "⚠️ Especifica un número entre 1 y 365.\nEjemplo: `/set days 7`"
                             })
                             continue
-                        days_range = new_days
-                        await send_safe_message({
-                            "role": "bot", 
-                            "message": f"✅ Rango establecido a {days_range} días.\n💡 Usa `/reload` para aplicar el cambio."
-                        })
+                        context_registry.pin(new_days)
+                        context_registry.unpin(session_days)
+                        session_days = new_days
+                        if context_registry.get(session_days):
+                            await send_safe_message({
+                                "role": "bot", 
+                                "message": f"✅ Rango establecido a {session_days} días.\n♻️ Se reutiliza el contexto ya cargado para este rango."
+                            })
+                        else:
+                            await send_safe_message({
+                                "role": "bot", 
+                                "message": f"✅ Rango establecido a {session_days} días.\n🔄 Cargando su contexto en segundo plano..."
+                            })
+                            reload_task = asyncio.create_task(reload_context(session_days, force=False))
                     except (ValueError, IndexError):
                         await send_safe_message({
                             "role": "bot", 
@@ -612,16 +4768,11 @@ async def websocket_endpoint(websocket: WebSocket):
                             "status": "loading_stats"
                         })
                         
-                        logs = load_logs_from_days(days_range)
-                        stats = get_stats(logs)
-                        
-                        # Estadísticas adicionales
-                        if logs:
-                            sample_log = logs[0] if logs else {}
-                            stats += f"\n\n**Detalles adicionales:**\n"
-                            stats += f"- Tamaño promedio por log: {sum(len(str(log)) for log in logs[:100]) // min(len(logs), 100)} caracteres\n"
-                            stats += f"- Campos disponibles en muestra: {list(sample_log.keys())[:10]}\n"
-                            stats += f"- Rango configurado: {days_range} días"
+                        log_filter = session_days.log_filter() if isinstance(session_days, LogWindow) else None
+                        stats = (await asyncio.to_thread(get_index_stats, range_days(session_days), log_filter)).format()
+                        stats += f"\n\n- Rango configurado: {describe_range(session_days)}"
+                        if log_filter and log_filter.groups:
+                            stats += "\n- El filtro de grupos no se aplica a las estadísticas (no está indexado)"
                         
                         await send_safe_message({
                             "role": "bot", 
@@ -635,8 +4786,9 @@ async def websocket_endpoint(websocket: WebSocket):
                         })
                     continue
                 
-                # Verificar que qa_chain esté disponible antes de procesar pregunta
-                if not qa_chain:
+                # Fijar el snapshot de la sesión para toda la pregunta
+                snapshot = context_registry.get(session_days)
+                if not snapshot:
                     await send_safe_message({
                         "role": "bot", 
                         "message": (
@@ -652,7 +4804,6 @@ async def websocket_endpoint(websocket: WebSocket):
                     continue
                 
                 # Procesar pregunta regular con manejo robusto de errores
-                chat_history.append(HumanMessage(content=data))
                 print(f"🧠 Pregunta recibida ({messages_processed}): {data}")
                 
                 # Indicar que está procesando
@@ -665,22 +4816,128 @@ async def websocket_endpoint(websocket: WebSocket):
                 try:
                     # Timeout para la respuesta de Ollama con mejor manejo
                     # Determinar qué contexto usar basado en la pregunta
-                    if is_wazuh_related_question(data):
+                    known_agents = snapshot.event_ranker.agents if snapshot.event_ranker else ()
+                    route = question_router.route(data, known_agents)
+                    print(f"🧭 Intención: {route.describe()}")
+                    structured_query = parse_structured_query(data, session_days) if route.uses_logs else None
+                    if structured_query:
+                        print(f"📐 Consulta estructurada detectada: {structured_query.describe()}")
+                        mode = "query"
+                        mode_info = "📐 **Consulta estructurada:** Resultado exacto sobre el índice de logs"
+                    elif route.intent == "agent":
+                        print(f"🖥️ Pregunta sobre {', '.join(route.agents)}: {data}")
+                        mode = "agent"
+                        mode_info = f"🖥️ **Modo agente:** Analizando los eventos de {', '.join(route.agents)}"
+                    elif route.uses_logs:
                         print(f"🔍 Pregunta relacionada con Wazuh detectada: {data}")
-                        full_message = f"{wazuh_context}\n\nUser question: {data}"
+                        mode = "wazuh"
                         mode_info = "🔍 **Modo Wazuh:** Analizando logs de seguridad"
                     else:
                         print(f"💬 Pregunta general detectada: {data}")
-                        full_message = f"{general_context}\n\nUser question: {data}"
+                        mode = "general"
                         mode_info = "💬 **Modo General:** Asistente general"
+
+                    stream_id = f"{id(websocket)}-{messages_processed}"
+                    started = time.perf_counter()
+
+                    query_result = None
+                    if mode == "query":
+                        # Se consulta el índice vivo antes del cache: el ámbito es el resultado
+                        total, rows = await asyncio.to_thread(structured_query.run)
+                        query_result = structured_query.format_result(total, rows)
+                        print(f"📐 Consulta resuelta en {time.perf_counter() - started:.3f} s")
+                        if not STRUCTURED_QUERY_PHRASING:
+                            memory.add(data, query_result, snapshot.qa_chain)
+                            await send_safe_message({
+                                "role": "bot",
+                                "message": f"{mode_info}\n\n{query_result}",
+                                "status": "response_complete",
+                                "stream_id": stream_id,
+                                "processing_time": f"{(time.perf_counter() - started) * 1000:.0f} ms"
+                            })
+                            continue
+
+                    # Cache de respuestas: misma pregunta sobre el mismo contexto y el
+                    # mismo historial (las consultas estructuradas, sobre el mismo resultado)
+                    if mode == "query":
+                        cache_scope = response_cache.scope(mode, snapshot, result=query_result)
+                    else:
+                        cache_scope = response_cache.scope(mode, snapshot, memory.messages())
+                    cache_key = response_cache.key(cache_scope, data)
+                    question_embedding = await response_cache.embed(data)
+                    cached_answer = response_cache.get(cache_key, cache_scope, question_embedding)
+                    if cached_answer:
+                        print(f"⚡ Respuesta servida desde el cache: {data}")
+                        memory.add(data, cached_answer, snapshot.qa_chain)
+                        await send_safe_message({
+                            "role": "bot",
+                            "message": f"{mode_info}\n\n{cached_answer}",
+                            "status": "response_complete",
+                            "stream_id": stream_id,
+                            "cached": True,
+                            "processing_time": f"{(time.perf_counter() - started) * 1000:.0f} ms"
+                        })
+                        continue
+
+                    # Mensajes estructurados: prefijo de sistema estable + turnos previos +
+                    # pregunta actual, así Ollama solo procesa los tokens nuevos
+                    if mode == "query":
+                        # El LLM solo redacta el resultado exacto; prompt corto y sin historial
+                        full_message = [
+                            SystemMessage(content=QUERY_PHRASING_PROMPT),
+                            HumanMessage(content=f"Question: {data}\n\nExact query result:\n{query_result}")
+                        ]
+                    elif mode in ("wazuh", "agent"):
+                        # Con recuperación semántica se embebe la pregunta: fuera del event loop
+                        agents = route.agents if mode == "agent" else None
+                        question_events = await asyncio.to_thread(create_question_events, snapshot, data, CONTEXT_TOKEN_BUDGET, agents)
+                        question_text = f"User question: {data}"
+                        if question_events:
+                            question_text = f"Eventos más relevantes para esta pregunta:\n{question_events}\n\n{question_text}"
+                        full_message = [SystemMessage(content=snapshot.wazuh_context), *memory.messages(), HumanMessage(content=question_text)]
+                    else:
+                        full_message = [SystemMessage(content=snapshot.general_context), *memory.messages(), HumanMessage(content=data)]
                     
+                    PROMPT_TOKENS.observe(sum(estimate_tokens(message.content) for message in full_message))
+
+                    # Respuesta en streaming: cada grupo de tokens es un frame
+                    llm = snapshot.qa_chain
+                    queued_at = time.perf_counter()
+                    first_token_pending = True
+
+                    async def send_chunk(text):
+                        nonlocal first_token_pending
+                        if first_token_pending:
+                            first_token_pending = False
+                            LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started)
+                        return await send_safe_message({
+                            "role": "bot",
+                            "message": text,
+                            "status": "streaming",
+                            "stream_id": stream_id
+                        })
+
+                    async def generate():
+                        LLM_QUEUE_WAIT_SECONDS.observe(time.perf_counter() - queued_at)
+                        await send_safe_message({
+                            "role": "bot",
+                            "message": f"{mode_info}\n\n",
+                            "status": "stream_start",
+                            "stream_id": stream_id
+                        })
+                        with LLM_GENERATION_SECONDS.time():
+                            return await stream_llm_response(llm, full_message, send_chunk)
+
+                    # Turno en el planificador compartido; se cancela si el cliente se va
                     response = await asyncio.wait_for(
-                        asyncio.to_thread(qa_chain.invoke, full_message),
-                        timeout=3600  # 2 minutos timeout
+                        run_until_disconnect(llm_scheduler.run(session_id, generate, on_position=send_queue_position)),
+                        timeout=3600
                     )
                     
-                    answer = response.content.replace("\\n", "\n").strip() if hasattr(response, 'content') else str(response)
-                    if not answer:
+                    answer = response.replace("\\n", "\n").strip()
+                    if answer:
+                        response_cache.put(cache_key, cache_scope, answer, question_embedding)
+                    else:
                         answer = (
                             "⚠️ No pude generar una respuesta para tu consulta.\n\n"
                             "**Sugerencias:**\n"
@@ -689,14 +4946,18 @@ async def websocket_endpoint(websocket: WebSocket):
                             "- Usa `/stat` para ver información disponible"
                         )
 
-                    chat_history.append(SystemMessage(content=answer))
+                    # En el historial va la pregunta sin los eventos para no arrastrarlos
+                    memory.add(data, answer, llm)
                     await send_safe_message({
                         "role": "bot", 
                         "message": f"{mode_info}\n\n{answer}",
                         "status": "response_complete",
-                        "processing_time": "< 1 h"
+                        "stream_id": stream_id,
+                        "processing_time": f"{time.perf_counter() - started:.1f} s"
                     })
                     
+                except WebSocketDisconnect:
+                    raise
                 except asyncio.TimeoutError:
                     timeout_msg = (
                         "⏰ **Timeout: La consulta tardó más de 1 min.**\n\n"
@@ -714,9 +4975,6 @@ async def websocket_endpoint(websocket: WebSocket):
                         "message": timeout_msg,
                         "status": "timeout_error"
                     })
-                    # Limpiar el último mensaje del historial
-                    if chat_history and isinstance(chat_history[-1], HumanMessage):
-                        chat_history.pop()
                         
                 except Exception as e:
                     error_details = {
@@ -746,9 +5004,6 @@ async def websocket_endpoint(websocket: WebSocket):
                         "error_details": error_details
                     })
                     
-                    # Limpiar el último mensaje del historial
-                    if chat_history and isinstance(chat_history[-1], HumanMessage):
-                        chat_history.pop()
 
             except WebSocketDisconnect:
                 print(f"⚠️ Cliente desconectado después de {datetime.now() - connection_start}")
@@ -804,6 +5059,15 @@ async def websocket_endpoint(websocket: WebSocket):
         except:
             print("❌ No se pudo enviar mensaje de error crítico")
     finally:
+        if reader_task:
+            reader_task.cancel()
+        if reload_task:
+            reload_task.cancel()
+        if session_days is not None:
+            context_registry.unpin(session_days)
+        WEBSOCKETS_ACTIVE.dec()
+        if memory:
+            memory.close()
         session_duration = datetime.now() - connection_start
         print(f"🔌 Cerrando conexión WebSocket - Duración: {session_duration}, Mensajes: {messages_processed}")
         try:
@@ -815,14 +5079,28 @@ async def websocket_endpoint(websocket: WebSocket):
 
 
 
+async def initial_setup():
+    success = await context_rebuilder.rebuild(days_range)
+    if not success:
+        print("⚠️ Advertencia: No se pudo inicializar el sistema completamente")
+
+
 @app.on_event("startup")
 async def on_startup():
-    print("🚀 Iniciando FastAPI y cargando vectorstore...")
+    print("🚀 Iniciando FastAPI...")
     print(f"🔗 Ollama URL configurada: {OLLAMA_BASE_URL}")
     print(f"🤖 Modelo configurado: {OLLAMA_MODEL}")
-    success = setup_chain(past_days=days_range)
-    if not success:
-        print("⚠️ Advertencia: No se pudo inicializar el sistema completamente")
+    print(f"🧠 Recuperación semántica: {EMBEDDING_MODEL if SEMANTIC_RETRIEVAL else 'desactivada'}")
+    # El contexto se construye en segundo plano: /health y los WebSocket responden ya
+    asyncio.create_task(initial_setup())
+    if ARCHIVE_FOLLOW_INTERVAL > 0:
+        asyncio.create_task(follow_archives_loop())
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    close_sftp_pools()
+    full_log_reader.close()
 
 
 if __name__ == "__main__":
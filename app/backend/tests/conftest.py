@@ -0,0 +1,5 @@
+import os
+import sys
+
+# main.py vive en app/backend, un nivel por encima de los tests
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
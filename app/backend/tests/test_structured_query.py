@@ -0,0 +1,76 @@
+from datetime import datetime
+
+import pytest
+
+import main
+from main import StructuredQuery, parse_structured_query
+
+
+@pytest.mark.parametrize("question", [
+    "cuántas inyecciones sql hubo hoy",
+    "how many ssh brute force attempts today",
+    "cuantos ataques hubo hoy",
+    "cuántos intentos de login fallidos por hora",
+])
+def test_subject_without_index_filter_goes_to_llm(question):
+    assert parse_structured_query(question) is None
+
+
+@pytest.mark.parametrize("question", [
+    "hola, ¿qué tal?",
+    "explícame qué es un SIEM",
+    "qué reglas se disparan más",
+])
+def test_non_aggregate_questions(question):
+    assert parse_structured_query(question) is None
+
+
+def test_top_agents():
+    query = parse_structured_query("top 10 agentes con más alertas")
+    assert (query.kind, query.group_by, query.limit) == ("top", "agent", 10)
+    assert query.filters == {}
+
+
+def test_count_with_level_and_today():
+    query = parse_structured_query("cuántas alertas de nivel 12 o más hubo hoy")
+    assert query.kind == "count"
+    assert query.filters == {"rule_level": (">=", 12)}
+    assert query.since is not None and query.until is None
+    assert query.past_days == 1
+
+
+def test_count_by_rule():
+    query = parse_structured_query("cuántas veces saltó la regla 5710")
+    assert query.kind == "count"
+    assert query.filters == {"rule_id": "5710"}
+
+
+def test_group_by_agent():
+    query = parse_structured_query("número de alertas por agente")
+    assert (query.kind, query.group_by) == ("top", "agent")
+
+
+def test_count_per_hour_and_day():
+    assert parse_structured_query("how many events per day").group_by == "day"
+    assert parse_structured_query("cuántos eventos hubo por hora ayer").group_by == "hour"
+
+
+def test_filters_by_ip_and_agent():
+    query = parse_structured_query("cuántos eventos del agente web-01 desde la ip 10.0.0.5 en los últimos 3 días")
+    assert query.filters == {"agent": "web-01", "srcip": "10.0.0.5"}
+    assert query.past_days == 3
+
+
+def test_run_reads_the_days_of_an_absolute_window(monkeypatch):
+    calls = []
+
+    def fake_iter_index_days(past_days, source=None, since=None, until=None):
+        calls.append((past_days, since, until))
+        return iter(())
+
+    monkeypatch.setattr(main, "iter_index_days", fake_iter_index_days)
+    since = datetime(2026, 9, 1).timestamp()
+    until = datetime(2026, 9, 3).timestamp()
+    query = StructuredQuery("count", since=since, until=until, past_days=1)
+    assert query.run() == (0, [])
+    assert calls == [(1, since, until)]
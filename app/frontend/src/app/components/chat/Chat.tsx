@@ -4,6 +4,13 @@ import { signOut } from "@/lib/auth.client"
 import { useWebSocket } from "../../hooks/useWebSocket"
 import { config, getWebSocketHeaders } from "@/lib/config"
 
+// Estados intermedios de una respuesta: la pregunta sigue en curso hasta un estado final
+// (response_complete, stats_complete, los de error...) o un mensaje sin estado
+const PENDING_STATUSES = new Set([
+    "queued", "processing", "heartbeat", "timeout_warning", "stream_start", "streaming",
+    "loading_stats", "reloading", "reload_progress", "initializing", "diagnostic",
+])
+
 interface Message {
     id: string
     message: string | null
@@ -25,6 +32,33 @@ export default function Chat() {
         headers: getWebSocketHeaders(),
         onMessage: (wsMessage) => {
             console.log(wsMessage)
+            // Respuestas en streaming: los frames con el mismo stream_id forman un mensaje
+            if (wsMessage.stream_id) {
+                const streamId = wsMessage.stream_id
+                setMessages(prev => {
+                    const index = prev.findIndex(m => m.id === streamId)
+                    if (index === -1) {
+                        return [...prev, {
+                            id: streamId,
+                            message: wsMessage.message || "",
+                            role: wsMessage.role,
+                            timestamp: new Date(wsMessage?.timestamp || new Date())
+                        }]
+                    }
+                    const updated = [...prev]
+                    updated[index] = {
+                        ...updated[index],
+                        message: wsMessage.status === "streaming"
+                            ? (updated[index].message || "") + wsMessage.message
+                            : wsMessage.message
+                    }
+                    return updated
+                })
+                if (!PENDING_STATUSES.has(wsMessage.status || "")) {
+                    setIsLoading(false)
+                }
+                return
+            }
             const message: Message = {
                 id: wsMessage.id,
                 message: wsMessage?.message || "",
@@ -32,7 +66,9 @@ export default function Chat() {
                 timestamp: new Date(wsMessage?.timestamp || new Date())
             }
             setMessages(prev => [...prev, message])
-            setIsLoading(false)
+            if (!PENDING_STATUSES.has(wsMessage.status || "")) {
+                setIsLoading(false)
+            }
         },
         onConnect: () => {
             console.log('Conectado al chat en tiempo real')
@@ -6,6 +6,8 @@ interface WebSocketMessage {
     role: 'user' | 'assistant'
     timestamp: string
     id: string
+    status?: string
+    stream_id?: string
 }
 
 interface UseWebSocketProps {